@@ -0,0 +1,9 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+# add the images of new products to the training rec of create_dataset_A.sh, with the options it was created with
+python3 -u bson2rec_simple.py \
+    --bson          ${ROOT}/data/train_new.bson \
+    --out-rec       ${ROOT}/data/train_split_A_train.rec \
+    --append
@@ -1,7 +1,20 @@
 # -*- coding: utf-8 -*-
 
+"""
+Write the images of a bson to an indexed rec, or append the images of new products to one (--append).
+
+Next to <prefix>.rec and <prefix>.idx, <prefix>.meta.json keeps the options of the rec (label mapping,
+md5 filtering), the counts to continue from (next id, images by category) and the list of appends,
+and <prefix>.md5 the md5 digests of the images written with --unique-md5, so an append costs
+the new products only. A rec created before these files is indexed once by reading its records.
+"""
+
 import sys
 import os
+import json
+import time
+import struct
+import shutil
 import hashlib
 import pickle
 import random
@@ -21,30 +34,55 @@ import zmq
 
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from data.category import get_category_dict
+from data.category import get_category_arrays
 from data import utils
 
+RECORDIO_MAGIC = 0xced7230a
+UNLIMITED = 99999999  # --under-sampling
+
+
+def idx_path(rec_path):
+    return os.path.splitext(rec_path)[0] + '.idx'
+
+
+def meta_path(rec_path):
+    return os.path.splitext(rec_path)[0] + '.meta.json'
 
-def read_images(args):
-    cate1_dict, cate2_dict, cate3_dict = get_category_dict()
+
+def md5_path(rec_path):
+    return os.path.splitext(rec_path)[0] + '.md5'
+
+
+def _new_state():
+    """what read_images continues from: the next record id, the images by category and the md5s written"""
+    return {'next_id': 0, 'category_counter': Counter(), 'used_md5': set()}
+
+
+def read_images(args, state=None):
+    if args.cate_type not in (1, 3):
+        raise ValueError('invalid cate type: {}'.format(args.cate_type))
+    cates = get_category_arrays()
 
     logging.info('read bson file: {}'.format(args.bson))
     total_count = utils.get_bson_count(args.bson)
     data = bson.decode_file_iter(open(args.bson, 'rb'))
 
-    idx = 0
-    category_counter = Counter()
+    state = state if state is not None else _new_state()  # updated in place
+    category_counter = state['category_counter']
     md5_dict = pickle.load(open(args.md5_dict_pkl, 'rb')) if args.md5_dict_pkl else None
     if md5_dict is None:
         logging.info('md5_dict is not provided')
     else:
         logging.info('md5_dict has {} keys'.format(len(md5_dict)))
 
-    used_md5_set = set()
+    used_md5_set = state['used_md5']
     for i, prod in tqdm(enumerate(data), unit='products', total=total_count):
         product_id = prod.get('_id')
         category_id = prod.get('category_id', None)  # This won't be in Test data
         images = prod.get('imgs')
+        class_id = int(cates.to_class(category_id, args.cate_type)) if category_id is not None else -1
+        if category_id is not None and class_id < 0:
+            raise KeyError('unknown category_id: {}'.format(category_id))
 
         for img in images:
             img_bytes = img['picture']
@@ -58,55 +96,211 @@ def read_images(args):
 
             item = None
             if category_id is None:
-                item = (idx, img_bytes, -1)
+                item = (state['next_id'], img_bytes, -1, h)
             elif category_counter[category_id] < args.under_sampling:
-                if args.cate_type == 1:
-                    class_id = cate1_dict[(cate3_dict[category_id]['names'][0],)]['child_cate3'][category_id]
-                elif args.cate_type == 3:
-                    class_id = cate3_dict[category_id]['cate3_class_id']
-                else:
-                    raise ValueError('invalid cate type: {}'.format(args.cate_type))
-                item = (idx, img_bytes, class_id)
+                item = (state['next_id'], img_bytes, class_id, h)
                 category_counter[category_id] += 1
 
             if item is not None:
-                idx += 1
-                yield item  # id, img_bytes, label
-
+                state['next_id'] += 1
+                yield item  # id, img_bytes, label, md5
 
-def main(args):
-    if os.path.exists(args.out_rec):
-        raise FileExistsError(args.out_rec)
 
-    logging.info('write rec file to {}'.format(args.out_rec))
-    rec_writer = mx.recordio.MXRecordIO(args.out_rec, 'w')
-    count = 0
+def write_rec(args, rec_path, state):
+    """write the images shuffled by blocks of --shuffle-size to rec_path and its .idx, returns their md5s"""
+    logging.info('write rec file to {}'.format(rec_path))
+    rec_writer = mx.recordio.MXIndexedRecordIO(idx_path(rec_path), rec_path, 'w')
     random.seed(args.random_seed)
     images_buf = []
-    for item in read_images(args):
+    digests = []
+
+    def _flush():
+        logging.info('shuffle {} images'.format(len(images_buf)))
+        item_perm = [i for i in range(len(images_buf))]
+        random.shuffle(item_perm)
+        logging.info('write {} images'.format(len(images_buf)))
+        for i in tqdm(item_perm, total=len(item_perm), unit='images', desc='write to rec file'):
+            rec_writer.write_idx(*images_buf[i])
+        del images_buf[:]
+
+    for item in read_images(args, state):
         header = mx.recordio.IRHeader(0, item[2], item[0], 0)
-        rec = mx.recordio.pack(header, item[1])
-        images_buf.append(rec)
+        images_buf.append((item[0], mx.recordio.pack(header, item[1])))
+        digests.append(item[3])
         if len(images_buf) >= args.shuffle_size:
-            logging.info('shuffle {} images'.format(len(images_buf)))
-            item_perm = [i for i in range(len(images_buf))]
-            random.shuffle(item_perm)
-            logging.info('write {} images'.format(len(images_buf)))
-            for i in tqdm(item_perm, total=len(item_perm), unit='images', desc='write to rec file'):
-                rec_writer.write(images_buf[i])
-            del images_buf[:]
-            images_buf = []
-        count += 1
-
-    logging.info('shuffle {} images'.format(len(images_buf)))
-    item_perm = [i for i in range(len(images_buf))]
-    random.shuffle(item_perm)
-    logging.info('write {} images'.format(len(images_buf)))
-    for i in tqdm(item_perm, total=len(item_perm), unit='images', desc='write to rec file'):
-        rec_writer.write(images_buf[i])
+            _flush()
+    _flush()
 
     rec_writer.close()
-    logging.info('complete. {} images'.format(count))
+    return digests
+
+
+def _write_digests(path, digests, mode):
+    with open(path, mode) as writer:
+        for h in digests:
+            writer.write(bytes.fromhex(h))
+
+
+def _new_meta(args, state, num_records, rec_size, md5_count):
+    return {
+        'cate_type': args.cate_type,
+        'unique_md5': args.unique_md5,
+        'under_sampling': args.under_sampling,
+        'md5_dict_pkl': os.path.abspath(args.md5_dict_pkl) if args.md5_dict_pkl else None,
+        'num_records': num_records,
+        'next_id': state['next_id'],
+        'rec_size': rec_size,
+        'md5_count': md5_count,
+        'category_counts': {str(k): v for k, v in state['category_counter'].items()},
+        'appends': [],
+    }
+
+
+def save_meta(rec_path, meta):
+    with open(meta_path(rec_path) + '.tmp', 'w') as writer:
+        json.dump(meta, writer, indent=2)
+    os.replace(meta_path(rec_path) + '.tmp', meta_path(rec_path))
+
+
+def load_meta(rec_path):
+    with open(meta_path(rec_path), 'r') as reader:
+        return json.load(reader)
+
+
+def iter_rec(rec_path):
+    """yield (offset, record) of a rec, from the RecordIO framing (a record is split where it contains the magic)"""
+    with open(rec_path, 'rb') as reader:
+        offset, parts = 0, []
+        while True:
+            head = reader.read(8)
+            if len(head) < 8:
+                break
+            magic, lrec = struct.unpack('<II', head)
+            if magic != RECORDIO_MAGIC:
+                raise ValueError('invalid record at {} in {}'.format(reader.tell() - 8, rec_path))
+            cflag, length = lrec >> 29, lrec & ((1 << 29) - 1)
+            if cflag in (0, 1):  # whole or first part
+                offset, parts = reader.tell() - 8, []
+            parts.append(reader.read(length))
+            reader.seek(-length % 4, os.SEEK_CUR)  # padding
+            if cflag in (0, 3):  # whole or last part
+                yield offset, struct.pack('<I', RECORDIO_MAGIC).join(parts)
+
+
+def index_rec(args, rec_path):
+    """write the .idx, .md5 and meta of a rec created before they were, reading all of its records"""
+    logging.info('index {}, created without {}'.format(rec_path, meta_path(rec_path)))
+    if args.under_sampling < UNLIMITED:
+        raise ValueError('images by category of {} are unknown, --under-sampling cannot continue'.format(rec_path))
+    state, count = _new_state(), 0
+    with open(idx_path(rec_path), 'w') as idx_writer:
+        for offset, record in tqdm(iter_rec(rec_path), unit='images', desc='index rec file'):
+            header, img_bytes = mx.recordio.unpack(record)
+            idx_writer.write('{}\t{}\n'.format(header.id, offset))
+            if args.unique_md5:
+                state['used_md5'].add(hashlib.md5(img_bytes).hexdigest())
+            state['next_id'] = max(state['next_id'], header.id + 1)
+            count += 1
+    if args.unique_md5:
+        _write_digests(md5_path(rec_path), sorted(state['used_md5']), 'wb')
+    meta = _new_meta(args, state, count, os.path.getsize(rec_path), len(state['used_md5']))
+    save_meta(rec_path, meta)
+    return meta
+
+
+def _load_state(rec_path, meta):
+    state = _new_state()
+    state['next_id'] = meta['next_id']
+    state['category_counter'].update({int(k): v for k, v in meta['category_counts'].items()})
+    if meta['unique_md5']:
+        with open(md5_path(rec_path), 'rb') as reader:
+            digests = reader.read(16 * meta['md5_count'])
+        state['used_md5'].update(digests[i:i + 16].hex() for i in range(0, len(digests), 16))
+    return state
+
+
+def _truncate(path, size):
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        with open(path, 'r+b') as f:
+            f.truncate(size)
+
+
+def _rollback(rec_path, meta):
+    """drop what an interrupted append wrote after the last complete one"""
+    if os.path.getsize(rec_path) == meta['rec_size']:
+        return
+    logging.warning('{} was not completely appended, truncate it to {} bytes'.format(rec_path, meta['rec_size']))
+    _truncate(rec_path, meta['rec_size'])
+    with open(idx_path(rec_path), 'r') as reader:
+        lines = [reader.readline() for _ in range(meta['num_records'])]
+    with open(idx_path(rec_path), 'w') as writer:
+        writer.writelines(lines)
+    if meta['unique_md5']:
+        _truncate(md5_path(rec_path), 16 * meta['md5_count'])
+
+
+def create(args):
+    state = _new_state()
+    digests = write_rec(args, args.out_rec, state)
+    if args.unique_md5:
+        _write_digests(md5_path(args.out_rec), digests, 'wb')
+    meta = _new_meta(args, state, len(digests), os.path.getsize(args.out_rec), len(digests) if args.unique_md5 else 0)
+    save_meta(args.out_rec, meta)
+    logging.info('complete. {} images'.format(len(digests)))
+
+
+def append(args):
+    """write the new images to a temporary rec, then add its records and index to the end of --out-rec"""
+    if os.path.exists(meta_path(args.out_rec)):
+        meta = load_meta(args.out_rec)
+        _rollback(args.out_rec, meta)
+    else:
+        meta = index_rec(args, args.out_rec)
+
+    md5_dict_pkl = os.path.abspath(args.md5_dict_pkl) if args.md5_dict_pkl else None
+    for name, value in (('cate_type', args.cate_type), ('unique_md5', args.unique_md5),
+                        ('under_sampling', args.under_sampling), ('md5_dict_pkl', md5_dict_pkl)):
+        if meta[name] != value:
+            raise ValueError('{} of {} is {}, not {}'.format(name, args.out_rec, meta[name], value))
+    if os.path.abspath(args.bson) in [x['bson'] for x in meta['appends']]:
+        raise ValueError('{} is already appended to {}'.format(args.bson, args.out_rec))
+
+    state = _load_state(args.out_rec, meta)
+    first_id = state['next_id']
+    tmp_rec = os.path.splitext(args.out_rec)[0] + '.append.rec'
+    digests = write_rec(args, tmp_rec, state)
+
+    rec_size = os.path.getsize(args.out_rec)
+    with open(args.out_rec, 'ab') as writer, open(tmp_rec, 'rb') as reader:
+        shutil.copyfileobj(reader, writer, 16 * 1024 * 1024)
+    with open(idx_path(args.out_rec), 'a') as writer, open(idx_path(tmp_rec), 'r') as reader:
+        for line in reader:
+            key, offset = line.split('\t')
+            writer.write('{}\t{}\n'.format(key, int(offset) + rec_size))
+    if args.unique_md5:
+        _write_digests(md5_path(args.out_rec), digests, 'ab')
+    os.remove(tmp_rec)
+    os.remove(idx_path(tmp_rec))
+
+    meta['appends'].append({'bson': os.path.abspath(args.bson), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                            'images': len(digests), 'first_id': first_id, 'next_id': state['next_id'],
+                            'begin': rec_size, 'end': os.path.getsize(args.out_rec)})
+    meta.update(num_records=meta['num_records'] + len(digests), next_id=state['next_id'],
+                rec_size=os.path.getsize(args.out_rec), md5_count=meta['md5_count'] + len(digests) * args.unique_md5,
+                category_counts={str(k): v for k, v in state['category_counter'].items()})
+    save_meta(args.out_rec, meta)
+    logging.info('complete. {} images appended, {} in total'.format(len(digests), meta['num_records']))
+
+
+def main(args):
+    if args.append:
+        if not os.path.exists(args.out_rec):
+            raise FileNotFoundError(args.out_rec)
+        append(args)
+    else:
+        if os.path.exists(args.out_rec):
+            raise FileExistsError(args.out_rec)
+        create(args)
 
 
 if __name__ == '__main__':
@@ -114,12 +308,14 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--bson', type=str, required=True)
     parser.add_argument('--out-rec', type=str, required=True)
+    parser.add_argument('--append', action='store_true',
+                        help='add the images of --bson to the existing --out-rec, with the options it was created with')
     parser.add_argument('--md5-dict-pkl', type=str, default=None)
     parser.add_argument('--cate-type', type=int, default=3)
     parser.add_argument('--shuffle-size', type=int, default=99999999)
     parser.add_argument('--random-seed', type=int, default=0xC0FFEE)
     parser.add_argument('--unique-md5', action='store_true')
-    parser.add_argument('--under-sampling', type=int, default=99999999)
+    parser.add_argument('--under-sampling', type=int, default=UNLIMITED)
 
     parser.add_argument('--num-procs', type=int, default=1)
     parser.add_argument('--zmq-port', type=int, default=18300)
@@ -10,6 +10,7 @@ refined image count: 7658701
 import hashlib
 import io
 import os
+import json
 from operator import itemgetter
 import pickle
 
@@ -27,11 +28,11 @@ def save_image(path, imgid, data):
     return img_path
 
 
-def main(args):
-    data = bson.decode_file_iter(open(args.bson, 'rb'))
+def hash_bson(bson_path):
+    """{md5 hexdigest: Counter({category_id: images})} of the images of a bson"""
+    data = bson.decode_file_iter(open(bson_path, 'rb'))
 
     md5_dict = defaultdict(Counter)
-    category_counter = Counter()
     for i, d in tqdm(enumerate(data)):
         product_id = d.get('_id')
         category_id = d.get('category_id', None)  # This won't be in Test data
@@ -40,7 +41,45 @@ def main(args):
             picture = pic['picture']
             h = hashlib.md5(picture).hexdigest()
             md5_dict[h][category_id] += 1
-            category_counter[category_id] += 1
+    return md5_dict
+
+
+def merge(md5_dict, other):
+    """add the counts of other to md5_dict"""
+    for h, v in other.items():
+        md5_dict.setdefault(h, Counter()).update(v)
+    return md5_dict
+
+
+def load_md5_dict(md5_dict_pkl):
+    with open(md5_dict_pkl, 'rb') as reader:
+        return pickle.load(reader)
+
+
+def save_md5_dict(md5_dict, md5_dict_pkl):
+    with open(md5_dict_pkl + '.tmp', 'wb') as writer:
+        pickle.dump(md5_dict, writer)
+    os.replace(md5_dict_pkl + '.tmp', md5_dict_pkl)
+
+
+def sources_path(md5_dict_pkl):
+    """the inputs counted in a table: [{'bson': path} or {'md5_dict_pkl': path}, ...]"""
+    return md5_dict_pkl + '.sources.json'
+
+
+def load_sources(md5_dict_pkl):
+    if not os.path.exists(sources_path(md5_dict_pkl)):
+        return [{'md5_dict_pkl': os.path.abspath(md5_dict_pkl)}]  # a table built before the sources were kept
+    with open(sources_path(md5_dict_pkl), 'r') as reader:
+        return json.load(reader)
+
+
+def summarize(md5_dict):
+    """relabel the conflicting hashes by the most common label (ties to the most common category),
+    print the images by label and the statistics"""
+    category_counter = Counter()
+    for v in md5_dict.values():
+        category_counter.update(v)
 
     image_count, label_conflict = 0, 0
     relabel_dict = dict()
@@ -65,20 +104,62 @@ def main(args):
     for i, (k, v) in enumerate(relabel_counter):
         print(i, k, v)
 
-    with open(args.md5_dict_pkl, 'wb') as writer:
-        pickle.dump(md5_dict, writer)
-
     print('total image count: {}'.format(image_count))
     print('unique image count: {}'.format(len(md5_dict)))
     print('label conflict count: {}'.format(label_conflict))
     print('refined image count: {}'.format(len(refined)))
 
 
+def _source_key(source):
+    return source.get('bson') or source.get('md5_dict_pkl')
+
+
+def main(args):
+    md5_dict, sources = defaultdict(Counter), []
+    if args.update:
+        md5_dict = load_md5_dict(args.md5_dict_pkl)
+        sources = load_sources(args.md5_dict_pkl)
+        print('loaded {} hashes from {}'.format(len(md5_dict), args.md5_dict_pkl))
+
+    paths = [os.path.abspath(x) for x in args.merge + ([args.bson] if args.bson else [])]
+    counted = sorted(set(paths) & set(_source_key(x) for x in sources))
+    if counted and not args.force:
+        raise ValueError('already counted in {}: {}, --force to add them again'.format(args.md5_dict_pkl, counted))
+
+    for path in args.merge:  # partial tables built elsewhere
+        other = load_md5_dict(path)
+        merge(md5_dict, other)
+        source = {'md5_dict_pkl': os.path.abspath(path)}
+        if os.path.exists(sources_path(path)):
+            source['sources'] = load_sources(path)
+        sources.append(source)
+        print('merged {} hashes from {}'.format(len(other), path))
+    if args.bson:
+        other = hash_bson(args.bson)
+        merge(md5_dict, other)
+        sources.append({'bson': os.path.abspath(args.bson)})
+        print('added {} hashes from {}'.format(len(other), args.bson))
+
+    save_md5_dict(md5_dict, args.md5_dict_pkl)
+    with open(sources_path(args.md5_dict_pkl), 'w') as writer:
+        json.dump(sources, writer, indent=2)
+    summarize(md5_dict)
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('--bson', type=str, required=True)
+    parser.add_argument('--bson', type=str, default='', help='bson to hash')
     parser.add_argument('--md5-dict-pkl', type=str, required=True)
+    parser.add_argument('--update', action='store_true',
+                        help='add to the existing --md5-dict-pkl instead of replacing it, e.g. with a bson of new products')
+    parser.add_argument('--merge', type=str, nargs='*', default=[], help='partial tables to add, e.g. built elsewhere')
+    parser.add_argument('--force', action='store_true', help='add a bson or a table again, its images are counted twice')
     args = parser.parse_args()
 
+    if not args.bson and not args.merge:
+        parser.error('--bson or --merge is required')
+    if args.update and not os.path.exists(args.md5_dict_pkl):
+        parser.error('--update requires an existing --md5-dict-pkl')
+
     main(args)
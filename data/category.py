@@ -6,6 +6,8 @@ import logging
 import coloredlogs
 coloredlogs.install(level=logging.INFO)
 
+import numpy as np
+
 
 def get_category_dict():
     category_names_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'category_names.csv')
@@ -73,6 +75,73 @@ def get_category_dict():
     return cate1_dict, cate2_dict, cate3_dict
 
 
+class CategoryArrays(object):
+    """
+    category mappings as arrays indexed by cate3 class id, for batched conversions of labels:
+
+        cate_ids   cate_id of each cate3 class
+        cate1      cate1 class id
+        cate2      cate2 class id
+        cate1_sub  class id within its cate1 (labels of cate level 1)
+    """
+    def __init__(self, cate_ids, cate1, cate2, cate1_sub):
+        self.cate_ids = cate_ids
+        self.cate1 = cate1
+        self.cate2 = cate2
+        self.cate1_sub = cate1_sub
+        self._order = np.argsort(cate_ids)
+        self._sorted_cate_ids = cate_ids[self._order]
+
+    def to_cate3(self, cate_ids):
+        """cate3 class ids of cate_ids, -1 for unknown cate_ids"""
+        cate_ids = np.asarray(cate_ids, dtype=np.int64)
+        index = np.searchsorted(self._sorted_cate_ids, cate_ids).clip(0, len(self._sorted_cate_ids) - 1)
+        found = self._sorted_cate_ids[index] == cate_ids
+        return np.where(found, self._order[index], -1)
+
+    def to_class(self, cate_ids, cate_level=3):
+        """class ids of cate_ids for the cate level (3 or 1), -1 for unknown cate_ids"""
+        cate3 = self.to_cate3(cate_ids)
+        if cate_level == 3:
+            return cate3
+        elif cate_level == 1:
+            return np.where(cate3 >= 0, self.cate1_sub[cate3], -1)
+        raise ValueError('invalid cate level: {}'.format(cate_level))
+
+
+_category_arrays = None
+
+
+def get_category_arrays():
+    """CategoryArrays of category_names.csv, loaded once per process and cached as .npz in ~/.cache/kaggle-cdiscount"""
+    global _category_arrays
+    if _category_arrays is not None:
+        return _category_arrays
+
+    category_names_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'category_names.csv')
+    cache_path = os.path.join(os.path.expanduser('~/.cache/kaggle-cdiscount'), 'category_names.npz')
+    names = ('cate_ids', 'cate1', 'cate2', 'cate1_sub')
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(category_names_path):
+        with np.load(cache_path) as data:
+            arrays = [data[k] for k in names]
+    else:
+        _, _, cate3_dict = get_category_dict()
+        values = [cate3_dict[i] for i in range(len(cate3_dict) // 3)]
+        arrays = [np.array([v[k] for v in values], dtype=np.int64)
+                  for k in ('cate_id', 'cate1_class_id', 'cate2_class_id', 'cate1_sub_class_id')]
+        try:  # renamed into place, so that another process never loads a partial file
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+            with open(tmp_path, 'wb') as writer:
+                np.savez(writer, **dict(zip(names, arrays)))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logging.warning('cannot save category cache: {}'.format(e))
+
+    _category_arrays = CategoryArrays(*arrays)
+    return _category_arrays
+
+
 def __category_csv_to_dict(category_csv):
     logging.error('deprecated')
     cate2cid, cid2cate, cate2name = dict(), dict(), dict()
@@ -0,0 +1,9 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+python3 -u phash_index.py \
+    --bson          ${ROOT}/data/train_split_train.bson \
+    --index         ${ROOT}/data/train_split_train_phash_index.npz \
+    --query-bson    ${ROOT}/data/train_split_val.bson \
+    --num-procs     24
@@ -0,0 +1,8 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+python3 -u product_index.py \
+    --bson          ${ROOT}/data/train.bson \
+    --index         ${ROOT}/data/train_product_index.npz \
+    --num-procs     24
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+Near-duplicate index of images by a 64-bit perceptual hash (dHash).
+
+Re-encoded, rescaled or slightly edited copies of an image have different md5 digests
+but dHashes within a small Hamming distance. The index is stored like product_index.py,
+one row for each (hash, category_id) sorted by hash:
+
+    hashes    uint64  dHash
+    cate_ids  int64   category_id
+    counts    int32   number of training images with this hash and category
+
+Searching within a radius uses multi-index hashing: the hash is split into 4 chunks of 16 bits,
+and a hash within distance r of the query has at least one chunk within distance r // 4 of the
+query's chunk (pigeonhole), so only the rows of these buckets are compared.
+"""
+
+import sys
+import os
+import time
+import logging
+from collections import Counter
+from itertools import combinations
+from multiprocessing import Pool
+import coloredlogs
+coloredlogs.install(level=logging.INFO)
+
+import numpy as np
+import cv2
+import bson
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data import utils
+
+NUM_CHUNKS = 4
+CHUNK_BITS = 16
+_POPCOUNT = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+
+
+def image_dhash(img_bytes):
+    """64-bit difference hash of a jpeg: signs of the horizontal gradients of the 9x8 grayscale thumbnail"""
+    img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+    return int(np.packbits(small[:, 1:] > small[:, :-1]).view('>u8')[0])
+
+
+def popcount(x):
+    """number of bits set in each uint64"""
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return _POPCOUNT[x.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+
+def _hash_range(job):
+    bson_path, offset, count = job
+    hashes, cate_ids = [], []
+    for _, raw in utils.iter_bson_raw(bson_path, offset, count):
+        d = bson.BSON(raw).decode()
+        for pic in d['imgs']:
+            hashes.append(image_dhash(pic['picture']))
+            cate_ids.append(d.get('category_id', -1))
+    return np.array(hashes, dtype=np.uint64), np.array(cate_ids, dtype=np.int64)
+
+
+def build_index(bson_path, num_procs=1, chunk_size=10000):
+    offsets = utils.get_bson_offsets(bson_path)
+    jobs = [(bson_path, int(offsets[i]), min(chunk_size, len(offsets) - i)) for i in range(0, len(offsets), chunk_size)]
+    logging.info('hash the images of {} products in {} with {} processes'.format(len(offsets), bson_path, num_procs))
+    with Pool(num_procs) as pool:
+        results = list(tqdm(pool.imap(_hash_range, jobs), total=len(jobs), unit='chunks'))
+    if not results:
+        return {'hashes': np.zeros(0, np.uint64), 'cate_ids': np.zeros(0, np.int64), 'counts': np.zeros(0, np.int32)}
+    hashes, cate_ids = (np.concatenate(x) for x in zip(*results))
+
+    order = np.lexsort((cate_ids, hashes))
+    hashes, cate_ids = hashes[order], cate_ids[order]
+    first = np.ones(len(hashes), dtype=bool)
+    first[1:] = (hashes[1:] != hashes[:-1]) | (cate_ids[1:] != cate_ids[:-1])
+    starts = np.nonzero(first)[0]
+    counts = np.diff(np.append(starts, len(hashes))).astype(np.int32)
+    return {'hashes': hashes[starts], 'cate_ids': cate_ids[starts], 'counts': counts}
+
+
+def save_index(index, index_path):
+    with open(index_path, 'wb') as writer:
+        np.savez(writer, **{k: index[k] for k in ('hashes', 'cate_ids', 'counts')})
+    logging.info('saved {} rows to {}'.format(len(index['hashes']), index_path))
+
+
+def _chunks(hashes, j):
+    return ((hashes >> np.uint64(j * CHUNK_BITS)) & np.uint64((1 << CHUNK_BITS) - 1)).astype(np.int64)
+
+
+def load_index(index_path):
+    """the rows, with the buckets of each chunk: rows sorted by the chunk (order_j) and bucket boundaries (starts_j)"""
+    with np.load(index_path) as data:
+        index = {k: data[k] for k in ('hashes', 'cate_ids', 'counts')}
+    for j in range(NUM_CHUNKS):
+        chunks = _chunks(index['hashes'], j)
+        index['order_{}'.format(j)] = np.argsort(chunks, kind='mergesort').astype(np.int32)
+        index['starts_{}'.format(j)] = np.searchsorted(chunks[index['order_{}'.format(j)]],
+                                                        np.arange((1 << CHUNK_BITS) + 1))
+    logging.info('loaded {} rows from {}'.format(len(index['hashes']), index_path))
+    return index
+
+
+def _probe_masks(distance):
+    """chunk masks with at most `distance` bits set"""
+    masks = [0]
+    for d in range(1, distance + 1):
+        masks.extend(sum(1 << b for b in bits) for bits in combinations(range(CHUNK_BITS), d))
+    return np.array(masks, dtype=np.int64)
+
+
+def search(index, queries, radius):
+    """(query indices, rows, distances) of all rows within the radius of the queries"""
+    queries = np.asarray(queries, dtype=np.uint64)
+    masks = _probe_masks(radius // NUM_CHUNKS)
+    query_ids, rows = [], []
+    for j in range(NUM_CHUNKS):
+        probes = _chunks(queries, j)[:, None] ^ masks[None, :]
+        begins = index['starts_{}'.format(j)][probes].ravel()
+        lengths = index['starts_{}'.format(j)][probes + 1].ravel() - begins
+        total = lengths.sum()
+        if total == 0:
+            continue
+        # positions begins[k] .. begins[k] + lengths[k] - 1 of every probe k, without a python loop
+        offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        rows.append(index['order_{}'.format(j)][np.repeat(begins, lengths) + offsets])
+        query_ids.append(np.repeat(np.arange(len(queries)), len(masks))[np.repeat(np.arange(len(lengths)), lengths)])
+    if not rows:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+    # a row found through several chunks is counted once
+    pairs = np.unique(np.concatenate(query_ids).astype(np.int64) * len(index['hashes']) + np.concatenate(rows))
+    query_ids, rows = pairs // len(index['hashes']), pairs % len(index['hashes'])
+    distances = popcount(index['hashes'][rows] ^ queries[query_ids])
+    hit = distances <= radius
+    return query_ids[hit], rows[hit], distances[hit]
+
+
+def nearest_labels(index, queries, radius):
+    """for each query, Counter({category_id: training images}) of the nearest rows within the radius
+    (empty if none) and their distance (-1 if none)"""
+    labels = [Counter() for _ in queries]
+    nearest = np.full(len(queries), -1, dtype=np.int64)
+    query_ids, rows, distances = search(index, queries, radius)
+    for q, row, distance in zip(query_ids.tolist(), rows.tolist(), distances.tolist()):
+        if nearest[q] < 0 or distance < nearest[q]:
+            nearest[q] = distance
+            labels[q].clear()
+        if distance == nearest[q]:
+            labels[q][int(index['cate_ids'][row])] += int(index['counts'][row])
+    return labels, nearest
+
+
+def benchmark(index, bson_path, radii, batch_size=256, count=None):
+    """hit rate, accuracy of the hits with a single label and lookup latency of the images of a labelled bson"""
+    hashes, cate_ids = _hash_range((bson_path, 0, count))
+    logging.info('{} query images from {}'.format(len(hashes), bson_path))
+    print('radius\thit rate\tunique hits\tunique acc\tus/query (batch {})\tus/query (brute force)'.format(batch_size))
+    for radius in radii:
+        t0 = time.time()
+        hits, unique, correct = 0, 0, 0
+        for i in range(0, len(hashes), batch_size):
+            labels, _ = nearest_labels(index, hashes[i:i + batch_size], radius)
+            for label, cate_id in zip(labels, cate_ids[i:i + batch_size]):
+                hits += bool(label)
+                if len(label) == 1:
+                    unique += 1
+                    correct += next(iter(label)) == cate_id
+        elapsed = time.time() - t0
+
+        t0 = time.time()
+        brute = hashes[:min(len(hashes), 100)]
+        for query in brute:
+            np.nonzero(popcount(index['hashes'] ^ query) <= radius)
+        brute_elapsed = (time.time() - t0) / max(1, len(brute))
+        print('{}\t{:.4f}\t{:.4f}\t{:.4f}\t{:.1f}\t{:.1f}'.format(
+            radius, hits / max(1, len(hashes)), unique / max(1, len(hashes)), correct / max(1, unique),
+            elapsed / max(1, len(hashes)) * 1e6, brute_elapsed * 1e6))
+
+
+def main(args):
+    if args.bson:
+        save_index(build_index(args.bson, args.num_procs), args.index)
+    if args.query_bson:
+        benchmark(load_index(args.index), args.query_bson, args.radius, args.batch_size, args.cut or None)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bson', type=str, default='', help='training bson to build the index from')
+    parser.add_argument('--index', type=str, required=True, help='.npz path to save (or to load with --query-bson)')
+    parser.add_argument('--num-procs', type=int, default=8)
+    parser.add_argument('--query-bson', type=str, default='',
+                        help='benchmark the index with the images of a labelled bson, e.g. the validation split')
+    parser.add_argument('--radius', type=int, nargs='+', default=[0, 2, 4, 6, 8])
+    parser.add_argument('--batch-size', type=int, default=256, help='queries searched at once')
+    parser.add_argument('--cut', type=int, default=0, help='products of --query-bson')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+Index of products by the set of their images.
+
+The md5 digests of the (unique) images of a product are combined into one 64-bit signature,
+and the index is stored as arrays sorted by (signature, category_id) with the number of products:
+
+    keys      uint64  signature
+    cate_ids  int64   category_id
+    counts    int32   number of training products with this signature and category
+"""
+
+import sys
+import os
+import hashlib
+import logging
+from multiprocessing import Pool
+import coloredlogs
+coloredlogs.install(level=logging.INFO)
+
+import numpy as np
+import bson
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data import utils
+
+
+def product_signature(digests):
+    """64-bit signature of a set of md5 digests (bytes), independent of their order and duplicates"""
+    return int.from_bytes(hashlib.md5(b''.join(sorted(set(digests)))).digest()[:8], 'little')
+
+
+def _hash_range(job):
+    bson_path, offset, count = job
+    product_ids, keys, cate_ids = [], [], []
+    for _, raw in utils.iter_bson_raw(bson_path, offset, count):
+        d = bson.BSON(raw).decode()
+        product_ids.append(d['_id'])
+        keys.append(product_signature(hashlib.md5(pic['picture']).digest() for pic in d['imgs']))
+        cate_ids.append(d.get('category_id', -1))
+    return (np.array(product_ids, dtype=np.int64), np.array(keys, dtype=np.uint64),
+            np.array(cate_ids, dtype=np.int64))
+
+
+def hash_products(bson_path, num_procs=1, chunk_size=10000):
+    """(product_ids, signatures, category_ids) of all products in a bson file, in file order"""
+    offsets = utils.get_bson_offsets(bson_path)
+    jobs = [(bson_path, int(offsets[i]), min(chunk_size, len(offsets) - i)) for i in range(0, len(offsets), chunk_size)]
+    logging.info('hash {} products in {} with {} processes'.format(len(offsets), bson_path, num_procs))
+
+    with Pool(num_procs) as pool:
+        results = list(tqdm(pool.imap(_hash_range, jobs), total=len(jobs), unit='chunks'))
+    if not results:
+        return np.zeros(0, np.int64), np.zeros(0, np.uint64), np.zeros(0, np.int64)
+    return tuple(np.concatenate(x) for x in zip(*results))
+
+
+def build_index(bson_path, num_procs=1):
+    _, keys, cate_ids = hash_products(bson_path, num_procs)
+    order = np.lexsort((cate_ids, keys))
+    keys, cate_ids = keys[order], cate_ids[order]
+
+    # one row for each (signature, category_id)
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = (keys[1:] != keys[:-1]) | (cate_ids[1:] != cate_ids[:-1])
+    starts = np.nonzero(first)[0]
+    counts = np.diff(np.append(starts, len(keys))).astype(np.int32)
+    return {'keys': keys[starts], 'cate_ids': cate_ids[starts], 'counts': counts}
+
+
+def save_index(index, index_path):
+    with open(index_path, 'wb') as writer:
+        np.savez(writer, **index)
+    logging.info('saved {} rows to {}'.format(len(index['keys']), index_path))
+
+
+def load_index(index_path):
+    with np.load(index_path) as data:
+        index = {k: data[k] for k in ('keys', 'cate_ids', 'counts')}
+    logging.info('loaded {} rows from {}'.format(len(index['keys']), index_path))
+    return index
+
+
+def lookup(index, keys):
+    """category_id of each signature if all training products with it have one label (-1 otherwise),
+    and the number of labels of the signature"""
+    keys = np.asarray(keys, dtype=np.uint64)
+    if len(index['keys']) == 0:
+        return np.full(len(keys), -1, dtype=np.int64), np.zeros(len(keys), dtype=np.int64)
+    left = np.searchsorted(index['keys'], keys, side='left')
+    right = np.searchsorted(index['keys'], keys, side='right')
+    num_labels = right - left
+    cate_ids = np.where(num_labels == 1, index['cate_ids'][np.minimum(left, len(index['keys']) - 1)], -1)
+    return cate_ids, num_labels
+
+
+def main(args):
+    index = build_index(args.bson, args.num_procs)
+    save_index(index, args.index)
+
+    keys = index['keys']
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    num_labels = np.diff(np.append(np.nonzero(first)[0], len(keys)))
+    print('total product count: {}'.format(index['counts'].sum()))
+    print('unique product count: {}'.format(len(num_labels)))
+    print('label conflict count: {}'.format((num_labels > 1).sum()))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bson', type=str, required=True)
+    parser.add_argument('--index', type=str, required=True, help='.npz path to save')
+    parser.add_argument('--num-procs', type=int, default=8)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,9 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+# add the images of new products to the table of create_train_md5_dict.sh, without hashing train.bson again
+python3 -u bson_md5_dict.py \
+    --bson        ${ROOT}/data/train_new.bson \
+    --md5-dict-pkl      ${ROOT}/data/train_md5_dict.pkl \
+    --update
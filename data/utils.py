@@ -1,5 +1,6 @@
 
 import os
+import struct
 import logging
 
 from tqdm import tqdm
@@ -27,3 +28,74 @@ def encode_dict_list(products, output_bson_path, total=None, overwrite=False):
             obj = bson._dict_to_bson(prod, False, bson.DEFAULT_CODEC_OPTIONS)
             writer.write(obj)
 
+
+
+def get_bson_offsets(bson_path):
+    """offsets of all documents, read from the length prefixes only"""
+    offsets = []
+    with open(bson_path, 'rb') as reader:
+        size = os.fstat(reader.fileno()).st_size
+        offset = 0
+        while offset < size:
+            offsets.append(offset)
+            reader.seek(offset)
+            offset += struct.unpack('<i', reader.read(4))[0]
+    return offsets
+
+
+def iter_bson_raw(bson_path, offset=0, count=None):
+    """yield (offset, raw bytes) of each document using the length prefixes, without decoding"""
+    with open(bson_path, 'rb') as reader:
+        reader.seek(offset)
+        n = 0
+        while count is None or n < count:
+            head = reader.read(4)
+            if len(head) < 4:
+                break
+            size = struct.unpack('<i', head)[0]
+            raw = head + reader.read(size - 4)
+            if len(raw) < size:
+                raise EOFError('truncated bson document at {} in {}'.format(offset, bson_path))
+            yield offset, raw
+            offset += size
+            n += 1
+
+
+# type: (struct format or None, size) of the top-level bson values decode_fields can skip over
+_BSON_SCALARS = {
+    0x01: ('<d', 8),     # double
+    0x07: (None, 12),    # ObjectId
+    0x08: ('<?', 1),     # bool
+    0x09: ('<q', 8),     # datetime
+    0x0A: (None, 0),     # null
+    0x10: ('<i', 4),     # int32
+    0x11: ('<Q', 8),     # timestamp
+    0x12: ('<q', 8),     # int64
+    0x13: (None, 16),    # decimal128
+}
+
+
+def decode_fields(raw, names=('_id', 'category_id')):
+    """decode only the scalar top-level fields in `names`, skipping over e.g. the image bytes"""
+    result = dict.fromkeys(names)
+    pos, end = 4, len(raw) - 1
+    while pos < end:
+        tp = raw[pos]
+        name_end = raw.index(b'\x00', pos + 1)
+        name = raw[pos + 1:name_end].decode('utf-8')
+        pos = name_end + 1
+        if tp in _BSON_SCALARS:
+            fmt, size = _BSON_SCALARS[tp]
+            if name in result and fmt is not None:
+                result[name] = struct.unpack_from(fmt, raw, pos)[0]
+        elif tp == 0x02:  # string
+            size = 4 + struct.unpack_from('<i', raw, pos)[0]
+        elif tp in (0x03, 0x04):  # document, array
+            size = struct.unpack_from('<i', raw, pos)[0]
+        elif tp == 0x05:  # binary
+            size = 5 + struct.unpack_from('<i', raw, pos)[0]
+        else:
+            doc = bson.BSON(raw).decode()
+            return {k: doc.get(k) for k in names}
+        pos += size
+    return result
@@ -2,63 +2,87 @@
 
 import sys
 import os
-import csv
-from collections import defaultdict, Counter
 
 import bson
+import numpy as np
 from tqdm import tqdm
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from data.category import get_category_dict
+from data.category import get_category_dict, get_category_arrays
+from data import utils
+
+
+def _lookup(sorted_keys, keys):
+    """index of each key in sorted_keys, -1 if not found"""
+    index = np.searchsorted(sorted_keys, keys).clip(0, max(len(sorted_keys) - 1, 0))
+    found = sorted_keys[index] == keys if len(sorted_keys) else np.zeros(len(keys), dtype=bool)
+    return np.where(found, index, -1)
+
+
+def load_predictions(predict_csv):
+    data = np.loadtxt(predict_csv, delimiter=',', skiprows=1, dtype=np.int64, ndmin=2)
+    order = np.argsort(data[:, 0], kind='mergesort')
+    return data[order, 0], data[order, 1]
 
 
 def main(args):
-    cate1_dict, cate2_dict, cate3_dict = get_category_dict()
-
-    products = dict()
-    with open(args.bson_path, 'rb') as reader:
-        data = bson.decode_file_iter(reader)
-        for c, d in tqdm(enumerate(data), unit='products'):
-            product_id = d.get('_id')
-            category_id = d.get('category_id', None)  # This won't be in Test data
-            products[product_id] = {
-                'product_id': product_id,
-                'category_id': category_id,
-                'images': [pic.get('picture') for e, pic in enumerate(d['imgs'])],
-            }
-
-    cate1_total_counter, cate1_correct_counter = Counter(), Counter()
-    with open(args.predict_csv, 'r') as reader:
-        csvreader = csv.reader(reader, delimiter=',', quotechar='"')
-        save_count = 0
-        for i, row in enumerate(csvreader):
-            if i == 0:  # ignore header line
-                continue
-            prod_id, cate_id = (int(x) for x in row)
-            cate_answer = products[prod_id]['category_id']
-            cate1, cate2, cate3 = cate3_dict[cate_answer]['names']
-            cate1_total_counter[cate1] += 1
-            if cate_answer == cate_id:  # correct
-                cate1_correct_counter[cate1] += 1
-            else:  # incorrect
-                if args.save_incorrect and save_count < args.save_cut:
-                    save_count += 1
-                    save_dir = os.path.join(args.save_incorrect, '%03d' % cate1_dict[(cate1,)]['cate1_class_id'])
-                    if not os.path.exists(save_dir):
-                        os.makedirs(save_dir)
-                    save_path = os.path.join(save_dir, '%d.png' % prod_id)
-
-                    with open(save_path, 'wb') as writer:
-                        writer.write(products[prod_id]['images'][0])
-
-    print('Accuracy: {:.6f}'.format(sum(cate1_correct_counter.values())/sum(cate1_total_counter.values())))
-    for cate1 in cate1_total_counter:
-        cate1_accuracy = cate1_correct_counter[cate1] / cate1_total_counter[cate1]
-        print('{:8d}\t{:8d}\t{:8d}\t{:.6f}\t[{:02d}] {}'.format(cate1_total_counter[cate1],
-                                                                cate1_correct_counter[cate1],
-                                                                cate1_total_counter[cate1] - cate1_correct_counter[cate1],
-                                                                cate1_accuracy,
-                                                                cate1_dict[(cate1,)]['cate1_class_id'], cate1))
+    cate1_dict, _, _ = get_category_dict()
+    cates = get_category_arrays()
+
+    pred_ids, pred_cates = load_predictions(args.predict_csv)
+
+    # a single pass over the bson: only the labels are decoded,
+    # images are decoded only for incorrect products that are saved
+    product_ids, answers = [], []
+    save_count = 0
+    for offset, raw in tqdm(utils.iter_bson_raw(args.bson_path), unit='products'):
+        fields = utils.decode_fields(raw)
+        product_id, category_id = fields['_id'], fields['category_id']
+        product_ids.append(product_id)
+        answers.append(category_id if category_id is not None else -1)
+
+        if args.save_incorrect and save_count < args.save_cut:
+            i = _lookup(pred_ids, np.array([product_id]))[0]
+            if i >= 0 and pred_cates[i] != category_id:
+                save_count += 1
+                save_dir = os.path.join(args.save_incorrect, '%03d' % cates.cate1[cates.to_cate3(category_id)])
+                if not os.path.exists(save_dir):
+                    os.makedirs(save_dir)
+                save_path = os.path.join(save_dir, '%d.png' % product_id)
+
+                with open(save_path, 'wb') as writer:
+                    writer.write(bson.BSON(raw).decode()['imgs'][0]['picture'])
+
+    product_ids = np.array(product_ids, dtype=np.int64)
+    answers = np.array(answers, dtype=np.int64)
+
+    # join predictions with answers
+    index = _lookup(pred_ids, product_ids)
+    matched = index >= 0
+    print('products: {}, predictions: {}, matched: {}'.format(len(product_ids), len(pred_ids), matched.sum()))
+    answers, preds = answers[matched], pred_cates[index[matched]]
+
+    answer_index, pred_index = cates.to_cate3(answers), cates.to_cate3(preds)
+    assert (answer_index >= 0).all(), 'unknown category in {}'.format(args.bson_path)
+    valid = pred_index >= 0  # e.g. outputs of --cate-level 1 are not cate_ids
+    correct3 = answers == preds
+    correct2 = valid & (cates.cate2[answer_index] == cates.cate2[pred_index])
+    correct1 = valid & (cates.cate1[answer_index] == cates.cate1[pred_index])
+
+    print('Accuracy: {:.6f}'.format(correct3.mean()))
+    print('Accuracy (cate1): {:.6f}'.format(correct1.mean()))
+    print('Accuracy (cate2): {:.6f}'.format(correct2.mean()))
+
+    answer_cate1 = cates.cate1[answer_index]
+    cate1_total_counter = np.bincount(answer_cate1, minlength=len(cate1_dict) // 2)
+    cate1_correct_counter = np.bincount(answer_cate1[correct3], minlength=len(cate1_dict) // 2)
+    for cate1_class_id in np.nonzero(cate1_total_counter)[0]:
+        total, correct = int(cate1_total_counter[cate1_class_id]), int(cate1_correct_counter[cate1_class_id])
+        print('{:8d}\t{:8d}\t{:8d}\t{:.6f}\t[{:02d}] {}'.format(total,
+                                                                correct,
+                                                                total - correct,
+                                                                correct / total,
+                                                                cate1_class_id, cate1_dict[int(cate1_class_id)]['names'][0]))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tune the pipeline options of predict.py on a host: --batch-size, --num-procs, --processor-hwm, --reader-hwm
+(only with --product-index, the products found in the index are the only ones it queues) and --multi-view
+(which changes the predictions, only if several values are given).
+
+Every trial runs predict.py on the first --cut products with --metrics-output, and its steady-state
+throughput is read from the snapshots of the predictor: source images per second after --warmup seconds
+of forwarding (loading the models is not counted). The options are searched one at a time
+(coordinate descent) until a round improves nothing, and the best values are written to a json
+that predict.py loads with --config.
+
+    python autotune.py --output host.json --batch-size 16 32 64 --num-procs 2 4 8 -- \\
+        --bson ... --csv ... --symbol ... --params ... --device-type cpu
+"""
+
+import sys
+import os
+import json
+import time
+import tempfile
+import subprocess
+import logging
+import coloredlogs
+coloredlogs.install(level=logging.INFO, milliseconds=True)
+
+PREDICT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'predict.py')
+OPTIONS = ('batch_size', 'num_procs', 'reader_hwm', 'processor_hwm', 'multi_view')
+RESERVED = ('--cut', '--metrics-output', '--metrics-interval', '--config', '--resume')
+
+
+def _flag(name):
+    return '--' + name.replace('_', '-')
+
+
+def _views(multi_view):
+    """views forwarded for each image, see decode_images"""
+    return min(max(multi_view, -1), 3) + 1
+
+
+def steady_rate(metrics_path, warmup, views=1):
+    """source images per second of the predictor after `warmup` seconds of forwarding, 0 if too short"""
+    points = []
+    with open(metrics_path, 'r') as reader:
+        for line in reader:
+            snapshot = json.loads(line)
+            if snapshot['stage'] == 'predictor':
+                points.append((snapshot['time'], snapshot['counters'].get('images_forwarded', 0)))
+    started = [x for x in points if x[1] > 0]
+    if not started:
+        logging.warning('no image forwarded in {}'.format(metrics_path))
+        return 0.0
+    steady = [x for x in started if x[0] >= started[0][0] + warmup] or started
+    (t0, n0), (t1, n1) = steady[0], points[-1]
+    if t1 <= t0:
+        logging.warning('{}: the trial is too short for --warmup {} and --metrics-interval, use a larger --cut'.format(
+            metrics_path, warmup))
+        return 0.0
+    return (n1 - n0) / (t1 - t0) / views
+
+
+def run_trial(args, config, workdir, index):
+    """(steady images/s, seconds) of predict.py with the options of config"""
+    metrics_path = os.path.join(workdir, 'trial-{}.jsonl'.format(index))
+    command = [sys.executable, PREDICT] + args.predict_args + [
+        '--cut', str(args.cut), '--metrics-output', metrics_path, '--metrics-interval', str(args.metrics_interval)]
+    for name, value in sorted(config.items()):
+        command += [_flag(name), str(value)]
+
+    t0 = time.time()
+    with open(os.path.join(workdir, 'trial-{}.log'.format(index)), 'w') as log:
+        try:
+            returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, timeout=args.timeout)
+        except subprocess.TimeoutExpired:
+            returncode = None
+    elapsed = time.time() - t0
+    if returncode != 0 or not os.path.exists(metrics_path):
+        logging.warning('trial {} failed ({}), see {}'.format(
+            index, 'timeout' if returncode is None else 'exit code {}'.format(returncode), log.name))
+        return 0.0, elapsed
+    return steady_rate(metrics_path, args.warmup, _views(config.get('multi_view', 0))), elapsed
+
+
+def search(args, space, workdir):
+    """coordinate descent from the middle values, returns (best config, best images/s, all trials)"""
+    config = {name: values[len(values) // 2] for name, values in space.items()}
+    trials = dict()  # sorted config items -> images/s
+
+    def _evaluate(candidate):
+        key = tuple(sorted(candidate.items()))
+        if key not in trials:
+            rate, elapsed = run_trial(args, candidate, workdir, len(trials))
+            trials[key] = rate
+            logging.info('trial {:3d}: {:8.1f} images/s ({:.0f}s) {}'.format(
+                len(trials) - 1, rate, elapsed, ' '.join('{}={}'.format(k, v) for k, v in key)))
+        return trials[key]
+
+    best = _evaluate(config)
+    for round_index in range(args.max_rounds):
+        improved = False
+        for name, values in space.items():
+            for value in values:
+                candidate = dict(config, **{name: value})
+                rate = _evaluate(candidate)
+                if rate > best * (1 + args.min_gain):
+                    config, best, improved = candidate, rate, True
+        logging.info('round {}: {:.1f} images/s with {}'.format(round_index, best, config))
+        if not improved:
+            break
+    return config, best, trials
+
+
+def main(args):
+    space = {name: getattr(args, name) for name in OPTIONS if getattr(args, name)}
+    workdir = args.workdir or tempfile.mkdtemp(prefix='autotune-')
+    os.makedirs(workdir, exist_ok=True)
+    logging.info('trials on {} products, logs in {}'.format(args.cut, workdir))
+
+    config, best, trials = search(args, space, workdir)
+    if best <= 0:
+        logging.error('no trial was measured, see the warnings above and the logs in {}'.format(workdir))
+        sys.exit(1)
+
+    with open(args.output, 'w') as writer:
+        json.dump(config, writer, indent=2, sort_keys=True)
+    logging.info('best: {:.1f} images/s with {}, saved to {}'.format(best, config, args.output))
+    with open(os.path.splitext(args.output)[0] + '.trials.tsv', 'w') as writer:
+        writer.write('\t'.join(sorted(space)) + '\timages/s\n')
+        for key, rate in sorted(trials.items(), key=lambda x: -x[1]):
+            writer.write('\t'.join(str(v) for _, v in key) + '\t{:.1f}\n'.format(rate))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', type=str, required=True, help='json of the best options, for predict.py --config')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[16, 32, 64, 128])
+    parser.add_argument('--num-procs', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--reader-hwm', type=int, nargs='+', default=[0],
+                        help='values to try, 0 is --batch-size (the default of predict.py). '
+                             'tuned only with --product-index in the options of predict.py')
+    parser.add_argument('--processor-hwm', type=int, nargs='+', default=[0])
+    parser.add_argument('--multi-view', type=int, nargs='+', default=[],
+                        help='values to try, not tuned by default since it changes the predictions')
+    parser.add_argument('--cut', type=int, default=2000, help='products of each trial')
+    parser.add_argument('--warmup', type=float, default=5.0, help='seconds of forwarding not measured')
+    parser.add_argument('--metrics-interval', type=float, default=1.0, help='seconds between snapshots of a trial')
+    parser.add_argument('--timeout', type=float, default=600.0, help='seconds before a trial is abandoned')
+    parser.add_argument('--max-rounds', type=int, default=3)
+    parser.add_argument('--min-gain', type=float, default=0.02,
+                        help='relative improvement needed to move to another value, against noise')
+    parser.add_argument('--workdir', type=str, default='', help='where the logs and metrics of the trials are kept')
+    parser.add_argument('predict_args', nargs=argparse.REMAINDER,
+                        help='options of predict.py after --, without the tuned ones')
+    args = parser.parse_args()
+
+    if args.predict_args and args.predict_args[0] == '--':
+        args.predict_args = args.predict_args[1:]
+    if not args.predict_args:
+        parser.error('options of predict.py are required after --')
+    given = set(x.split('=')[0] for x in args.predict_args if x.startswith('--'))
+    if '--product-index' not in given:  # the reader queues only the products found in the index
+        if len(args.reader_hwm) > 1:
+            logging.warning('--reader-hwm is not tuned without --product-index')
+        args.reader_hwm = []
+    conflicts = sorted(given & (set(RESERVED) | set(_flag(x) for x in OPTIONS if getattr(args, x))))
+    if conflicts:
+        parser.error('set by the trials, remove from the options of predict.py: {}'.format(', '.join(conflicts)))
+    main(args)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""
+Checkpoints of predict.py runs.
+
+Products are written out of order (several processors, cascade queues), so a checkpoint keeps
+the watermark, the first product (in bson order) not yet written, with its byte offset in the bson,
+the products after the watermark that are already written, and the positions of the outputs.
+Resuming truncates the outputs to these positions, seeks the reader to the offset and skips
+the products already written, so no product is written twice or dropped.
+"""
+
+import os
+import json
+import time
+import logging
+
+
+class Checkpoint(object):
+    def __init__(self, offsets, seq_of, interval=60.0, state=None, start=0):
+        """
+        offsets: bson byte offset of each product in file order
+        seq_of: product_id -> its index in offsets
+        start: index of the first product to predict (of the shard)
+        """
+        self._offsets = offsets
+        self._seq_of = seq_of
+        self._interval = interval
+        self._last_save = time.time()
+        self.next_seq = state['seq'] if state else start
+        self.ahead = set(state['skip']) if state else set()
+
+    def done(self, product_id):
+        """mark a product as written to all outputs"""
+        seq = self._seq_of[product_id]
+        if seq < self.next_seq:
+            return
+        self.ahead.add(seq)
+        while self.next_seq in self.ahead:
+            self.ahead.remove(self.next_seq)
+            self.next_seq += 1
+
+    def due(self):
+        return time.time() - self._last_save >= self._interval
+
+    def state(self):
+        """the watermark to save with the output positions (see save_checkpoint)"""
+        self._last_save = time.time()
+        return {
+            'seq': self.next_seq,
+            'offset': self._offsets[self.next_seq] if self.next_seq < len(self._offsets) else None,
+            'skip': sorted(self.ahead),
+        }
+
+
+def save_checkpoint(path, state, outputs):
+    """save the state with the positions of the outputs, which must have been flushed"""
+    state = dict(state, outputs={k: v for output in outputs for k, v in output.positions().items()})
+    with open(path + '.tmp', 'w') as writer:
+        json.dump(state, writer)
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(path):
+    with open(path, 'r') as reader:
+        state = json.load(reader)
+    logging.info('checkpoint: {} products written, {} ahead (offset: {})'.format(
+        state['seq'], len(state['skip']), state['offset']))
+    return state
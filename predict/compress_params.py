@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Convert .params of ensemble members to the compressed format of train/common/params.py (float16 or int8),
+and compare them with the originals: disk size, startup (load and bind) time, the agreement of the top-1
+and the largest difference of the probabilities, and the accuracy on the images of a labelled bson.
+"""
+
+import sys
+import os
+import time
+import logging
+import coloredlogs
+coloredlogs.install(level=logging.INFO)
+
+import numpy as np
+import mxnet as mx
+import bson
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from train.common.params import save_compressed, FORMATS
+from data.category import get_category_arrays
+from data import utils
+from predict import Tester, decode_images
+
+
+def compressed_path(params_path, fmt):
+    """<name>-0015.params -> <name>-0015-<fmt>.cparams"""
+    base = params_path[:-len('.params')] if params_path.endswith('.params') else params_path
+    return '{}-{}.cparams'.format(base, fmt)
+
+
+def load_images(bson_path, data_shape, num_products, cate_level=3):
+    """(images, class labels) of the first products of a labelled bson"""
+    cates = get_category_arrays()
+    images, cate_ids = [], []
+    for _, raw in utils.iter_bson_raw(bson_path, count=num_products):
+        d = bson.BSON(raw).decode()
+        items = [(d['_id'], i, pic['picture']) for i, pic in enumerate(d['imgs'])]
+        for img, _, _, _ in decode_images(items, data_shape):
+            images.append(img)
+            cate_ids.append(d['category_id'])
+    return np.stack(images).astype(np.float32), cates.to_class(cate_ids, cate_level)
+
+
+def _probs(tester, images, batch_size):
+    probs = []
+    for i in range(0, len(images), batch_size):
+        batch = np.zeros((batch_size,) + images.shape[1:], dtype=np.float32)
+        batch[:len(images[i:i + batch_size])] = images[i:i + batch_size]
+        probs.append(tester.get_probs(batch)[:len(images[i:i + batch_size])])
+    return np.concatenate(probs)
+
+
+def compare(args, symbol_path, params_path, path, images, labels):
+    batch_shape = [args.batch_size] + list(images.shape[1:])
+    testers, startup = [], []
+    for p in (params_path, path):
+        t0 = time.time()
+        testers.append(Tester(symbol_path, p, batch_shape, device_type=args.device_type, gpus=args.gpus))
+        mx.nd.waitall()
+        startup.append(time.time() - t0)
+    original, compressed = (_probs(x, images, args.batch_size) for x in testers)
+
+    line = '{}: size {:.1f}MB -> {:.1f}MB, startup {:.2f}s -> {:.2f}s, same top-1: {:.4f}, max |prob difference|: {:.3g}'.format(
+        os.path.basename(path), os.path.getsize(params_path) / 2**20, os.path.getsize(path) / 2**20,
+        startup[0], startup[1], np.mean(original.argmax(axis=1) == compressed.argmax(axis=1)),
+        np.abs(original - compressed).max())
+    if labels is not None:
+        line += ', accuracy: {:.6f} -> {:.6f}'.format(np.mean(original.argmax(axis=1) == labels),
+                                                      np.mean(compressed.argmax(axis=1) == labels))
+    logging.info(line)
+
+
+def main(args):
+    data_shape = [int(x) for x in args.data_shape.split(',')]
+    images, labels = None, None
+    if args.symbol:
+        if args.bson:
+            images, labels = load_images(args.bson, data_shape, args.num_products, args.cate_level)
+            logging.info('{} images of {} products from {}'.format(len(images), args.num_products, args.bson))
+        else:
+            images = np.random.RandomState(0).uniform(0, 255, [args.batch_size * 4] + data_shape).astype(np.float32)
+
+    for i, params_path in enumerate(args.params):
+        path = compressed_path(params_path, args.format)
+        save_compressed(path, mx.nd.load(params_path), args.format)
+        logging.info('saved {}'.format(path))
+        if args.symbol:
+            compare(args, args.symbol[i], params_path, path, images, labels)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--params', type=str, nargs='+', required=True)
+    parser.add_argument('--symbol', type=str, nargs='*', default=[],
+                        help='symbols of --params, to compare the compressed params with the originals')
+    parser.add_argument('--format', type=str, default='float16', choices=FORMATS)
+    parser.add_argument('--bson', type=str, default='', help='labelled bson to compare the accuracy on')
+    parser.add_argument('--num-products', type=int, default=1000)
+    parser.add_argument('--cate-level', type=int, default=3)
+    parser.add_argument('--data-shape', type=str, default='3,180,180')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--device-type', type=str, default='gpu', choices=['gpu', 'cpu'])
+    parser.add_argument('--gpus', type=str, default='0')
+    args = parser.parse_args()
+
+    if args.symbol and len(args.symbol) != len(args.params):
+        parser.error('one --symbol for each --params')
+    main(args)
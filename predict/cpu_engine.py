@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""
+Multi-instance inference on CPU.
+
+A single MXNet process does not scale well on many-core machines: OpenMP threads of
+different operators fight for the same cores. ReplicaPool starts several replica processes,
+each pinned to its own set of cores with its own thread count, and splits every batch into
+micro-batches that are dispatched round-robin to the replicas.
+"""
+
+import sys
+import os
+import time
+import logging
+import functools
+import subprocess
+import coloredlogs
+coloredlogs.install(level=logging.DEBUG, milliseconds=True)
+
+import numpy as np
+import zmq
+
+
+def send_array(socket, array, **meta):
+    array = np.ascontiguousarray(array)
+    meta.update(dtype=str(array.dtype), shape=array.shape)
+    socket.send_pyobj(meta, flags=zmq.SNDMORE)
+    socket.send(array, copy=False)
+
+
+def recv_array(socket):
+    meta = socket.recv_pyobj()
+    if meta is None:
+        return None, None
+    frame = socket.recv(copy=False)
+    array = np.frombuffer(frame.buffer, dtype=meta.pop('dtype')).reshape(meta.pop('shape'))
+    return meta, array
+
+
+def get_core_sets(num_replicas, num_threads):
+    cores = sorted(os.sched_getaffinity(0))
+    if num_replicas * num_threads > len(cores):
+        logging.warning('{} replicas x {} threads > {} cores'.format(num_replicas, num_threads, len(cores)))
+    return [[cores[(i * num_threads + j) % len(cores)] for j in range(num_threads)] for i in range(num_replicas)]
+
+
+class ReplicaModel(object):
+    """looks like a Tester for _do_forward, but runs on the replicas of a ReplicaPool"""
+    def __init__(self, pool, model_id):
+        self._pool = pool
+        self._model_id = model_id
+
+    def get_probs(self, batch_data):
+        return self._pool.forward(self._model_id, batch_data)
+
+
+class ReplicaPool(object):
+    def __init__(self, symbols, params, batch_shape, num_replicas, num_threads, zmq_port, symbol_cache_dir=''):
+        self._num_replicas = num_replicas
+        self._micro_batch_size = (batch_shape[0] + num_replicas - 1) // num_replicas
+        micro_shape = [self._micro_batch_size] + list(batch_shape[1:])
+
+        self._context = zmq.Context()
+        self._result_socket = self._context.socket(zmq.PULL)
+        self._result_socket.bind('tcp://0.0.0.0:{port}'.format(port=zmq_port))
+        self._sockets = []
+        for i in range(num_replicas):
+            socket = self._context.socket(zmq.PUSH)
+            socket.bind('tcp://0.0.0.0:{port}'.format(port=zmq_port + 1 + i))
+            self._sockets.append(socket)
+
+        self._procs = []
+        for i, cores in enumerate(get_core_sets(num_replicas, num_threads)):
+            env = dict(os.environ)
+            env.update(OMP_NUM_THREADS=str(num_threads), MKL_NUM_THREADS=str(num_threads),
+                       MXNET_CPU_WORKER_NTHREADS='1')
+            cmd = [sys.executable, '-u', os.path.abspath(__file__), '--replica-id', str(i),
+                   '--zmq-port', str(zmq_port), '--data-shape', ','.join(str(x) for x in micro_shape),
+                   '--symbol-cache-dir', symbol_cache_dir,
+                   '--symbol'] + list(symbols) + ['--params'] + list(params)
+            logging.info('start replica {} (cores: {})'.format(i, cores))
+            self._procs.append(subprocess.Popen(cmd, env=env, preexec_fn=functools.partial(os.sched_setaffinity, 0, cores)))
+
+        for _ in range(num_replicas):
+            meta, _ = recv_array(self._result_socket)
+            logging.info('replica {} is ready'.format(meta['replica_id']))
+
+        self.models = [ReplicaModel(self, model_id) for model_id in range(len(symbols))]
+
+    def forward(self, model_id, batch_data):
+        chunks = range(0, len(batch_data), self._micro_batch_size)
+        for seq, begin in enumerate(chunks):
+            chunk = batch_data[begin:begin + self._micro_batch_size].astype(np.float32, copy=False)
+            send_array(self._sockets[seq % self._num_replicas], chunk, seq=seq, model_id=model_id)
+
+        probs = [None] * len(chunks)
+        for _ in chunks:
+            meta, array = recv_array(self._result_socket)
+            probs[meta['seq']] = array
+        return np.concatenate(probs)
+
+    def close(self):
+        for socket in self._sockets:
+            socket.send_pyobj(None)
+        for proc in self._procs:
+            proc.wait()
+        for socket in self._sockets + [self._result_socket]:  # free the ports for the next pool
+            socket.close(linger=0)
+        self._context.term()
+        logging.info('all replicas finished')
+
+
+def _func_replica(args):
+    from predict import load_testers
+
+    data_shape = [int(x) for x in args.data_shape.split(',')]
+    testers = load_testers(args.symbol, args.params, data_shape, device_type='cpu',
+                           symbol_cache_dir=args.symbol_cache_dir, num_threads=1)
+
+    context = zmq.Context()
+    socket = context.socket(zmq.PULL)
+    socket.connect('tcp://0.0.0.0:{port}'.format(port=args.zmq_port + 1 + args.replica_id))
+    result_socket = context.socket(zmq.PUSH)
+    result_socket.connect('tcp://0.0.0.0:{port}'.format(port=args.zmq_port))
+    send_array(result_socket, np.zeros(0), replica_id=args.replica_id)
+
+    batch_data = np.zeros(data_shape, dtype=np.float32)
+    while True:
+        meta, chunk = recv_array(socket)
+        if meta is None:
+            return
+        batch_data[:len(chunk)] = chunk
+        probs = testers[meta['model_id']].get_probs(batch_data)
+        send_array(result_socket, probs[:len(chunk)], **meta)
+
+
+def benchmark(args):
+    data_shape = [int(x) for x in args.data_shape.split(',')]
+    batch_shape = [args.batch_size] + data_shape
+    batch_data = np.random.uniform(0, 255, batch_shape).astype(np.float32)
+    num_cores = len(os.sched_getaffinity(0))
+
+    results = []
+    for num_replicas in args.bench_replicas:
+        for num_threads in args.bench_threads:
+            if num_replicas * num_threads > num_cores:
+                continue
+            pool = ReplicaPool(args.symbol, args.params, batch_shape, num_replicas, num_threads, args.zmq_port,
+                               symbol_cache_dir=args.symbol_cache_dir)
+            try:
+                for model in pool.models:  # warm-up
+                    model.get_probs(batch_data)
+                t0 = time.time()
+                for _ in range(args.bench_batches):
+                    for model in pool.models:
+                        model.get_probs(batch_data)
+                elapsed = time.time() - t0
+            finally:
+                pool.close()
+            speed = args.bench_batches * args.batch_size / elapsed
+            results.append((num_replicas, num_threads, speed))
+            logging.info('replicas:{} threads:{} -> {:.1f} images/s'.format(num_replicas, num_threads, speed))
+
+    base = results[0][2] if results else 1.0
+    print('replicas\tthreads\tcores\timages/s\tspeedup')
+    for num_replicas, num_threads, speed in results:
+        print('{}\t{}\t{}\t{:.1f}\t{:.2f}'.format(num_replicas, num_threads, num_replicas * num_threads, speed, speed / base))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--params', type=str, nargs='+', required=True)
+    parser.add_argument('--symbol', type=str, nargs='+', required=True)
+    parser.add_argument('--data-shape', type=str, default='3,180,180')
+    parser.add_argument('--zmq-port', type=int, default=18310)
+    parser.add_argument('--symbol-cache-dir', type=str, default='')
+    parser.add_argument('--replica-id', type=int, default=-1, help='internal: run as a replica')
+
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--bench-replicas', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--bench-threads', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--bench-batches', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.replica_id >= 0:
+        _func_replica(args)
+    else:
+        benchmark(args)
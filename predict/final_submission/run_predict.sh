@@ -50,7 +50,8 @@ python3 -u ${ROOT}/predict/predict.py \
 python3 -u ${ROOT}/predict/md5_predict.py \
     --train-bson    ${ROOT}/data/train.bson \
     --test-bson     ${ROOT}/data/test.bson \
-    --md5-dict-pkl  ${ROOT}/data/train_md5_dict.pkl \
+    --product-index ${ROOT}/data/train_product_index.npz \
+    --num-procs     24 \
     --output        ${ROOT}/predict/md5_output.txt
 
 
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+Export a trained model for inference with BatchNorm folded into the preceding convolutions.
+
+At inference a BatchNorm after a Convolution (or FullyConnected) is an affine transform per channel,
+so it is merged into the weights and the bias of the layer:
+
+    scale = gamma / sqrt(moving_var + eps)      (gamma = 1 with fix_gamma)
+    w' = w * scale,  b' = (b - moving_mean) * scale + beta
+
+Ops that are the identity at inference (Dropout, _copy, identity, BlockGrad) are removed,
+and so are the nodes no longer used (the BatchNorm parameters). The graph is edited as json,
+and the result is checked against the original model on random inputs.
+"""
+
+import sys
+import json
+import time
+import logging
+import coloredlogs
+coloredlogs.install(level=logging.INFO)
+
+import numpy as np
+import mxnet as mx
+
+from predict import load_symbol, load_params, Tester
+
+FOLDABLE = ('Convolution', 'FullyConnected')
+IDENTITY_OPS = ('Dropout', '_copy', 'identity', 'BlockGrad', 'stop_gradient')
+
+
+def _attrs(node):
+    for key in ('attrs', 'attr', 'param'):  # by MXNet version
+        if key in node:
+            return node[key]
+    return {}
+
+
+def _is_true(value):
+    return str(value).lower() in ('true', '1')
+
+
+def _consumers(nodes, heads):
+    """node id -> number of references to its outputs"""
+    counts = [0] * len(nodes)
+    for node in nodes:
+        for src, _, _ in node['inputs']:
+            counts[src] += 1
+    for src, _, _ in heads:
+        counts[src] += 1
+    return counts
+
+
+def fold(graph, arg_params, aux_params):
+    """fold BatchNorm and remove identity ops in the json graph, returns (graph, arg_params, aux_params, stats)"""
+    nodes, heads = graph['nodes'], graph['heads']
+    arg_params, aux_params = dict(arg_params), dict(aux_params)
+    consumers = _consumers(nodes, heads)
+    redirect = dict()  # (node id, output index) of a removed node -> what it is replaced with
+    stats = {'folded': 0, 'identity': 0}
+
+    def _resolve(entry):
+        key = (entry[0], entry[1])
+        while key in redirect:
+            key = redirect[key]
+        return [key[0], key[1], 0]
+
+    for i, node in enumerate(nodes):
+        node['inputs'] = [_resolve(x) for x in node['inputs']]
+        attrs = _attrs(node)
+        if node['op'] in IDENTITY_OPS:
+            redirect[(i, 0)] = tuple(node['inputs'][0][:2])
+            stats['identity'] += 1
+        elif node['op'] == 'BatchNorm' and int(attrs.get('axis', 1)) == 1:
+            src = node['inputs'][0][0]
+            layer = nodes[src]
+            if layer['op'] not in FOLDABLE or consumers[src] != 1:
+                continue
+            gamma_name, beta_name, mean_name, var_name = (nodes[x[0]]['name'] for x in node['inputs'][1:5])
+            weight_name = nodes[layer['inputs'][1][0]]['name']
+            no_bias = _is_true(_attrs(layer).get('no_bias', False))
+            bias_name = layer['name'] + '_bias' if no_bias else nodes[layer['inputs'][2][0]]['name']
+
+            eps = float(attrs.get('eps', 1e-3))
+            gamma = arg_params[gamma_name].asnumpy()
+            if _is_true(attrs.get('fix_gamma', True)):
+                gamma = np.ones_like(gamma)
+            scale = gamma / np.sqrt(aux_params[var_name].asnumpy() + eps)
+            weight = arg_params[weight_name].asnumpy()
+            bias = np.zeros(weight.shape[0], np.float32) if no_bias else arg_params[bias_name].asnumpy()
+            arg_params[weight_name] = mx.nd.array(weight * scale.reshape((-1,) + (1,) * (weight.ndim - 1)))
+            arg_params[bias_name] = mx.nd.array((bias - aux_params[mean_name].asnumpy()) * scale
+                                                + arg_params[beta_name].asnumpy())
+            for name in (gamma_name, beta_name):
+                arg_params.pop(name, None)
+            for name in (mean_name, var_name):
+                aux_params.pop(name, None)
+
+            if no_bias:
+                _attrs(layer)['no_bias'] = 'False'
+                nodes.append({'op': 'null', 'name': bias_name, 'inputs': []})
+                layer['inputs'].append([len(nodes) - 1, 0, 0])
+            redirect[(i, 0)] = (src, 0)
+            stats['folded'] += 1
+
+    graph['heads'] = [_resolve(x) for x in heads]
+    return _compact(graph), arg_params, aux_params, stats
+
+
+def _compact(graph):
+    """drop the nodes not reachable from the heads, in topological order (variables appended by fold first)"""
+    nodes = graph['nodes']
+    used = set()
+    stack = [x[0] for x in graph['heads']]
+    while stack:
+        i = stack.pop()
+        if i not in used:
+            used.add(i)
+            stack.extend(x[0] for x in nodes[i]['inputs'])
+
+    first_consumer = dict()
+    for j in sorted(used):
+        for src, _, _ in nodes[j]['inputs']:
+            first_consumer.setdefault(src, j)
+    # a variable goes right before its first consumer
+    order = sorted(used, key=lambda i: (first_consumer.get(i, i), 0) if nodes[i]['op'] == 'null' else (i, 1))
+    new_id = {old: new for new, old in enumerate(order)}
+    new_nodes = []
+    for old in order:
+        node = dict(nodes[old])
+        node['inputs'] = [[new_id[x[0]], x[1], x[2]] for x in node['inputs']]
+        new_nodes.append(node)
+    result = {'nodes': new_nodes, 'arg_nodes': [i for i, x in enumerate(new_nodes) if x['op'] == 'null'],
+              'heads': [[new_id[x[0]], x[1], x[2]] for x in graph['heads']]}
+    if 'attrs' in graph:
+        result['attrs'] = graph['attrs']
+    return result
+
+
+def _latency(tester, data, num_runs):
+    tester.get_probs(data)  # warm-up
+    t0 = time.time()
+    for _ in range(num_runs):
+        tester.get_probs(data)
+    return (time.time() - t0) / num_runs
+
+
+def main(args):
+    symbol = load_symbol(args.symbol)
+    arg_params, aux_params = load_params(args.params)
+    graph = json.loads(symbol.tojson())
+    num_nodes = len(graph['nodes'])
+    graph, arg_params, aux_params, stats = fold(graph, arg_params, aux_params)
+    folded_symbol = mx.sym.load_json(json.dumps(graph))
+    logging.info('folded {folded} BatchNorm, removed {identity} identity ops'.format(**stats))
+    logging.info('nodes: {} -> {}, operators: {} -> {}'.format(
+        num_nodes, len(graph['nodes']),
+        sum(x['op'] != 'null' for x in json.loads(symbol.tojson())['nodes']),
+        sum(x['op'] != 'null' for x in graph['nodes'])))
+
+    folded_symbol.save(args.prefix + '-symbol.json')
+    mx.nd.save(args.prefix + '-0000.params', dict([('arg:' + k, v) for k, v in arg_params.items()] +
+                                                 [('aux:' + k, v) for k, v in aux_params.items()]))
+    logging.info('saved {0}-symbol.json and {0}-0000.params'.format(args.prefix))
+
+    data_shape = [args.batch_size] + [int(x) for x in args.data_shape.split(',')]
+    data = np.random.RandomState(0).uniform(0, 255, data_shape).astype(np.float32)
+    original = Tester(args.symbol, args.params, data_shape, device_type=args.device_type, gpus=args.gpus)
+    exported = Tester(args.prefix + '-symbol.json', args.prefix + '-0000.params', data_shape,
+                      device_type=args.device_type, gpus=args.gpus)
+    expected, actual = original.get_probs(data), exported.get_probs(data)
+    max_diff = np.abs(expected - actual).max()
+    same_top1 = np.mean(expected.argmax(axis=1) == actual.argmax(axis=1))
+    logging.info('max |prob difference|: {:.3g}, same top-1: {:.4f}'.format(max_diff, same_top1))
+
+    if args.num_runs > 0:
+        before, after = _latency(original, data, args.num_runs), _latency(exported, data, args.num_runs)
+        logging.info('latency (batch {}, {}): {:.2f}ms -> {:.2f}ms (x{:.2f})'.format(
+            args.batch_size, args.device_type, before * 1000, after * 1000, before / after))
+
+    if max_diff > args.tolerance:
+        logging.error('outputs differ by more than {}'.format(args.tolerance))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--symbol', type=str, required=True)
+    parser.add_argument('--params', type=str, required=True)
+    parser.add_argument('--prefix', type=str, required=True, help='save to <prefix>-symbol.json and <prefix>-0000.params')
+    parser.add_argument('--data-shape', type=str, default='3,180,180')
+    parser.add_argument('--batch-size', type=int, default=8, help='of the check and the latency comparison')
+    parser.add_argument('--device-type', type=str, default='cpu', choices=['gpu', 'cpu'])
+    parser.add_argument('--gpus', type=str, default='0')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='largest difference of the probabilities')
+    parser.add_argument('--num-runs', type=int, default=10, help='forwards timed for the latency, 0 to skip')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load generator of serve.py: concurrent clients send the products of a bson and
+the latency percentiles and the throughput are reported for each number of clients.
+"""
+
+import sys
+import os
+import time
+import logging
+import threading
+import coloredlogs
+coloredlogs.install(level=logging.INFO)
+
+import bson
+import numpy as np
+import zmq
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data import utils
+from serve import classify
+
+
+def load_products(bson_path, num_products):
+    products = []
+    for _, raw in utils.iter_bson_raw(bson_path, count=num_products):
+        d = bson.BSON(raw).decode()
+        products.append(([pic['picture'] for pic in d['imgs']], d.get('category_id')))
+    return products
+
+
+def _func_client(port, products, top_k, results):
+    socket = zmq.Context.instance().socket(zmq.REQ)
+    socket.connect('tcp://0.0.0.0:{port}'.format(port=port))
+    for images, category_id in products:
+        t0 = time.time()
+        reply = classify(socket, images, top_k)
+        results.append((time.time() - t0, reply, category_id))
+    socket.close()
+
+
+def run(port, products, num_clients, top_k):
+    results = []
+    threads = [threading.Thread(target=_func_client, args=(port, products[i::num_clients], top_k, results))
+               for i in range(num_clients)]
+    t0 = time.time()
+    [x.start() for x in threads]
+    [x.join() for x in threads]
+    elapsed = time.time() - t0
+
+    latencies = np.array([x[0] for x in results]) * 1000
+    labelled = [(reply, category_id) for _, reply, category_id in results if category_id is not None and 'top_k' in reply]
+    accuracy = np.mean([reply['top_k'][0][0] == category_id for reply, category_id in labelled]) if labelled else 0.0
+    return len(results) / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99), accuracy
+
+
+def main(args):
+    products = load_products(args.bson, args.num_products)
+    logging.info('{} products from {}'.format(len(products), args.bson))
+
+    run(args.port, products[:args.num_clients[0]], args.num_clients[0], args.top_k)  # warm-up
+    print('clients\tproducts/s\tp50(ms)\tp99(ms)\taccuracy')
+    for num_clients in args.num_clients:
+        speed, p50, p99, accuracy = run(args.port, products, num_clients, args.top_k)
+        print('{}\t{:.1f}\t{:.1f}\t{:.1f}\t{:.4f}'.format(num_clients, speed, p50, p99, accuracy))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bson', type=str, required=True)
+    parser.add_argument('--port', type=int, default=18500)
+    parser.add_argument('--num-products', type=int, default=1000)
+    parser.add_argument('--num-clients', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--top-k', type=int, default=5)
+    args = parser.parse_args()
+
+    main(args)
@@ -1,65 +1,43 @@
-
 import sys
 import os
 import logging
-import pickle
-import hashlib
-from collections import defaultdict, Counter
 
-from tqdm import tqdm
-import bson
+import numpy as np
 import coloredlogs
 coloredlogs.install(level=logging.INFO)
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data import product_index
 
-def main(args):
-    # logging.info('loading md5 dict...')
-    # md5_dict = pickle.load(open(args.md5_dict_pkl, 'rb')) if args.md5_dict_pkl else dict()
-    # logging.info('loaded {} images'.format(len(md5_dict)))
-
-    train_data = bson.decode_file_iter(open(args.train_bson, 'rb'))
-
-    product_dict = defaultdict(Counter)
-    image_dict = defaultdict(Counter)
-    for i, d in tqdm(enumerate(train_data), unit='products'):
-        product_id = d.get('_id')
-        category_id = d.get('category_id', None)  # This won't be in Test data
-
-        hash_list = []
-        for img in d['imgs']:
-            h = hashlib.md5(img['picture']).hexdigest()
-            hash_list.append(h)
-            image_dict[h][category_id] += 1
-        product_hash = ','.join(sorted(set(hash_list)))
-        product_dict[product_hash][category_id] += 1
 
-    test_data = bson.decode_file_iter(open(args.test_bson, 'rb'))
-    for i, d in tqdm(enumerate(test_data), unit='products'):
-        product_id = d.get('_id')
-        category_id = d.get('category_id', None)  # This won't be in Test data
-
-        hash_list = []
-        for img in d['imgs']:
-            h = hashlib.md5(img['picture']).hexdigest()
-            hash_list.append(h)
+def main(args):
+    if os.path.exists(args.product_index):
+        index = product_index.load_index(args.product_index)
+    else:
+        index = product_index.build_index(args.train_bson, args.num_procs)
+        if args.product_index:
+            product_index.save_index(index, args.product_index)
 
-        product_hash = ','.join(sorted(set(hash_list)))
-        if product_hash in product_dict:
-            if len(product_dict[product_hash]) == 1:
-                most_id, most_cnt = product_dict[product_hash].most_common(1)[0]
-                pred = most_id
-                args.output.write('{},{}\n'.format(product_id, pred))
+    product_ids, keys, _ = product_index.hash_products(args.test_bson, args.num_procs)
+    cate_ids, num_labels = product_index.lookup(index, keys)
+    found = cate_ids >= 0
+    logging.info('{} of {} products are found with a single label'.format(found.sum(), len(product_ids)))
+    for product_id, pred in zip(product_ids[found], cate_ids[found]):
+        args.output.write('{},{}\n'.format(product_id, pred))
 
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('--train-bson', type=str, required=True)
+    parser.add_argument('--train-bson', type=str, default='', help='used to build --product-index if it does not exist')
     parser.add_argument('--test-bson', type=str, required=True)
-    parser.add_argument('--md5-dict-pkl', type=str, required=True)
+    parser.add_argument('--product-index', type=str, default='', help='.npz created by data/product_index.py')
     parser.add_argument('--output', type=argparse.FileType('w'), default='-')
+    parser.add_argument('--num-procs', type=int, default=8)
     parser.add_argument('--cut', type=int, default=0)
     args = parser.parse_args()
 
-    main(args)
+    if not os.path.exists(args.product_index) and not args.train_bson:
+        parser.error('--train-bson is required to build the product index')
 
+    main(args)
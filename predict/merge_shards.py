@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+Merge the outputs of predict.py --num-shards K into one output per file (main output, its .topk and the
+.e{k}.m{m} of the ensembles), in csv or columnar (see output.py) as written by the shards, with the products
+in the order of the bson, and verify that every product is predicted exactly once.
+"""
+
+import sys
+import os
+import glob
+import logging
+import coloredlogs
+coloredlogs.install(level=logging.INFO)
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data import utils
+from output import get_output, read_columnar
+
+CSV_HEADERS = (b'_id,category_id\n', b'_id,category_ids,scores\n')  # see output.CsvOutput
+COLUMNS = ('.id', '.cate', '.topk_id', '.topk_score')  # see output.ColumnarOutput
+
+
+def shard_path(output, shard_index, num_shards):
+    return '{}.shard-{}-of-{}'.format(output, shard_index, num_shards)
+
+
+def _csv_header(path):
+    with open(path, 'rb') as reader:
+        header = reader.readline(64)
+    return header.decode() if header in CSV_HEADERS else None
+
+
+def get_outputs(output, num_shards):
+    """[(suffix, format)] of the outputs found for the first shard, the files of other formats are an error"""
+    prefix = shard_path(output, 0, num_shards)
+    outputs, unknown = [], []
+    for path in sorted(glob.glob(glob.escape(prefix) + '*')):
+        suffix = path[len(prefix):]
+        column = next((x for x in COLUMNS if suffix.endswith(x)), None)
+        if '.ckpt' in suffix or column in ('.cate', '.topk_id', '.topk_score'):
+            continue
+        elif column == '.id':
+            outputs.append((suffix[:-len(column)], 'columnar'))
+        elif _csv_header(path):
+            outputs.append((suffix, 'csv'))
+        else:
+            unknown.append(path)
+    if unknown:
+        raise ValueError('unknown output format: {}'.format(', '.join(unknown)))
+    return outputs
+
+
+def read_csv(path):
+    """{product id: the rest of its row}, the number of duplicated products"""
+    predictions, duplicates = dict(), 0
+    with open(path, 'r') as reader:
+        next(reader)  # csv header
+        for line in reader:
+            product_id, value = line.rstrip('\n').split(',', 1)
+            if int(product_id) in predictions:
+                duplicates += 1
+            predictions[int(product_id)] = value
+    return predictions, duplicates
+
+
+def read_columnar_rows(path):
+    """{product id: (category id, and top-k ids and scores if written)}, the number of duplicated products"""
+    data = read_columnar(path)
+    columns = [data[k] for k in ('category_id', 'topk_id', 'topk_score') if k in data]
+    predictions = dict(zip(data['_id'].tolist(), zip(*columns)))
+    return predictions, len(data['_id']) - len(predictions)
+
+
+def _write_csv(path, header, product_ids, predictions):
+    with open(path, 'w') as writer:
+        writer.write(header)
+        for product_id in product_ids:
+            writer.write('{},{}\n'.format(product_id, predictions[product_id]))
+
+
+def _write_columnar(path, top_k, product_ids, predictions):
+    writer = get_output(path, 'columnar', top_k)
+    rows = [predictions[x] for x in product_ids]
+    columns = [np.array([row[i] for row in rows]) for i in range(3 if top_k else 1)]
+    writer.write(product_ids, *columns)
+    writer.close()
+
+
+def merge(product_ids, output, suffix, num_shards, output_format='csv'):
+    read = read_csv if output_format == 'csv' else read_columnar_rows
+    predictions, duplicates = dict(), 0
+    for shard_index in range(num_shards):
+        shard_predictions, shard_duplicates = read(shard_path(output, shard_index, num_shards) + suffix)
+        duplicates += shard_duplicates + len(predictions.keys() & shard_predictions.keys())
+        predictions.update(shard_predictions)
+
+    missing = [x for x in product_ids if x not in predictions]
+    unknown = len(predictions.keys() - set(product_ids))
+    found = [x for x in product_ids if x in predictions]
+    first = shard_path(output, 0, num_shards) + suffix
+    if output_format == 'csv':
+        _write_csv(output + suffix, _csv_header(first), found, predictions)
+    else:
+        _write_columnar(output + suffix, os.path.exists(first + '.topk_id'), found, predictions)
+
+    logging.info('{} ({}): {} products, missing: {}, duplicated: {}, unknown: {}'.format(
+        output + suffix, output_format, len(found), len(missing), duplicates, unknown))
+    if missing:
+        logging.warning('missing products: {}{}'.format(missing[:10], ' ...' if len(missing) > 10 else ''))
+    return not missing and not duplicates and not unknown
+
+
+def main(args):
+    product_ids = [utils.decode_fields(raw, ('_id',))['_id'] for _, raw in utils.iter_bson_raw(args.bson)]
+    if args.cut:
+        product_ids = product_ids[:args.cut]
+
+    outputs = get_outputs(args.output, args.num_shards)
+    if not outputs:
+        raise FileNotFoundError(shard_path(args.output, 0, args.num_shards))
+    results = [merge(product_ids, args.output, suffix, args.num_shards, output_format)
+               for suffix, output_format in outputs]
+    if not all(results):
+        logging.error('coverage check failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bson', type=str, required=True, help='the bson given to predict.py')
+    parser.add_argument('--output', type=str, required=True, help='--output of predict.py (without the shard suffix)')
+    parser.add_argument('--num-shards', type=int, required=True)
+    parser.add_argument('--cut', type=int, default=0, help='--cut of predict.py')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pipeline metrics of predict.py.
+
+Every stage (reader, processors, predictor) keeps cumulative counters, gauges and latency histograms
+in a MetricsPublisher, which pushes a snapshot of them to the predictor at most every `interval` seconds.
+The MetricsCollector of the predictor keeps the last snapshot of each stage and writes the snapshots
+as JSON lines (appended) or a Prometheus text file (replaced).
+
+Snapshots are cumulative, so a snapshot dropped because the channel is full only delays the numbers,
+and a stage never blocks on its metrics.
+"""
+
+import os
+import json
+import time
+import bisect
+import contextlib
+
+import zmq
+
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)  # seconds
+
+
+def get_rss():
+    """resident set size of this process in bytes, 0 if unknown"""
+    try:
+        with open('/proc/self/statm') as reader:
+            return int(reader.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())))
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+
+class MetricsPublisher(object):
+    def __init__(self, stage, port=None, interval=5.0):
+        self.stage = stage
+        self._interval = interval
+        self._last_publish = 0.0
+        self._counters, self._gauges, self._histograms = dict(), dict(), dict()
+
+        self._socket = None
+        if port is not None:
+            self._context = zmq.Context()
+            self._socket = self._context.socket(zmq.PUSH)
+            self._socket.set_hwm(10)
+            self._socket.connect('tcp://0.0.0.0:{port}'.format(port=port))
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self._gauges[_key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        if key not in self._histograms:
+            self._histograms[key] = Histogram()
+        self._histograms[key].observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        t0 = time.time()
+        yield
+        self.observe(name, time.time() - t0, **labels)
+
+    def snapshot(self):
+        self.set('rss_bytes', get_rss())
+        return {
+            'stage': self.stage,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'counters': dict(self._counters),
+            'gauges': dict(self._gauges),
+            'histograms': {k: v.to_dict() for k, v in self._histograms.items()},
+        }
+
+    def publish(self, force=False):
+        """send a snapshot if the interval has passed (or force)"""
+        now = time.time()
+        if self._socket is None or (not force and now - self._last_publish < self._interval):
+            return
+        self._last_publish = now
+        try:
+            self._socket.send_pyobj(self.snapshot(), flags=zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+
+    def close(self):
+        self.publish(force=True)
+        if self._socket is not None:
+            self._socket.close(linger=10000)
+            self._context.term()  # flush the last snapshot, processes exit without terminating contexts
+
+
+def _backlogs(snapshots):
+    """messages sent but not yet received between the stages"""
+    def _total(prefix, name):
+        return sum(s['counters'].get(name, 0) for stage, s in snapshots.items() if stage.startswith(prefix))
+
+    return {
+        'reader_to_processors': _total('reader', 'products_sent') - _total('processor', 'products_received'),
+        'processors_to_predictor': _total('processor', 'products_sent') - _total('predictor', 'products_received'),
+    }
+
+
+class MetricsCollector(object):
+    def __init__(self, port, output, output_format='jsonl', interval=5.0):
+        assert output_format in ('jsonl', 'prom'), output_format
+        self._output = output
+        self._format = output_format
+        self._interval = interval
+        self._last_write = time.time()
+        self.snapshots = dict()
+
+        self._socket = zmq.Context.instance().socket(zmq.PULL)
+        self._socket.bind('tcp://0.0.0.0:{port}'.format(port=port))
+
+    def poll(self, timeout=0):
+        """receive the pending snapshots, waiting up to timeout ms for the first one"""
+        while self._socket.poll(timeout):
+            snapshot = self._socket.recv_pyobj()
+            self.snapshots[snapshot['stage']] = snapshot
+            timeout = 0
+
+    def update(self, local=None, force=False):
+        """poll and write if the interval has passed (or force), with a snapshot of the local MetricsPublisher"""
+        self.poll()
+        if force or time.time() - self._last_write >= self._interval:
+            self._last_write = time.time()
+            if local is not None:
+                self.snapshots[local.stage] = local.snapshot()
+            self.write()
+
+    def write(self):
+        backlogs = _backlogs(self.snapshots)
+        if self._format == 'jsonl':
+            with open(self._output, 'a') as writer:
+                for stage in sorted(self.snapshots):
+                    writer.write(json.dumps(self.snapshots[stage], sort_keys=True) + '\n')
+                writer.write(json.dumps({'stage': 'pipeline', 'time': time.time(), 'gauges': backlogs}, sort_keys=True) + '\n')
+        else:
+            with open(self._output + '.tmp', 'w') as writer:
+                writer.write(self.to_prometheus(backlogs))
+            os.replace(self._output + '.tmp', self._output)
+
+    def to_prometheus(self, backlogs):
+        lines = []
+
+        def _name(key, suffix=''):
+            name, _, labels = key.partition('{')
+            return 'cdiscount_predict_' + name + suffix, labels.rstrip('}')
+
+        def _line(name, labels, value):
+            lines.append('{}{{{}}} {}'.format(name, ','.join(x for x in labels if x), value))
+
+        for stage in sorted(self.snapshots):
+            s = self.snapshots[stage]
+            stage_label = 'stage="{}"'.format(stage)
+            for key, value in sorted(s['counters'].items()):
+                name, labels = _name(key, '_total')
+                _line(name, [stage_label, labels], value)
+            for key, value in sorted(s['gauges'].items()):
+                name, labels = _name(key)
+                _line(name, [stage_label, labels], value)
+            for key, h in sorted(s['histograms'].items()):
+                name, labels = _name(key)
+                cumulative = 0
+                for le, count in zip(list(h['buckets']) + ['+Inf'], h['counts']):
+                    cumulative += count
+                    _line(name + '_bucket', [stage_label, labels, 'le="{}"'.format(le)], cumulative)
+                _line(name + '_sum', [stage_label, labels], h['sum'])
+                _line(name + '_count', [stage_label, labels], h['count'])
+        for key, value in sorted(backlogs.items()):
+            _line('cdiscount_predict_backlog', ['link="{}"'.format(key)], value)
+        return '\n'.join(lines) + '\n'
+
+    def close(self, local=None):
+        self.poll(timeout=500)  # the last snapshots of the other stages
+        self.update(local, force=True)
+        self._socket.close()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Output files of predict.py, written by its writer process in large buffered chunks.
+
+csv:       <path> with '_id,category_id' rows (and <path>.topk with '_id,category_ids,scores' if top-k)
+columnar:  <path>.id int64, <path>.cate int64 (and <path>.topk_id int64 (N, k), <path>.topk_score float32 (N, k))
+           raw little-endian arrays, see read_columnar
+"""
+
+import os
+
+import numpy as np
+
+BUFFER_SIZE = 1 << 22
+
+
+def _open(path, mode, position=None, header=None):
+    """open to append after position (resume), or create with the header"""
+    if position is not None:
+        with open(path, 'r+b') as writer:
+            writer.truncate(position)
+        return open(path, mode.replace('w', 'a'), buffering=BUFFER_SIZE)
+    writer = open(path, mode, buffering=BUFFER_SIZE)
+    if header:
+        writer.write(header)
+    return writer
+
+
+class CsvOutput(object):
+    def __init__(self, path, top_k=0, positions=None):
+        positions = positions or {}
+        self._files = {path: _open(path, 'w', positions.get(path), '_id,category_id\n')}
+        self._path = path
+        if top_k:
+            self._files[path + '.topk'] = _open(path + '.topk', 'w', positions.get(path + '.topk'),
+                                                '_id,category_ids,scores\n')
+
+    def write(self, product_ids, cate_ids, topk_ids=None, topk_scores=None):
+        self._files[self._path].write(''.join('{0:d},{1:d}\n'.format(product_id, cate_id)
+                                              for product_id, cate_id in zip(product_ids, cate_ids)))
+        if topk_ids is not None and self._path + '.topk' in self._files:
+            self._files[self._path + '.topk'].write(''.join(
+                '{},{},{}\n'.format(product_id, ' '.join(str(x) for x in ids), ' '.join('{:.6f}'.format(x) for x in scores))
+                for product_id, ids, scores in zip(product_ids, topk_ids, topk_scores)))
+
+    def flush(self):
+        for writer in self._files.values():
+            writer.flush()
+
+    def positions(self):
+        return {path: writer.tell() for path, writer in self._files.items()}
+
+    def close(self):
+        for writer in self._files.values():
+            writer.close()
+
+
+class ColumnarOutput(CsvOutput):
+    def __init__(self, path, top_k=0, positions=None):
+        positions = positions or {}
+        columns = ['.id', '.cate'] + (['.topk_id', '.topk_score'] if top_k else [])
+        self._files = {path + x: _open(path + x, 'wb', positions.get(path + x)) for x in columns}
+        self._path = path
+
+    def write(self, product_ids, cate_ids, topk_ids=None, topk_scores=None):
+        self._files[self._path + '.id'].write(np.asarray(product_ids, dtype='<i8').tobytes())
+        self._files[self._path + '.cate'].write(np.asarray(cate_ids, dtype='<i8').tobytes())
+        if topk_ids is not None and self._path + '.topk_id' in self._files:
+            self._files[self._path + '.topk_id'].write(np.asarray(topk_ids, dtype='<i8').tobytes())
+            self._files[self._path + '.topk_score'].write(np.asarray(topk_scores, dtype='<f4').tobytes())
+
+
+def read_columnar(path):
+    """{'_id': (N,), 'category_id': (N,), and 'topk_id', 'topk_score': (N, k) if written}"""
+    data = {'_id': np.fromfile(path + '.id', dtype='<i8'), 'category_id': np.fromfile(path + '.cate', dtype='<i8')}
+    if os.path.exists(path + '.topk_id'):
+        ids = np.fromfile(path + '.topk_id', dtype='<i8')
+        data['topk_id'] = ids.reshape(len(data['_id']), -1) if len(data['_id']) else ids.reshape(0, 0)
+        data['topk_score'] = np.fromfile(path + '.topk_score', dtype='<f4').reshape(data['topk_id'].shape)
+    return data
+
+
+def get_output(path, output_format='csv', top_k=0, positions=None):
+    if output_format == 'csv':
+        return CsvOutput(path, top_k, positions)
+    elif output_format == 'columnar':
+        return ColumnarOutput(path, top_k, positions)
+    raise ValueError('invalid output format: {}'.format(output_format))
@@ -2,6 +2,8 @@
 
 import time
 import csv
+import json
+import functools
 import hashlib
 import logging
 import coloredlogs
@@ -9,7 +11,8 @@ import pickle
 import sys
 import os
 from operator import itemgetter
-from multiprocessing import Process
+from multiprocessing import Process, Event, Value
+from concurrent.futures import ThreadPoolExecutor
 coloredlogs.install(level=logging.DEBUG, milliseconds=True)
 
 from collections import namedtuple, Counter, defaultdict
@@ -22,40 +25,176 @@ import zmq
 from tqdm import tqdm
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from data.category import get_category_dict
+from data.category import get_category_arrays
 from data import utils
+from data import product_index
+from data import phash_index
+from train.common.params import is_compressed, load_compressed
+from cpu_engine import ReplicaPool
+from metrics import MetricsPublisher, MetricsCollector
+from checkpoint import Checkpoint, load_checkpoint, save_checkpoint
+from output import get_output
+from tensor_cache import load_cache, check_cache
+from merge_shards import shard_path
 
 
 Batch = namedtuple('Batch', ['data'])
+KnownProduct = namedtuple('KnownProduct', ['product_id', 'cate_id', 'num_images'])  # found in the product index
+ReaderDone = namedtuple('ReaderDone', ['num_products'])  # the number of products sent to the processors
+HashedImages = namedtuple('HashedImages', ['images', 'hashes'])  # with [(image_id, dHash), ...] for --phash-index
 
+# shared between the processes, watched by the Supervisor
+PipelineCounters = namedtuple('PipelineCounters', ['dispatched', 'processed', 'consumed', 'starved_ms', 'input_done'])
 
-class Tester(object):
-    def __init__(self, symbol_path, params_path, data_shape, device_type='gpu', gpus='0'):
-        self._data_shape = data_shape
-        self._arg_params, self._aux_params = {}, {}
+
+def _get_counters():
+    return PipelineCounters(*(Value('q', 0) for _ in PipelineCounters._fields))
+
+
+def _add(value, n):
+    with value.get_lock():
+        value.value += n
+
+
+def _symbol_cache_path(raw, cache_dir):
+    return os.path.join(cache_dir, hashlib.md5(raw).hexdigest() + '.json') if cache_dir else None
+
+
+def _save_symbol_cache(symbol, cache_path):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = '{}.{}'.format(cache_path, os.getpid())
+    symbol.save(tmp_path)
+    os.rename(tmp_path, cache_path)
+
+
+def load_symbol(symbol_path, cache_dir=''):
+    """symbols saved by old MXNet (e.g. v0.8) are upgraded on every load, so keep the upgraded json in cache_dir"""
+    if not cache_dir:
+        return mx.symbol.load(symbol_path)
+
+    with open(symbol_path, 'rb') as reader:
+        raw = reader.read()
+    cache_path = _symbol_cache_path(raw, cache_dir)
+    if os.path.exists(cache_path):
+        return mx.symbol.load(cache_path)
+
+    symbol = mx.symbol.load_json(raw.decode('utf-8'))
+    _save_symbol_cache(symbol, cache_path)
+    return symbol
+
+
+def load_params(params_path, raw=None):
+    """raw: the bytes of params_path if already read"""
+    if is_compressed(params_path):  # see train/common/params.py
+        return load_compressed(params_path)
+    arg_params, aux_params = {}, {}
+    if raw is not None and hasattr(mx.nd, 'load_frombuffer'):
+        save_dict = mx.nd.load_frombuffer(raw)
+    else:  # older MXNet reads the file again, from the page cache
         save_dict = mx.nd.load(params_path)
-        for k, v in save_dict.items():
-            tp, name = k.split(':', 1)
-            if tp == 'arg':
-                self._arg_params[name] = v
-            if tp == 'aux':
-                self._aux_params[name] = v
+    for k, v in save_dict.items():
+        tp, name = k.split(':', 1)
+        if tp == 'arg':
+            arg_params[name] = v
+        if tp == 'aux':
+            aux_params[name] = v
+    return arg_params, aux_params
+
+
+def read_model(symbol_path, params_path, symbol_cache_dir=''):
+    """
+    the bytes of a model, without MXNet, so that several models are read concurrently:
+    (symbol json (upgraded one if cached), its cache path or None, params or None if compressed, seconds)
+    """
+    t0 = time.time()
+    with open(symbol_path, 'rb') as reader:
+        raw_symbol = reader.read()
+    cache_path = _symbol_cache_path(raw_symbol, symbol_cache_dir)
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as reader:
+            raw_symbol, cache_path = reader.read(), None
+    raw_params = None
+    if not is_compressed(params_path):  # memory-mapped by load_compressed
+        with open(params_path, 'rb') as reader:
+            raw_params = reader.read()
+    return raw_symbol, cache_path, raw_params, time.time() - t0
+
+
+def load_model(symbol_path, params_path, symbol_cache_dir='', raw=None):
+    """(symbol, arg_params, aux_params, timings), raw: the result of read_model if already read"""
+    raw_symbol, cache_path, raw_params, read_time = raw or read_model(symbol_path, params_path, symbol_cache_dir)
+    t0 = time.time()
+    symbol = mx.symbol.load_json(raw_symbol.decode('utf-8'))
+    if cache_path is not None:
+        _save_symbol_cache(symbol, cache_path)
+    t1 = time.time()
+    arg_params, aux_params = load_params(params_path, raw_params)
+    t2 = time.time()
+    return symbol, arg_params, aux_params, {'read': read_time, 'symbol': t1 - t0, 'params': t2 - t1}
+
+
+def load_models(symbols, params, symbol_cache_dir='', num_threads=4):
+    """the files are read concurrently, and parsed by MXNet in this thread, its frontend is not thread-safe"""
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        raws = list(executor.map(lambda x: read_model(x[0], x[1], symbol_cache_dir), zip(symbols, params)))
+    return [load_model(symbol, param, symbol_cache_dir, raw) for symbol, param, raw in zip(symbols, params, raws)]
 
-        self._symbol = mx.symbol.load(symbol_path)
+
+class Tester(object):
+    def __init__(self, symbol_path, params_path, data_shape, device_type='gpu', gpus='0', symbol_cache_dir='', model=None,
+                 shared=None):
+        """shared: a Tester of the same model with a larger batch size, whose memory is shared"""
+        self._data_shape = data_shape
+        if model is None:
+            model = load_model(symbol_path, params_path, symbol_cache_dir)
+        self._symbol, self._arg_params, self._aux_params = model[:3]
 
         ctx = [mx.gpu(int(x)) for x in gpus.split(',')] if device_type == 'gpu' else mx.cpu()
 
         self._module = mx.mod.Module(symbol=self._symbol, label_names=None, context=ctx)
         self._module.bind(data_shapes=[('data', self._data_shape)],
                           label_shapes=None,
-                          for_training=False)
+                          for_training=False,
+                          shared_module=shared._module if shared is not None else None)
         self._module.set_params(self._arg_params, self._aux_params, allow_missing=True)
 
+    def warm_up(self):
+        """run a forward without waiting, so that the warm-up of many models overlaps"""
+        self._module.forward(Batch([mx.nd.zeros(self._data_shape)]), is_train=False)
+        return self._module.get_outputs()
+
     def get_output(self, batch_data):
         self._module.forward(Batch([mx.nd.array(batch_data)]), is_train=False)
         output = self._module.get_outputs()
         return output
 
+    def get_probs(self, batch_data):
+        return self.get_output(batch_data)[0].asnumpy()
+
+
+def load_testers(symbols, params, data_shape, device_type='gpu', gpus='0', symbol_cache_dir='', num_threads=4):
+    """read all symbols and params concurrently, bind them, and run one warm-up forward per model"""
+    __t0 = time.time()
+    models = load_models(symbols, params, symbol_cache_dir, num_threads)
+
+    testers, timings = [], []
+    for symbol, model in zip(symbols, models):
+        t0 = time.time()
+        testers.append(Tester(symbol, None, data_shape, device_type=device_type, gpus=gpus, model=model))
+        timings.append(dict(model[3], bind=time.time() - t0))
+
+    for symbol, timing in zip(symbols, timings):
+        logging.info('loaded {} (read:{read:.3f}s, symbol:{symbol:.3f}s, params:{params:.3f}s, bind:{bind:.3f}s)'.format(
+            os.path.basename(symbol), **timing))
+
+    t0 = time.time()  # the warm-ups of the models overlap, so only their total is known
+    outputs = [tester.warm_up() for tester in testers]
+    for outs in outputs:
+        [x.wait_to_read() for x in outs]
+    logging.info('{} models are ready in {:.3f}s (warm-up: {:.3f}s)'.format(
+        len(testers), time.time() - __t0, time.time() - t0))
+    return testers
+
 
 def category_csv_to_dict(category_csv):
     cate2cid, cid2cate = dict(), dict()
@@ -75,128 +214,358 @@ def category_csv_to_dict(category_csv):
     return cate2cid, cid2cate
 
 
-def read_images(bson_path, cut=None, product_unique_md5=False):
-    with open(bson_path, 'rb') as reader:
-        data = bson.decode_file_iter(reader)
-
-        product_count, image_count = 0, 0
-        for c, d in enumerate(data):
-            if cut and c == cut:
-                break
-            product_id = d.get('_id')
-            category_id = d.get('category_id', None)  # This won't be in Test data
-            items = []
-            prod_md5_set = set()
-            for i, pic in enumerate(d['imgs']):
-                img_bytes = pic['picture']
-                h = hashlib.md5(img_bytes).hexdigest()
-                if product_unique_md5 and h in prod_md5_set:
-                    continue
-                prod_md5_set.add(h)
-                item = (product_id, i, img_bytes)
-                items.append(item)
-                image_count += 1
-            product_count += 1
-            yield items  # list of [id, picture, label, [label,]]
+def read_images(bson_path, cut=None, product_unique_md5=False, offset=0, start=0, skip=()):
+    """products from the one at offset (the start-th of the file), except the skip-th ones"""
+    data = (bson.BSON(raw).decode() for _, raw in utils.iter_bson_raw(bson_path, offset))
+
+    product_count, image_count = 0, 0
+    for c, d in enumerate(data, start=start):
+        if cut and c >= cut:
+            break
+        if c in skip:
+            continue
+        product_id = d.get('_id')
+        category_id = d.get('category_id', None)  # This won't be in Test data
+        items = []
+        prod_md5_set = set()
+        for i, pic in enumerate(d['imgs']):
+            img_bytes = pic['picture']
+            h = hashlib.md5(img_bytes).digest()
+            if product_unique_md5 and h in prod_md5_set:
+                continue
+            prod_md5_set.add(h)
+            item = (product_id, i, img_bytes)
+            items.append(item)
+            image_count += 1
+        product_count += 1
+        yield items, prod_md5_set  # list of [id, picture, label, [label,]], md5 digests
     logging.info('read finished (product:{}, image:{})'.format(product_count, image_count))
 
 
-def _func_reader(args):
-    context = zmq.Context()
-    zmq_socket = context.socket(zmq.PUSH)
-    zmq_socket.set_hwm(1)
-    zmq_socket.bind('tcp://0.0.0.0:{port}'.format(port=args.zmq_port))
-    logging.info('reader started (port: {port})'.format(port=args.zmq_port))
+def _shard_range(args, num_products):
+    """[begin, end) of the products (in bson order) of this shard, limited by --cut"""
+    begin = num_products * args.shard_index // args.num_shards
+    end = num_products * (args.shard_index + 1) // args.num_shards
+    if args.cut:
+        begin, end = min(begin, args.cut), min(end, args.cut)
+    return begin, end
 
-    product_count = 0
-    for items in read_images(args.bson, args.cut, args.product_unique_md5):
-        zmq_socket.send_pyobj(items)
-        product_count += 1
 
-    for _ in range(args.num_procs):
-        zmq_socket.send_pyobj(None)
+def _get_metrics(args, stage, local=False):
+    """MetricsPublisher of a stage, publishing to the predictor if --metrics-output is given"""
+    port = args.zmq_port+2 if args.metrics_output and not local else None
+    return MetricsPublisher(stage, port, args.metrics_interval)
 
-    logging.info('reader finished (product: {})'.format(product_count))
 
+def _func_reader(args, stop_event, counters):
+    """
+    serve the products to the processors, one product for each request, so a processor never holds more than one.
+    after the last product, every request is answered with None until stop_event is set.
+    """
+    context = zmq.Context()
+    zmq_socket = context.socket(zmq.ROUTER)
+    zmq_socket.bind('tcp://0.0.0.0:{port}'.format(port=args.zmq_port))
+    logging.info('reader started (port: {port})'.format(port=args.zmq_port))
 
-def _do_forward(models, batch_data, batch_ids, batch_raw, cate3_dict, md5_dict=None, md5_type=None, cate_level=3):
-    probs_dict = defaultdict(lambda: defaultdict(list))
-    for model_id, model in enumerate(models):
-        output = model.get_output(batch_data)
-        probs = output[0].asnumpy()
+    # products found in the index skip the processors, and the end of input is told to the predictor directly
+    ext_socket = context.socket(zmq.PUSH)
+    ext_socket.set_hwm(args.reader_hwm or args.batch_size)
+    ext_socket.connect('tcp://0.0.0.0:{port}'.format(port=args.zmq_port+1))
+    index = product_index.load_index(args.product_index) if args.product_index else None
+
+    begin, end, offset, skip = 0, args.cut or None, 0, ()
+    if args.num_shards > 1:
+        offsets = utils.get_bson_offsets(args.bson)
+        begin, end = _shard_range(args, len(offsets))
+        offset = offsets[begin] if begin < len(offsets) else None
+        logging.info('shard {}/{}: products [{}, {})'.format(args.shard_index, args.num_shards, begin, end))
+    if args.resume:
+        state = load_checkpoint(args.output + '.ckpt')
+        begin, offset, skip = state['seq'], state['offset'], set(state['skip'])
+    if offset is None or (end is not None and begin >= end):
+        products = iter(())
+    else:
+        products = read_images(args.bson, end, args.product_unique_md5, offset, begin, skip)
+
+    metrics = _get_metrics(args, 'reader')
+    product_count, known_count, sent_count = 0, 0, 0
+    t0 = time.time()
+    for items, digests in products:
+        metrics.observe('read_seconds', time.time() - t0)
+        metrics.inc('products_read')
+        metrics.inc('images_read', len(items))
+        product_count += 1
+        if index is not None and items:
+            cate_ids, _ = product_index.lookup(index, [product_index.product_signature(digests)])
+            if cate_ids[0] >= 0:
+                ext_socket.send_pyobj(KnownProduct(items[0][0], int(cate_ids[0]), len(items)))
+                known_count += 1
+                metrics.inc('products_known')
+                t0 = time.time()
+                continue
+        with metrics.timer('send_wait_seconds'):
+            identity, _ = zmq_socket.recv_multipart()  # a request of a processor
+            zmq_socket.send_multipart([identity, pickle.dumps(items)])
+        sent_count += 1
+        _add(counters.dispatched, 1)
+        metrics.inc('products_sent')
+        metrics.publish()
+        t0 = time.time()
+
+    ext_socket.send_pyobj(ReaderDone(sent_count))
+    counters.input_done.value = 1
+    metrics.close()
+    logging.info('reader finished (product: {}, known: {})'.format(product_count, known_count))
+
+    while not stop_event.is_set():
+        if zmq_socket.poll(100):
+            identity, _ = zmq_socket.recv_multipart()
+            zmq_socket.send_multipart([identity, pickle.dumps(None)])
+
+
+def _read_tensor_cache(args, seq_of):
+    """
+    the input of the predictor read from --tensor-cache instead of the reader and the processors:
+    the views of each product (as decode_images, with md5 hexdigests for the bytes), KnownProduct, then ReaderDone
+    """
+    rows, cache = load_cache(args.tensor_cache)
+    check_cache(cache, [int(x) for x in args.data_shape.split(',')], args.resize, args.multi_view,
+                args.product_unique_md5)
+    product_ids, starts = cache['product_ids'], cache['starts']
+    if [seq_of.get(x) for x in product_ids.tolist()] != list(range(len(product_ids))):
+        raise ValueError('the tensor cache is not of the products of {}'.format(args.bson))
+    begin, end = _shard_range(args, len(seq_of))
+    if end > len(product_ids):
+        raise ValueError('the tensor cache has {} products, {} are predicted'.format(len(product_ids), end))
+    skip = ()
+    if args.resume:
+        state = load_checkpoint(args.output + '.ckpt')
+        begin, skip = state['seq'], set(state['skip'])
+    index = product_index.load_index(args.product_index) if args.product_index else None
+
+    sent_count = 0
+    for seq in range(begin, end):
+        if seq in skip:
+            continue
+        product_id = int(product_ids[seq])
+        digests = [x.tobytes() for x in cache['md5'][starts[seq]:starts[seq + 1]]]
+        if index is not None and digests:
+            cate_ids, _ = product_index.lookup(index, [product_index.product_signature(digests)])
+            if cate_ids[0] >= 0:
+                num_images = len(set(cache['image_ids'][starts[seq]:starts[seq + 1]].tolist()))
+                yield KnownProduct(product_id, int(cate_ids[0]), num_images)
+                continue
+        yield [(rows[r], product_id, int(cache['image_ids'][r]), digest.hex())
+               for r, digest in zip(range(starts[seq], starts[seq + 1]), digests)]
+        sent_count += 1
+    yield ReaderDone(sent_count)
+
+
+def _md5_prob(num_classes, h, cates, md5_dict, md5_type, cate_level=3):
+    """probability of an image given by the md5 dictionary, None if the dictionary does not decide it"""
+    if h not in md5_dict:
+        return None
+    counter = md5_dict[h]
+    if (md5_type == 'unique' and len(counter) == 1) or md5_type == 'majority':  # unique: BEST!
+        labels, counts = [counter.most_common(1)[0][0]], [1.0]  # NOTE: 10.0?
+    elif md5_type in ('l1', 'l2', 'softmax'):
+        labels, counts = zip(*counter.items())
+    else:
+        return None
+
+    classes, counts = cates.to_class(labels, cate_level), np.asarray(counts, dtype=np.float64)
+    known = classes >= 0  # category ids missing from category_names.csv are dropped
+    if not known.any():
+        return None
+    classes, counts = classes[known], counts[known]
+    prob = np.full(num_classes, 0.0)
+    prob[classes] = counts
+    if md5_type == 'l1':
+        prob /= sum(counts)
+    elif md5_type == 'l2':
+        prob /= np.linalg.norm(counts)
+    elif md5_type == 'softmax':
+        e_p = np.exp(prob - np.max(prob))
+        prob = e_p / e_p.sum()
+    return prob
+
+
+def _label_prob(num_classes, labels, cates, cate_level=3):
+    """l1-normalized probability of Counter({category_id: count}), None if no category id is known"""
+    cate_ids, counts = zip(*labels.items())
+    classes = cates.to_class(cate_ids, cate_level)
+    known = classes >= 0
+    if not known.any():
+        return None
+    prob = np.full(num_classes, 0.0)
+    prob[classes[known]] = np.asarray(counts, dtype=np.float64)[known]
+    return prob / prob.sum()
+
+
+def _do_forward(models, batch_data, batch_ids, batch_raw, cates, md5_dict=None, md5_type=None, cate_level=3,
+                probs_dict=None, model_offset=0, metrics=None, priors=None, prior_weight=0.0):
+    """
+    batch_raw: the jpeg bytes of the images, or their md5 hexdigests
+    priors: {product_id: {image_id: Counter({category_id: count})}} blended with prior_weight into the
+            probabilities of images not decided by the md5 dictionary
+    """
+    probs_dict = probs_dict if probs_dict is not None else defaultdict(lambda: defaultdict(list))
+    md5_probs = None
+    prior_probs = None
+    for model_id, model in enumerate(models, start=model_offset):
+        t0 = time.time()
+        probs = model.get_probs(batch_data)
+        if metrics is not None:
+            metrics.observe('forward_seconds', time.time() - t0, model=model_id)
+        if md5_dict and md5_probs is None:  # the same for all models
+            md5_probs = [_md5_prob(probs.shape[1], raw if isinstance(raw, str) else hashlib.md5(raw).hexdigest(),
+                                   cates, md5_dict, md5_type, cate_level) for raw in batch_raw]
+        if priors and prior_probs is None:
+            prior_probs = [priors.get(product_id, {}).get(image_id) for product_id, image_id in batch_ids]
+            prior_probs = [_label_prob(probs.shape[1], x, cates, cate_level) if x else None for x in prior_probs]
         for i, (product_id, image_id) in enumerate(batch_ids):
             if product_id is not None:
                 prob = probs[i]  # softmax
-                if md5_dict:
-                    h = hashlib.md5(batch_raw[i]).hexdigest()
-                    if h in md5_dict:
-                        if md5_type == 'unique' and len(md5_dict[h]) == 1:  # BEST!
-                            prob = np.full(probs.shape[1:], 0.0)
-                            most_label, most_count = md5_dict[h].most_common(1)[0]
-                            class_id = cate3_dict[most_label]['cate1_sub_class_id'] if cate_level == 1 else cate3_dict[most_label]['cate3_class_id']
-                            prob[class_id] = 1.0  # NOTE: 10.0?
-                        elif md5_type == 'majority':
-                            prob = np.full(probs.shape[1:], 0.0)
-                            most_label, most_count = md5_dict[h].most_common(1)[0]
-                            class_id = cate3_dict[most_label]['cate1_sub_class_id'] if cate_level == 1 else cate3_dict[most_label]['cate3_class_id']
-                            prob[class_id] = 1.0
-                        elif md5_type == 'l1':
-                            prob = np.full(probs.shape[1:], 0.0)
-                            for cate, cnt in md5_dict[h].items():
-                                class_id = cate3_dict[cate]['cate1_sub_class_id'] if cate_level == 1 else cate3_dict[cate]['cate3_class_id']
-                                prob[class_id] = cnt
-                            prob /= sum(list(md5_dict[h].values()))
-                        elif md5_type == 'l2':
-                            prob = np.full(probs.shape[1:], 0.0)
-                            for cate, cnt in md5_dict[h].items():
-                                class_id = cate3_dict[cate]['cate1_sub_class_id'] if cate_level == 1 else cate3_dict[cate]['cate3_class_id']
-                                prob[class_id] = cnt
-                            prob /= np.linalg.norm(list(md5_dict[h].values()))
-                        elif md5_type == 'softmax':
-                            prob = np.full(probs.shape[1:], 0.0)
-                            for cate, cnt in md5_dict[h].items():
-                                class_id = cate3_dict[cate]['cate1_sub_class_id'] if cate_level == 1 else cate3_dict[cate]['cate3_class_id']
-                                prob[class_id] = cnt
-                            e_p = np.exp(prob - np.max(prob))
-                            prob = e_p / e_p.sum()
+                if md5_probs and md5_probs[i] is not None:
+                    prob = md5_probs[i]
+                elif prior_probs and prior_probs[i] is not None:
+                    prob = (1.0 - prior_weight) * prob + prior_weight * prior_probs[i]
                 probs_dict[product_id][image_id].append((model_id, prob))
     return probs_dict
 
 
+def _product_prob(prod, max_ensemble, mode=0):
+    product_prob = None
+    images_prob = []
+    for image_id, image in prod.items():
+        image_prob = None
+        n = 0
+        for model_id, prob in image:
+            if model_id < max_ensemble:
+                if image_prob is None:
+                    image_prob = np.copy(prob)
+                else:
+                    image_prob = image_prob + prob
+                n += 1
+        image_prob /= n
+        images_prob.append(image_prob)
+
+    for prob in images_prob:
+        if product_prob is None:
+            if mode == 0:
+                product_prob = prob
+            else:
+                product_prob = prob ** mode
+        else:
+            if mode == 0:
+                product_prob = product_prob * prob
+            else:
+                product_prob = product_prob + prob ** mode
+    return product_prob
+
+
 def _predict(probs_dict, max_ensemble, mode=0):
     assert 0 < max_ensemble <= 22
     result = dict()
     for product_id, prod in probs_dict.items():
-        product_prob = None
-        images_prob = []
-        for image_id, image in prod.items():
-            image_prob = None
-            n = 0
-            for model_id, prob in image:
-                if model_id < max_ensemble:
-                    if image_prob is None:
-                        image_prob = np.copy(prob)
-                    else:
-                        image_prob = image_prob + prob
-                    n += 1
-            image_prob /= n
-            images_prob.append(image_prob)
-
-        for prob in images_prob:
-            if product_prob is None:
-                if mode == 0:
-                    product_prob = prob
-                else:
-                    product_prob = prob ** mode
-            else:
-                if mode == 0:
-                    product_prob = product_prob * prob
-                else:
-                    product_prob = product_prob + prob ** mode
-        result[product_id] = int(np.argmax(product_prob))
+        result[product_id] = int(np.argmax(_product_prob(prod, max_ensemble, mode)))
     return result
 
 
+class Cascade(object):
+    """
+    Run the models one after another and stop as soon as a product is confident enough.
+
+    Products wait in the queue of their next stage until a full batch can be forwarded,
+    so every forward is done with real images, not padding.
+    """
+    def __init__(self, testers, thresholds, metric, batch_shape, forward_kwargs):
+        assert len(thresholds) in (1, len(testers) - 1), 'need one threshold for every stage but the last'
+        self._testers = testers
+        self._thresholds = thresholds * (len(testers) - 1) if len(thresholds) == 1 else thresholds
+        self._metric = metric
+        self._batch_shape = batch_shape
+        self._forward_kwargs = forward_kwargs
+        self._batch_data = np.zeros(batch_shape, dtype=np.float32)
+        self._queues = [[] for _ in testers]
+        self._queue_rows = [0 for _ in testers]
+
+        self.input_rows = 0
+        self.forward_rows = 0
+        self.exit_counter = Counter()
+
+    def _confidence(self, product_prob):
+        total = product_prob.sum()
+        if not total > 0:  # e.g. conflicting one-hot probabilities from the md5 dictionary
+            return 0.0
+        product_prob = product_prob / total
+        if self._metric == 'margin':
+            top2 = np.partition(product_prob, -2)[-2:]
+            return top2[1] - top2[0]
+        return product_prob.max()
+
+    def _forward(self, stage, products):
+        batch_ids, batch_raw = [], []
+        for prod in products:
+            self._batch_data[len(batch_ids):len(batch_ids) + len(prod['ids'])] = prod['data']
+            batch_ids.extend(prod['ids'])
+            batch_raw.extend(prod['raw'])
+        batch_ids.extend([(None, None)] * (self._batch_shape[0] - len(batch_ids)))
+        self.forward_rows += len(batch_raw)
+
+        probs_dict = defaultdict(lambda: defaultdict(list))
+        for prod in products:
+            probs_dict[prod['product_id']] = prod['probs']
+        _do_forward([self._testers[stage]], self._batch_data, batch_ids, batch_raw,
+                    probs_dict=probs_dict, model_offset=stage, **self._forward_kwargs)
+
+        finished = []
+        for prod in products:
+            product_prob = _product_prob(prod['probs'], stage + 1)
+            if stage == len(self._testers) - 1 or self._confidence(product_prob) >= self._thresholds[stage]:
+                finished.append((prod['product_id'], int(np.argmax(product_prob)), stage))
+                self.exit_counter[stage] += 1
+            else:
+                finished.extend(self._enqueue(stage + 1, prod))
+        return finished
+
+    def _enqueue(self, stage, prod):
+        finished = []
+        if self._queue_rows[stage] + len(prod['ids']) > self._batch_shape[0]:
+            finished.extend(self._flush_stage(stage))
+        self._queues[stage].append(prod)
+        self._queue_rows[stage] += len(prod['ids'])
+        return finished
+
+    def _flush_stage(self, stage):
+        products = self._queues[stage]
+        self._queues[stage], self._queue_rows[stage] = [], 0
+        return self._forward(stage, products) if products else []
+
+    def push(self, images):
+        """add the images of a product, returns the products finished so far as (product_id, pred, stage)"""
+        if not images:
+            return []
+        self.input_rows += len(images)
+        prod = {
+            'product_id': images[0][1],
+            'data': np.stack([img for img, product_id, image_id, image_raw in images]),
+            'ids': [(product_id, image_id) for img, product_id, image_id, image_raw in images],
+            'raw': [image_raw for img, product_id, image_id, image_raw in images],
+            'probs': defaultdict(list),
+        }
+        return self._enqueue(0, prod)
+
+    def flush(self):
+        finished = []
+        for stage in range(len(self._testers)):
+            finished.extend(self._flush_stage(stage))
+        return finished
+
+    def forwards_per_image(self):
+        return self.forward_rows / max(1, self.input_rows)
+
+
 def _md5_predict(images, cnt, cate3_counter, mode=0):
     if mode >= 1:
         perfect_matches = []
@@ -219,33 +588,110 @@ def _md5_predict(images, cnt, cate3_counter, mode=0):
     return None
 
 
-def _write(writer, product_id, pred, cate3_dict):
-    if writer:
-        cate_id = cate3_dict[pred]['cate_id'] if args.cate_level == 3 else pred
-        writer.write('{0:d},{1:d}\n'.format(product_id, cate_id))
-        writer.flush()
+def _predict_top_k(probs_dict, max_ensemble, k, mode=0):
+    """{product_id: (class ids, normalized scores) of the k best classes}, the first one is the prediction of _predict"""
+    result = dict()
+    for product_id, prod in probs_dict.items():
+        prob = _product_prob(prod, max_ensemble, mode)
+        top = np.argsort(-prob, kind='mergesort')[:k]
+        result[product_id] = (top, prob[top] / prob.sum() if prob.sum() > 0 else prob[top])
+    return result
+
+
+class WriterClient(object):
+    """collects the rows of the outputs and sends them to the writer process, one message per output and batch"""
+    def __init__(self, port):
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.PUSH)
+        self._socket.connect('tcp://0.0.0.0:{port}'.format(port=port))
+        self._rows = defaultdict(lambda: ([], [], []))  # output suffix -> product_ids, class ids, top-k
+
+    def add(self, suffix, product_ids, preds, top_k=None):
+        ids, classes, tops = self._rows[suffix]
+        ids.extend(product_ids)
+        classes.extend(preds)
+        if top_k is not None:
+            tops.extend(top_k)
+
+    def send(self):
+        for suffix, (ids, classes, tops) in self._rows.items():
+            if ids:
+                topk_ids = np.array([x[0] for x in tops], dtype=np.int64) if tops else None
+                topk_scores = np.array([x[1] for x in tops], dtype=np.float32) if tops else None
+                self._socket.send_pyobj(('rows', suffix, np.array(ids, dtype=np.int64), np.array(classes, dtype=np.int64),
+                                         topk_ids, topk_scores))
+        self._rows.clear()
+
+    def checkpoint(self, state):
+        """save the checkpoint after the rows sent before"""
+        self.send()
+        self._socket.send_pyobj(('checkpoint', state))
+
+    def close(self):
+        self.send()
+        self._socket.send_pyobj(None)
+        self._socket.close(linger=-1)
+        self._context.term()
+
+
+def _func_writer(args):
+    """write the outputs in large chunks, flushed every --flush-interval seconds, and save the checkpoints"""
+    cates = get_category_arrays()
+    context = zmq.Context()
+    zmq_socket = context.socket(zmq.PULL)
+    zmq_socket.bind('tcp://0.0.0.0:{port}'.format(port=args.zmq_port+4))
+
+    positions = load_checkpoint(args.output + '.ckpt')['outputs'] if args.resume else None
+    suffixes = [''] + ['.e{}.m{}'.format(_k, _m) for _k in args.ensembles for _m in range(2)]
+    outputs = {suffix: get_output(args.output + suffix, args.output_format, args.top_k if suffix == '' else 0, positions)
+               for suffix in suffixes}
 
+    def _cate_ids(class_ids):
+        return cates.cate_ids[class_ids] if args.cate_level == 3 and class_ids is not None else class_ids
 
-def _func_predict(args):
+    row_count = 0
+    last_flush = time.time()
+    while True:
+        if zmq_socket.poll(args.flush_interval * 1000):
+            message = zmq_socket.recv_pyobj()
+            if message is None:
+                break
+            if message[0] == 'rows':
+                _, suffix, product_ids, preds, topk_ids, topk_scores = message
+                outputs[suffix].write(product_ids, _cate_ids(preds), _cate_ids(topk_ids), topk_scores)
+                row_count += len(product_ids)
+            elif message[0] == 'checkpoint':
+                [x.flush() for x in outputs.values()]
+                save_checkpoint(args.output + '.ckpt', message[1], outputs.values())
+                last_flush = time.time()
+        if time.time() - last_flush >= args.flush_interval:
+            [x.flush() for x in outputs.values()]
+            last_flush = time.time()
+
+    [x.close() for x in outputs.values()]
+    logging.info('writer finished ({} rows in {} outputs)'.format(row_count, len(outputs)))
+
+
+def _func_predict(args, counters):
     # cate2cid, cid2cate = category_csv_to_dict(args.csv)
-    cate1_dict, cate2_dict, cate3_dict = get_category_dict()
+    collector = None
+    if args.metrics_output:  # bind before loading models, not to miss the first snapshots
+        collector = MetricsCollector(args.zmq_port+2, args.metrics_output, args.metrics_format, args.metrics_interval)
+    metrics = _get_metrics(args, 'predictor', local=True)
+
+    cates = get_category_arrays()
 
     md5_dict = pickle.load(open(args.md5_dict_pkl, 'rb')) if args.md5_dict_pkl else None
-    ground_truths = dict()
-    cate3_counter = Counter()
-    with open(args.bson, 'rb') as reader:
-        for d in bson.decode_file_iter(reader):
-            prod_id = d.get('_id')
-            cate_id = d.get('category_id')
-            if cate_id is None:
-                continue
-            cate1, cate2, cate3 = cate3_dict[cate_id]['names']
-            if args.cate_level == 1:
-                ground_truths[prod_id] = cate1_dict[(cate1,)]['child_cate3'][cate_id]
-            elif args.cate_level == 3:
-                cate3_class_id = cate3_dict[cate_id]['cate3_class_id']
-                ground_truths[prod_id] = cate3_class_id
-                cate3_counter[cate3_class_id] += 1
+    prod_ids, cate_ids = [], []
+    offsets, seq_of = [], dict()  # for checkpoints
+    for offset, raw in utils.iter_bson_raw(args.bson):  # only the labels are decoded
+        fields = utils.decode_fields(raw)
+        seq_of[fields['_id']] = len(offsets)
+        offsets.append(offset)
+        if fields['category_id'] is not None:
+            prod_ids.append(fields['_id'])
+            cate_ids.append(fields['category_id'])
+    ground_truths = dict(zip(prod_ids, cates.to_class(cate_ids, args.cate_level).tolist()))
 
     logging.info('ground_truths: {}'.format(len(ground_truths)))
 
@@ -253,50 +699,160 @@ def _func_predict(args):
     batch_shape = [args.batch_size] + data_shape
     logging.info('batch_shape: {}'.format(batch_shape))
 
+    pool = None
     testers = []
-    for symbol, params in zip(args.symbol, args.params):
-        logging.info('load: {}'.format(symbol))
-        testers.append(Tester(symbol, params, batch_shape, gpus=args.gpus))
+    if args.device_type == 'cpu' and args.cpu_replicas > 0:
+        pool = ReplicaPool(args.symbol, args.params, batch_shape, args.cpu_replicas, args.cpu_threads, args.zmq_port+10,
+                           symbol_cache_dir=args.symbol_cache_dir)
+        testers = pool.models
+    else:
+        testers = load_testers(args.symbol, args.params, batch_shape, device_type=args.device_type, gpus=args.gpus,
+                               symbol_cache_dir=args.symbol_cache_dir, num_threads=args.load_threads)
 
     context = zmq.Context()
     ext_socket = context.socket(zmq.PULL)
-    ext_socket.set_hwm(args.batch_size)
+    ext_socket.set_hwm(args.processor_hwm or args.batch_size)
     ext_socket.bind('tcp://0.0.0.0:{port}'.format(port=args.zmq_port+1))
     logging.info('tester started (port: {port})'.format(port=args.zmq_port+1))
-
-    writer = open(args.output, 'w') if args.output else None
-    if writer:
-        writer.write('_id,category_id\n')  # csv header
-
-    ensemble_writer = dict()
-    for _k in args.ensembles:
-        for _m in range(2):
-            w = open(args.output + f'.e{_k}.m{_m}', 'w') if args.output else None
-            if w:
-                w.write('_id,category_id\n')  # csv header
-                ensemble_writer[(_k, _m)] = w
+    receive = ext_socket.recv_pyobj
+    if args.tensor_cache:
+        receive = functools.partial(next, _read_tensor_cache(args, seq_of))
+
+    writer = None
+    checkpoint = None
+    ensemble_suffixes = {(_k, _m): '.e{}.m{}'.format(_k, _m) for _k in args.ensembles for _m in range(2)}
+    if args.output:
+        writer = WriterClient(args.zmq_port+4)
+        if args.checkpoint_interval > 0:
+            state = load_checkpoint(args.output + '.ckpt') if args.resume else None
+            checkpoint = Checkpoint(offsets, seq_of, args.checkpoint_interval, state,
+                                    start=_shard_range(args, len(offsets))[0])
 
     __t0 = time.time()
-    batch_data = np.zeros(batch_shape)
+    batch_data = np.zeros(batch_shape, dtype=np.float32)
     batch_ids, batch_raw = [], []
-    term_count = 0
     product_count = 0
     correct_count = 0
     catetory_count_dict, correct_count_dict = Counter(), Counter()
     incorrect_count_dict = defaultdict(Counter)
 
-    total_count = utils.get_bson_count(args.bson)
-    bar = tqdm(total=total_count, unit='products')
+    def _account(product_id, pred, top_k=None):
+        nonlocal correct_count
+        correct = 0
+        if product_id in ground_truths:
+            label = ground_truths.get(product_id)
+            catetory_count_dict[label] += 1
+            if label == pred:  # correct
+                correct = 1
+                correct_count += 1
+                correct_count_dict[label] += 1
+            else:
+                incorrect_count_dict[label][pred] += 1
+        if writer is not None:
+            writer.add('', [product_id], [pred], None if top_k is None else [top_k])
+        if checkpoint is not None:  # the ensemble outputs are written before
+            checkpoint.done(product_id)
+        priors.pop(product_id, None)
+        return correct
+
+    phash = phash_index.load_index(args.phash_index) if args.phash_index else None
+    priors = dict()  # --phash-mode prior, {product_id: {image_id: labels}}
+    phash_count, prior_count = 0, 0
+
+    def _predict_known(product_id, cate_id):
+        """a product decided without inference, by the product index or near-duplicates"""
+        pred = int(cates.to_class(cate_id, args.cate_level))
+        if writer is not None:
+            for suffix in ensemble_suffixes.values():
+                writer.add(suffix, [product_id], [pred])
+        top_k = (np.full(args.top_k, pred), np.zeros(args.top_k, dtype=np.float32)) if args.top_k else None
+        if top_k is not None:
+            top_k[1][0] = 1.0
+        _account(product_id, pred, top_k)
+
+    cascade = None
+    stage_correct = Counter()
+    if args.cascade:
+        assert not args.ensembles, '--ensembles is not supported with --cascade'
+        cascade = Cascade(testers, args.cascade_thresholds, args.cascade_metric, batch_shape,
+                          dict(cates=cates, md5_dict=md5_dict, md5_type=args.md5_dict_type, cate_level=args.cate_level,
+                               metrics=metrics, priors=priors, prior_weight=args.phash_weight))
+
+    known_count, known_image_count = 0, 0
+    received_count, expected_count = 0, None  # products from the processors, and how many the reader sent them
+
+    begin, end = _shard_range(args, len(offsets))
+    bar = tqdm(total=end - begin, unit='products')
     finished = False
     while not finished:
-        images = ext_socket.recv_pyobj()
+        if collector is not None:
+            collector.update(metrics)
+        if writer is not None:
+            writer.send()
+            if checkpoint is not None and checkpoint.due():
+                writer.checkpoint(checkpoint.state())
+        if received_count == expected_count:
+            images = None  # all products have arrived
+        else:
+            with metrics.timer('recv_wait_seconds'):
+                images = receive()
+        if isinstance(images, ReaderDone):
+            expected_count = images.num_products
+            continue
+        if isinstance(images, KnownProduct):
+            metrics.inc('products_known')
+            _predict_known(images.product_id, images.cate_id)
+            known_count += 1
+            known_image_count += images.num_images
+            product_count += 1
+            bar.update(n=1)
+            continue
+
+        if images is not None:
+            received_count += 1
+            _add(counters.consumed, 1)
+            metrics.inc('products_received')
+
+        if isinstance(images, HashedImages):
+            images, hashes = images
+            with metrics.timer('phash_seconds'):
+                labels, _ = phash_index.nearest_labels(phash, [h for _, h in hashes], args.phash_radius)
+            if args.phash_mode == 'shortcut':
+                cate_ids = set(next(iter(x)) if len(x) == 1 else None for x in labels)
+                if len(cate_ids) == 1 and None not in cate_ids:  # every image is a near-duplicate of one category
+                    metrics.inc('products_phash')
+                    _predict_known(images[0][1], cate_ids.pop())
+                    phash_count += 1
+                    product_count += 1
+                    bar.update(n=1)
+                    continue
+            else:
+                image_labels = {image_id: x for (image_id, _), x in zip(hashes, labels) if x}
+                if image_labels:
+                    priors[images[0][1]] = image_labels
+                    prior_count += len(image_labels)
+
+        if cascade is not None:
+            if images is None:
+                finished = True
+                done = cascade.flush()
+            else:
+                product_count += 1
+                bar.update(n=1)
+                done = cascade.push(images)
+            for product_id, pred, stage in done:
+                stage_correct[stage] += _account(product_id, pred)
+            if done:
+                bar.write('[{0:8d}] acc={1:.6f} forwards/image:{2:.3f} ({3:.1f}products/s)'.format(
+                    product_count, correct_count / product_count, cascade.forwards_per_image(),
+                    product_count / (time.time() - __t0)))
+            continue
+
         pad_forward = False
         if images is None:
             images = []
-            term_count += 1
-            if term_count == args.num_procs:
-                finished = True
-                pad_forward = True
+            finished = True
+            pad_forward = True
         else:
             if len(images) + len(batch_ids) <= args.batch_size:
                 for img, product_id, image_id, image_raw in images:
@@ -310,27 +866,24 @@ def _func_predict(args):
 
         if pad_forward or len(batch_ids) == args.batch_size:
             __t1 = time.time()
-            probs_dict = _do_forward(testers, batch_data, batch_ids, batch_raw, cate3_dict, md5_dict, args.md5_dict_type, args.cate_level)
+            probs_dict = _do_forward(testers, batch_data, batch_ids, batch_raw, cates, md5_dict, args.md5_dict_type, args.cate_level,
+                                     metrics=metrics, priors=priors, prior_weight=args.phash_weight)
             __t2 = time.time()
-            if args.output:
-                for _k in args.ensembles:
-                    for _m in range(2):
-                        preds_dict = _predict(probs_dict, _k, _m)
-                        for product_id, pred in preds_dict.items():
-                            _write(ensemble_writer[(_k, _m)], product_id, pred, cate3_dict)
-
-            preds_dict = _predict(probs_dict, len(testers))
-            for product_id, pred in preds_dict.items():
-                if product_id in ground_truths:
-                    label = ground_truths.get(product_id)
-                    catetory_count_dict[label] += 1
-                    if label == pred:  # correct
-                        correct_count += 1
-                        correct_count_dict[label] += 1
-                    else:
-                        incorrect_count_dict[label][pred] += 1
-                _write(writer, product_id, pred, cate3_dict)
+            if writer is not None:
+                for (_k, _m), suffix in ensemble_suffixes.items():
+                    preds_dict = _predict(probs_dict, _k, _m)
+                    writer.add(suffix, list(preds_dict.keys()), list(preds_dict.values()))
+
+            if args.top_k:
+                for product_id, top_k in _predict_top_k(probs_dict, len(testers), args.top_k).items():
+                    _account(product_id, int(top_k[0][0]), top_k)
+            else:
+                for product_id, pred in _predict(probs_dict, len(testers)).items():
+                    _account(product_id, pred)
             __t3 = time.time()
+            metrics.inc('images_forwarded', len(batch_ids))
+            metrics.observe('batch_seconds', __t1-__t0)
+            metrics.observe('write_seconds', __t3-__t2)
             bar.write('[{0:8d}] acc={1:.6f} batch:{2:.3f}, forward:{3:.3f}, write:{4:.3f} ({5:.1f}images/s)'.format(
                 product_count, correct_count / product_count,
                 __t1-__t0, __t2-__t1, __t3-__t2, len(batch_ids) / (__t3-__t0)))
@@ -348,9 +901,34 @@ def _func_predict(args):
             __t0 = time.time()
 
     logging.info('tester finished (product_count:{0}, accuracy={1:.6f})'.format(
-        product_count, correct_count / product_count))
-    if writer:
+        product_count, correct_count / max(1, product_count)))
+    if args.product_index:
+        logging.info('product index: {0} products ({1} images) skipped decoding, {2} forwards avoided'.format(
+            known_count, known_image_count, known_image_count * (args.multi_view + 1) * len(testers)))
+    if args.phash_index:
+        logging.info('phash index: {0} products predicted by near-duplicates, {1} images with priors'.format(
+            phash_count, prior_count))
+    if pool:
+        pool.close()
+    if writer is not None:
+        if checkpoint is not None:
+            writer.checkpoint(checkpoint.state())
         writer.close()
+    if collector is not None:
+        collector.close(metrics)
+
+    if cascade is not None:
+        logging.info('cascade: {0:.3f} forwards/image with {1} models (x{2:.2f} less than the full ensemble)'.format(
+            cascade.forwards_per_image(), len(testers), len(testers) / max(cascade.forwards_per_image(), 1e-9)))
+        exited, correct = 0, 0
+        for stage in range(len(testers)):
+            exited += cascade.exit_counter[stage]
+            correct += stage_correct[stage]
+            threshold = args.cascade_thresholds[min(stage, len(args.cascade_thresholds) - 1)] if stage < len(testers) - 1 else 0.0
+            logging.info('  stage {0:2d} (threshold:{1:.3f}) exit:{2:8d} stage_acc={3:.6f} cumulative: {4:.4f} of products, acc={5:.6f}'.format(
+                stage, threshold, cascade.exit_counter[stage],
+                stage_correct[stage] / max(1, cascade.exit_counter[stage]),
+                exited / max(1, product_count), correct / max(1, exited)))
 
     if args.print_summary:
         category_accuracy = [(cate, count, correct_count_dict[cate], correct_count_dict[cate] / count)
@@ -372,45 +950,126 @@ def _hwc_to_chw(img):
     return img_chw
 
 
-def _func_processor(args):
+def decode_images(items, data_shape, resize=0, multi_view=0):
+    """views (chw) of the images of a product: [(img, product_id, image_id, img_bytes), ...]"""
+    images = []
+    for product_id, image_id, img_bytes in items:
+        img = cv2.imdecode(np.fromstring(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        if resize > 0:
+            img = cv2.resize(img, (resize, resize), interpolation=cv2.INTER_CUBIC)
+        if multi_view >= 0:
+            images.append((_hwc_to_chw(img), product_id, image_id, img_bytes))
+        if multi_view >= 1:
+            img_flip = cv2.flip(img, flipCode=1)
+            images.append((_hwc_to_chw(img_flip), product_id, image_id, img_bytes))
+        if multi_view >= 2:
+            img_flip = cv2.flip(img, flipCode=0)
+            images.append((_hwc_to_chw(img_flip), product_id, image_id, img_bytes))
+        if multi_view >= 3:
+            img_crop = cv2.resize(img[5:-5, 5:-5, :], tuple(data_shape[1:]))
+            images.append((_hwc_to_chw(img_crop), product_id, image_id, img_bytes))
+    return images
+
+
+def _func_processor(args, stop_event, counters):
+    """decode products requested one by one from the reader, until the reader runs out or stop_event is set (retired)"""
     context = zmq.Context()
-    zmq_socket = context.socket(zmq.PULL)
-    zmq_socket.set_hwm(0)
+    zmq_socket = context.socket(zmq.DEALER)
     zmq_socket.connect('tcp://0.0.0.0:{port}'.format(port=args.zmq_port))
     # logging.info('processor started')
 
     ext_socket = context.socket(zmq.PUSH)
-    ext_socket.set_hwm(args.batch_size)
+    ext_socket.set_hwm(args.processor_hwm or args.batch_size)
     ext_socket.connect('tcp://0.0.0.0:{port}'.format(port=args.zmq_port+1))
 
     data_shape = [int(x) for x in args.data_shape.split(',')]
-
-    while True:
-        items = zmq_socket.recv_pyobj()
+    metrics = _get_metrics(args, 'processor-{}'.format(os.getpid()))
+
+    while not stop_event.is_set():
+        t0 = time.time()
+        with metrics.timer('recv_wait_seconds'):
+            zmq_socket.send(b'')
+            items = zmq_socket.recv_pyobj()
+        _add(counters.starved_ms, int((time.time() - t0) * 1000))
         # logging.info('items: %s' % (None if items is None else len(items),))
         if items is None:
-            logging.info('processor finished')
-            ext_socket.send_pyobj(None)
+            break
+
+        metrics.inc('products_received')
+        t0 = time.time()
+        images = decode_images(items, data_shape, args.resize, args.multi_view)
+        metrics.observe('decode_seconds', time.time() - t0)
+        metrics.inc('images_decoded', len(items))
+        if args.phash_index:  # looked up by the predictor, which holds the index
+            images = HashedImages(images, [(image_id, phash_index.image_dhash(img_bytes))
+                                           for _, image_id, img_bytes in items])
+        with metrics.timer('send_wait_seconds'):
+            ext_socket.send_pyobj(images)
+        _add(counters.processed, 1)
+        metrics.inc('products_sent')
+        metrics.publish()
+
+    logging.info('processor {} (pid: {})'.format('retired' if stop_event.is_set() else 'finished', os.getpid()))
+    metrics.close()
+    ext_socket.close(linger=-1)  # deliver the last products before the process exits
+    zmq_socket.close()
+    context.term()
+
+
+class Supervisor(object):
+    """
+    Add or retire processors to keep the predictor fed with as few of them as possible.
+
+    Every interval, the products decoded but not yet taken by the predictor are compared with the watermarks:
+    below the low one a processor is added (unless the processors wait for the reader), above the high one
+    a processor is retired. A retired processor finishes its product and leaves without losing anything.
+    """
+    def __init__(self, args, counters):
+        self._args = args
+        self._counters = counters
+        self._workers = []  # (process, stop_event)
+        self._retired = []
+        self._last_starved_ms = 0
+        for _ in range(args.num_procs):
+            self.add()
+
+    def add(self):
+        stop_event = Event()
+        proc = Process(target=_func_processor, args=(self._args, stop_event, self._counters))
+        proc.start()
+        self._workers.append((proc, stop_event))
+
+    def retire(self):
+        proc, stop_event = self._workers.pop()
+        stop_event.set()
+        self._retired.append(proc)
+
+    def step(self, interval):
+        args, counters = self._args, self._counters
+        if counters.input_done.value:
             return
+        depth = counters.processed.value - counters.consumed.value
+        starved_ms = counters.starved_ms.value
+        starved = (starved_ms - self._last_starved_ms) / (interval * 1000 * len(self._workers))
+        self._last_starved_ms = starved_ms
+
+        num_procs = len(self._workers)
+        if depth < args.autoscale_low and starved < 0.5 and num_procs < args.max_procs:
+            self.add()
+        elif depth > args.autoscale_high and num_procs > args.min_procs:
+            self.retire()
+        if num_procs != len(self._workers):
+            logging.info('supervisor: {} -> {} processors (queue: {} products, waiting for the reader: {:.0%})'.format(
+                num_procs, len(self._workers), depth, starved))
+
+    def join(self):
+        for proc in [x for x, _ in self._workers] + self._retired:
+            proc.join()
 
-        images = []
-        for product_id, image_id, img_bytes in items:
-            img = cv2.imdecode(np.fromstring(img_bytes, np.uint8), cv2.IMREAD_COLOR)
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            if args.resize > 0:
-                img = cv2.resize(img, (args.resize, args.resize), interpolation=cv2.INTER_CUBIC)
-            if args.multi_view >= 0:
-                images.append((_hwc_to_chw(img), product_id, image_id, img_bytes))
-            if args.multi_view >= 1:
-                img_flip = cv2.flip(img, flipCode=1)
-                images.append((_hwc_to_chw(img_flip), product_id, image_id, img_bytes))
-            if args.multi_view >= 2:
-                img_flip = cv2.flip(img, flipCode=0)
-                images.append((_hwc_to_chw(img_flip), product_id, image_id, img_bytes))
-            if args.multi_view >= 3:
-                img_crop = cv2.resize(img[5:-5, 5:-5, :], tuple(data_shape[1:]))
-                images.append((_hwc_to_chw(img_crop), product_id, image_id, img_bytes))
-        ext_socket.send_pyobj(images)
+    def terminate(self):
+        for proc in [x for x, _ in self._workers] + self._retired:
+            proc.terminate()
 
 
 def main(args):
@@ -420,24 +1079,59 @@ def main(args):
     for _k, _v in vars(args).items():
         logging.info('  {}: {}'.format(_k, _v))
 
-    proc_predict = Process(target=_func_predict, args=(args,))
-    proc_reader = Process(target=_func_reader, args=(args,))
-    proc_processors = [Process(target=_func_processor, args=(args,)) for _ in range(args.num_procs)]
-
+    if args.num_shards > 1:  # own outputs and ports, to run the shards on the same machine as well
+        assert 0 <= args.shard_index < args.num_shards
+        if args.output:
+            args.output = shard_path(args.output, args.shard_index, args.num_shards)
+        args.zmq_port += 100 * args.shard_index
+        logging.info('shard {}/{}: output {}, zmq port {}'.format(args.shard_index, args.num_shards, args.output, args.zmq_port))
+
+    if args.resume and not os.path.exists(args.output + '.ckpt'):  # the last run stopped before its first checkpoint
+        logging.warning('no checkpoint {}, start from the beginning'.format(args.output + '.ckpt'))
+        args.resume = False
+
+    if args.tensor_cache:  # fail before loading the models
+        check_cache(load_cache(args.tensor_cache)[1], [int(x) for x in args.data_shape.split(',')], args.resize,
+                    args.multi_view, args.product_unique_md5)
+
+    counters = _get_counters()
+    reader_stop = Event()
+    proc_predict = Process(target=_func_predict, args=(args, counters))
+    # with --tensor-cache the predictor reads the decoded images itself
+    proc_reader = Process(target=_func_reader, args=(args, reader_stop, counters)) if not args.tensor_cache else None
+    proc_writer = Process(target=_func_writer, args=(args,)) if args.output else None
+
+    supervisor = None
     try:
+        if proc_writer is not None:
+            proc_writer.start()
         proc_predict.start()
-        proc_reader.start()
-        [x.start() for x in proc_processors]
-
-        [x.join() for x in proc_processors]
-        proc_predict.join()
-        proc_reader.join()
+        if proc_reader is not None:
+            proc_reader.start()
+            supervisor = Supervisor(args, counters)
+
+        while proc_predict.is_alive():
+            proc_predict.join(args.autoscale_interval)
+            if args.autoscale and supervisor is not None and proc_predict.is_alive():
+                supervisor.step(args.autoscale_interval)
+
+        if proc_reader is not None:
+            supervisor.join()  # the reader answers the last requests with None
+            reader_stop.set()
+            proc_reader.join()
+        if proc_writer is not None:
+            if proc_predict.exitcode != 0:  # the writer would wait for the predictor forever
+                proc_writer.terminate()
+            proc_writer.join()
     except KeyboardInterrupt:
         logging.warning('Keyboard Interrupted. Terminate all processes.')
-        proc_reader.terminate()
+        if proc_reader is not None:
+            proc_reader.terminate()
         proc_predict.terminate()
-        [x.terminate() for x in proc_processors]
-
+        if proc_writer is not None:
+            proc_writer.terminate()
+        if supervisor is not None:
+            supervisor.terminate()
 
 if __name__ == '__main__':
     import argparse
@@ -446,12 +1140,34 @@ if __name__ == '__main__':
     parser.add_argument('--csv', type=str, required=True)
     parser.add_argument('--params', type=str, nargs='+', required=True)
     parser.add_argument('--symbol', type=str, nargs='+', required=True)
-    parser.add_argument('--batch-size', type=int, required=True)
+    parser.add_argument('--batch-size', type=int, default=0, help='required, on the command line or in --config')
     parser.add_argument('--data-shape', type=str, default='3,180,180')
     parser.add_argument('--gpus', type=str, default='0')
-    parser.add_argument('--num-procs', type=int, default=1)
+    parser.add_argument('--device-type', type=str, default='gpu', choices=['gpu', 'cpu'])
+    parser.add_argument('--cpu-replicas', type=int, default=0, help='number of pinned CPU replicas, 0 runs in-process')
+    parser.add_argument('--cpu-threads', type=int, default=1, help='threads per CPU replica')
+    parser.add_argument('--num-procs', type=int, default=1, help='processors (initial number with --autoscale)')
+    parser.add_argument('--autoscale', action='store_true', help='add or retire processors while running')
+    parser.add_argument('--min-procs', type=int, default=1)
+    parser.add_argument('--max-procs', type=int, default=os.cpu_count())
+    parser.add_argument('--autoscale-interval', type=float, default=5.0, help='seconds')
+    parser.add_argument('--autoscale-low', type=int, default=4,
+                        help='add a processor if less products wait for the predictor')
+    parser.add_argument('--autoscale-high', type=int, default=32,
+                        help='retire a processor if more products wait for the predictor')
     parser.add_argument('--zmq-port', type=int, default=18300)
+    parser.add_argument('--reader-hwm', type=int, default=0,
+                        help='high water mark of the products found in --product-index, which the reader sends '
+                             'to the predictor, 0 for --batch-size')
+    parser.add_argument('--processor-hwm', type=int, default=0,
+                        help='high water mark of the products between the processors and the predictor, 0 for --batch-size')
+    parser.add_argument('--config', type=str, default='',
+                        help='json of option values, e.g. of autotune.py, the command line takes precedence')
     parser.add_argument('--cut', type=int, default=0)
+    parser.add_argument('--load-threads', type=int, default=4, help='number of models loaded concurrently')
+    parser.add_argument('--symbol-cache-dir', type=str,
+                        default=os.path.join(os.path.expanduser('~'), '.cache', 'kaggle-cdiscount', 'symbols'),
+                        help='where upgraded symbols are cached, empty to disable')
 
     parser.add_argument('--cate-level', type=int, default=3)
     parser.add_argument('--md5-dict-pkl', type=str, default='')
@@ -459,13 +1175,66 @@ if __name__ == '__main__':
     parser.add_argument('--resize', type=int, default=0)
     parser.add_argument('--multi-view', type=int, default=0)
     parser.add_argument('--product-unique-md5', action='store_true')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='split the products of the bson into shards, see merge_shards.py')
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help='shard to predict, its outputs get a .shard-<i>-of-<n> suffix and zmq ports +100*i')
+    parser.add_argument('--checkpoint-interval', type=float, default=60.0,
+                        help='seconds between checkpoints to <output>.ckpt, 0 to disable')
+    parser.add_argument('--resume', action='store_true', help='continue from <output>.ckpt')
+    parser.add_argument('--metrics-output', type=str, default='',
+                        help='write metrics of the reader, processors and predictor to this path')
+    parser.add_argument('--metrics-format', type=str, default='jsonl', choices=['jsonl', 'prom'],
+                        help='jsonl: a line per stage appended every interval, prom: prometheus text file')
+    parser.add_argument('--metrics-interval', type=float, default=5.0, help='seconds')
+    parser.add_argument('--product-index', type=str, default='',
+                        help='.npz of data/product_index.py, products found with a single label skip inference')
+    parser.add_argument('--phash-index', type=str, default='',
+                        help='.npz of data/phash_index.py, near-duplicates of training images (see --phash-mode)')
+    parser.add_argument('--phash-radius', type=int, default=4, help='largest Hamming distance of a near-duplicate')
+    parser.add_argument('--phash-mode', type=str, default='shortcut', choices=['shortcut', 'prior'],
+                        help='shortcut: products whose images all are near-duplicates of one category skip inference, '
+                             'prior: the categories of the near-duplicates are blended into the probabilities')
+    parser.add_argument('--phash-weight', type=float, default=0.5, help='weight of the prior with --phash-mode prior')
+    parser.add_argument('--tensor-cache', type=str, default='',
+                        help='read the decoded images from a cache of tensor_cache.py instead of decoding the bson')
 
     parser.add_argument('--output', type=str, default='')
+    parser.add_argument('--output-format', type=str, default='csv', choices=['csv', 'columnar'],
+                        help='columnar: raw int64 arrays <output>.id and <output>.cate, see output.py')
+    parser.add_argument('--top-k', type=int, default=0,
+                        help='also write the k best categories with their scores of the main output')
+    parser.add_argument('--flush-interval', type=float, default=5.0, help='seconds between flushes of the outputs')
     parser.add_argument('--ensembles', type=int, nargs='*', default=[])
     parser.add_argument('--print-summary', action='store_true')
 
     parser.add_argument('--md5-mode', type=int, default=0)
+
+    parser.add_argument('--cascade', action='store_true', help='run models in --symbol order, stop when confident')
+    parser.add_argument('--cascade-thresholds', type=float, nargs='+', default=[0.9],
+                        help='product-level confidence to exit after each stage (one value for all stages)')
+    parser.add_argument('--cascade-metric', type=str, default='max', choices=['max', 'margin'],
+                        help='max probability or margin between top-2 probabilities')
     args = parser.parse_args()
 
+    if args.config:
+        with open(args.config, 'r') as reader:
+            config = json.load(reader)
+        unknown = sorted(set(config) - set(vars(args)))
+        if unknown:
+            parser.error('unknown options in {}: {}'.format(args.config, ', '.join(unknown)))
+        parser.set_defaults(**config)
+        args = parser.parse_args()
+    if args.batch_size <= 0:
+        parser.error('--batch-size is required')
+    if args.resume and not args.output:
+        parser.error('--resume requires --output')
+    if args.resume and args.checkpoint_interval <= 0:
+        parser.error('--resume requires --checkpoint-interval > 0')
+    if args.phash_index and args.tensor_cache:
+        parser.error('--phash-index is not supported with --tensor-cache')
+    if args.top_k and args.cascade:
+        parser.error('--top-k is not supported with --cascade')
+
     main(args)
 
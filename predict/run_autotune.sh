@@ -0,0 +1,24 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+# tune the pipeline options of this host on 2000 products, then: predict.py --config ${ROOT}/predict/$(hostname).json ...
+python3 -u ${ROOT}/predict/autotune.py \
+    --output            ${ROOT}/predict/$(hostname).json \
+    --batch-size        128 256 512 \
+    --num-procs         8 16 24 32 \
+    --reader-hwm        0 1024 \
+    --processor-hwm     0 1024 4096 \
+    --cut               2000 \
+    --warmup            10 \
+    -- \
+    --zmq-port          18400 \
+    --bson              ${ROOT}/data/train_split_val.bson \
+    --csv               ${ROOT}/data/category_names.csv \
+    --params            ${ROOT}/train/M11/se-resnext-101-64x4d-0015.params \
+                        ${ROOT}/train/M10/resnext-101-0019.params \
+    --symbol            ${ROOT}/train/M11/se-resnext-101-64x4d-symbol.json \
+                        ${ROOT}/train/M10/resnext-101-symbol.json \
+    --data-shape        3,180,180 \
+    --gpus              0,1,2,3,4,5,6,7 \
+    --multi-view        1
@@ -0,0 +1,14 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+# throughput of pinned CPU replicas (replicas x threads <= cores)
+python3 -u ${ROOT}/predict/cpu_engine.py \
+    --zmq-port          18310 \
+    --params            ${ROOT}/train/M10/resnext-101-0019.params \
+    --symbol            ${ROOT}/train/M10/resnext-101-symbol.json \
+    --data-shape        3,180,180 \
+    --batch-size        64 \
+    --bench-replicas    1 2 4 8 16 \
+    --bench-threads     1 2 4 8 \
+    --bench-batches     10
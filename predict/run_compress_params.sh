@@ -0,0 +1,16 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+python3 -u ${ROOT}/predict/compress_params.py \
+    --params            ${ROOT}/predict/models/resnext-101-64x4d-model1-0015.params \
+                        ${ROOT}/predict/models/resnext-101-64x4d-model2-0015.params \
+                        ${ROOT}/predict/models/dpn98-0015.params \
+    --symbol            ${ROOT}/predict/models/resnext-101-64x4d-model1-symbol.json \
+                        ${ROOT}/predict/models/resnext-101-64x4d-model2-symbol.json \
+                        ${ROOT}/predict/models/dpn98-symbol.json \
+    --format            float16 \
+    --bson              ${ROOT}/data/train_split_val.bson \
+    --num-products      2000 \
+    --data-shape        3,180,180 \
+    --gpus              0
@@ -0,0 +1,11 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+python3 -u ${ROOT}/predict/fold_bn.py \
+    --symbol            ${ROOT}/predict/models/resnext-101-64x4d-model1-symbol.json \
+    --params            ${ROOT}/predict/models/resnext-101-64x4d-model1-0015.params \
+    --prefix            ${ROOT}/predict/models/resnext-101-64x4d-model1-folded \
+    --data-shape        3,180,180 \
+    --batch-size        8 \
+    --device-type       cpu
@@ -42,20 +42,8 @@ python3 -u ${ROOT}/predict/predict.py \
     --md5-dict-pkl  ${ROOT}/data/train_md5_dict.pkl \
     --md5-dict-type unique \
     --md5-mode      0 \
+    --product-index ${ROOT}/data/train_product_index.npz \
     --multi-view    1 \
     --ensembles     8 11 14 \
     --output        output_ensemble14_20171211.csv
 
-# create output using md5 dictionary
-python3 -u ${ROOT}/predict/md5_predict.py \
-    --train-bson    ${ROOT}/data/train.bson \
-    --test-bson     ${ROOT}/data/test.bson \
-    --md5-dict-pkl  ${ROOT}/data/train_md5_dict.pkl \
-    --output        ${ROOT}/predict/md5_output.txt
-
-
-# overwrite
-python3 -u ${ROOT}/predict/postprocess_product.py \
-    --src           output_ensemble14_20171211.csv.e14.m1 \
-    --dst           output_ensemble14_20171211.csv.e14.m1.md5 \
-    --md5           ${ROOT}/predict/md5_output.txt
@@ -0,0 +1,37 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+OUTPUT=output_sharded.csv
+NUM_SHARDS=4
+GPUS=(0,1 2,3 4,5 6,7)
+
+# one shard for each pair of gpus, on several nodes run a single shard per node with its --shard-index
+for ((i = 0; i < NUM_SHARDS; i++)); do
+    python3 -u ${ROOT}/predict/predict.py \
+        --zmq-port      18400 \
+        --bson          ${ROOT}/data/test.bson \
+        --csv           ${ROOT}/data/category_names.csv \
+        --params        ${ROOT}/train/M14/dpn107-0020.params \
+                        ${ROOT}/train/M13/se-resnext-101-64x4d-seed1-0013.params \
+                        ${ROOT}/train/M12/dpn131-seed1-0017.params \
+        --symbol        ${ROOT}/train/M14/dpn107-symbol.json \
+                        ${ROOT}/train/M13/se-resnext-101-64x4d-seed1-symbol.json \
+                        ${ROOT}/train/M12/dpn131-seed1-symbol.json \
+        --batch-size    512 \
+        --data-shape    3,180,180 \
+        --gpus          ${GPUS[$i]} \
+        --num-procs     6 \
+        --product-index ${ROOT}/data/train_product_index.npz \
+        --multi-view    1 \
+        --ensembles     3 \
+        --num-shards    ${NUM_SHARDS} \
+        --shard-index   ${i} \
+        --output        ${OUTPUT} > ${OUTPUT}.shard-${i}.log 2>&1 &
+done
+wait
+
+# merge in the order of test.bson, fails if a product is missing or duplicated
+python3 -u ${ROOT}/predict/merge_shards.py \
+    --bson          ${ROOT}/data/test.bson \
+    --output        ${OUTPUT} \
+    --num-shards    ${NUM_SHARDS}
@@ -0,0 +1,19 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+# classification service on port 18500, try it with:
+#   python3 -u ${ROOT}/predict/load_serve.py --bson ${ROOT}/data/train_split_val.bson --port 18500
+python3 -u ${ROOT}/predict/serve.py \
+    --port              18500 \
+    --params            ${ROOT}/predict/models/resnext-101-64x4d-model1-0015.params \
+                        ${ROOT}/predict/models/dpn98-0015.params \
+    --symbol            ${ROOT}/predict/models/resnext-101-64x4d-model1-symbol.json \
+                        ${ROOT}/predict/models/dpn98-symbol.json \
+    --data-shape        3,180,180 \
+    --batch-sizes       1 8 32 128 \
+    --max-delay-ms      5 \
+    --gpus              0 \
+    --md5-dict-pkl      ${ROOT}/data/train_md5_dict.pkl \
+    --product-index     ${ROOT}/data/train_product_index.npz \
+    --multi-view        1
@@ -0,0 +1,14 @@
+#!/usr/bin/env bash
+
+# decode the validation bson once, then run_validate.sh with --tensor-cache ${ROOT}/data/train_split_val.cache
+# (the same --data-shape, --resize, --multi-view and --product-unique-md5 as the cache)
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+python3 -u ${ROOT}/predict/tensor_cache.py \
+    --bson              ${ROOT}/data/train_split_val.bson \
+    --cache             ${ROOT}/data/train_split_val.cache \
+    --data-shape        3,180,180 \
+    --resize            0 \
+    --multi-view        1 \
+    --num-procs         24
@@ -0,0 +1,31 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+# accuracy vs. forwards per image for a few cascade thresholds
+for threshold in 0.99 0.95 0.90 0.80
+do
+    python3 -u ${ROOT}/predict/predict.py \
+        --zmq-port              18300 \
+        --bson                  ${ROOT}/data/train_split_val.bson \
+        --csv                   ${ROOT}/data/category_names.csv \
+        --params                ${ROOT}/train/M14/dpn107-0020.params \
+                                ${ROOT}/train/M13/se-resnext-101-64x4d-seed1-0013.params \
+                                ${ROOT}/train/M12/dpn131-seed1-0017.params \
+                                ${ROOT}/train/M11/se-resnext-101-64x4d-0015.params \
+        --symbol                ${ROOT}/train/M14/dpn107-symbol.json \
+                                ${ROOT}/train/M13/se-resnext-101-64x4d-seed1-symbol.json \
+                                ${ROOT}/train/M12/dpn131-seed1-symbol.json \
+                                ${ROOT}/train/M11/se-resnext-101-64x4d-symbol.json \
+        --batch-size            512 \
+        --data-shape            3,180,180 \
+        --gpus                  0,1,2,3,4,5,6,7 \
+        --num-procs             24 \
+        --md5-dict-pkl          ${ROOT}/data/train_split_train_md5.pkl \
+        --md5-dict-type         unique \
+        --multi-view            1 \
+        --cascade \
+        --cascade-metric        max \
+        --cascade-thresholds    ${threshold} \
+        --output                ""
+done
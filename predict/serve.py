@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+"""
+Classification service.
+
+Clients send a product over a ZMQ REQ socket and get its top-k categories (see classify).
+Products found in the product index, or whose images all have one label in the md5 dictionary,
+are answered at once. The others are decoded and queued, and the queue is forwarded as one batch
+when it is full or its oldest product has waited --max-delay-ms. Every model is bound for a few batch
+sizes sharing the same memory, and a batch is forwarded with the smallest one that fits.
+"""
+
+import sys
+import os
+import time
+import json
+import pickle
+import hashlib
+import logging
+from collections import defaultdict
+import coloredlogs
+coloredlogs.install(level=logging.INFO, milliseconds=True)
+
+import cv2
+import numpy as np
+import mxnet as mx
+import zmq
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data.category import get_category_arrays
+from data import product_index
+from predict import load_models, Tester, decode_images, _do_forward, _product_prob
+
+
+def classify(socket, images, top_k=5):
+    """images: jpeg bytes of a product -> {'top_k': [(category_id, prob), ...], 'source': 'index'|'md5'|'model'}"""
+    socket.send_pyobj({'images': images, 'top_k': top_k})
+    return socket.recv_pyobj()
+
+
+def _inference_symbol(symbol):
+    """SoftmaxOutput -> softmax, so that no argument (the label) depends on the batch size"""
+    if json.loads(symbol.tojson())['nodes'][-1]['op'] != 'SoftmaxOutput':
+        return symbol
+    return mx.sym.softmax(symbol.get_children()[0], name=symbol.name)
+
+
+def load_bound_testers(symbols, params, data_shape, batch_sizes, device_type='gpu', gpus='0', symbol_cache_dir='',
+                       num_threads=4):
+    """{batch_size: [Tester of each model]}, the testers of a model share the memory of the largest batch size"""
+    models = load_models(symbols, params, symbol_cache_dir, num_threads)
+
+    batch_sizes = sorted(batch_sizes, reverse=True)
+    testers = defaultdict(list)
+    for symbol, model in zip(symbols, models):
+        model = (_inference_symbol(model[0]),) + tuple(model[1:])
+        shared = None
+        for batch_size in batch_sizes:
+            tester = Tester(symbol, None, [batch_size] + data_shape, device_type=device_type, gpus=gpus, model=model,
+                            shared=shared)
+            shared = shared or tester
+            tester.get_probs(np.zeros([batch_size] + data_shape, dtype=np.float32))  # warm-up
+            testers[batch_size].append(tester)
+    logging.info('{} models are bound for batch sizes {}'.format(len(symbols), sorted(batch_sizes)))
+    return testers
+
+
+class Server(object):
+    def __init__(self, args):
+        self._args = args
+        self._data_shape = [int(x) for x in args.data_shape.split(',')]
+        self._cates = get_category_arrays()
+        self._md5_dict = pickle.load(open(args.md5_dict_pkl, 'rb')) if args.md5_dict_pkl else None
+        self._index = product_index.load_index(args.product_index) if args.product_index else None
+        self._testers = load_bound_testers(args.symbol, args.params, self._data_shape, args.batch_sizes,
+                                           device_type=args.device_type, gpus=args.gpus,
+                                           symbol_cache_dir=args.symbol_cache_dir)
+        self._batch_sizes = sorted(self._testers)
+        self._max_batch_size = self._batch_sizes[-1]
+
+        self._socket = zmq.Context().socket(zmq.ROUTER)
+        self._socket.bind('tcp://0.0.0.0:{port}'.format(port=args.port))
+        logging.info('serving on port {}'.format(args.port))
+
+        self._pending = []  # (identity, key, request, arrival, images)
+        self._pending_rows = 0
+        self._next_key = 0
+        self._latencies, self._batch_rows = [], []
+        self._sources = defaultdict(int)
+
+    def _reply(self, identity, request, arrival, probs, source):
+        top = np.argsort(-probs)[:request.get('top_k', 5)]
+        classes = self._cates.cate_ids[top] if self._args.cate_level == 3 else top
+        reply = {'top_k': [(int(c), float(probs[i])) for c, i in zip(classes, top)], 'source': source}
+        self._socket.send_multipart([identity, b'', pickle.dumps(reply)])
+        self._latencies.append(time.time() - arrival)
+        self._sources[source] += 1
+
+    def _error(self, identity, message):
+        self._socket.send_multipart([identity, b'', pickle.dumps({'error': message})])
+
+    def _known_probs(self, images):
+        """one-hot probabilities if the product index or the md5 dictionary decides the product, else None"""
+        digests = [hashlib.md5(x).digest() for x in images]
+        if self._index is not None and images:
+            cate_ids, _ = product_index.lookup(self._index, [product_index.product_signature(digests)])
+            if cate_ids[0] >= 0:
+                return self._one_hot(cate_ids[0]), 'index'
+        if self._md5_dict is not None and images:
+            labels = [self._md5_dict.get(x.hex()) for x in digests]
+            if all(x is not None and len(x) == 1 for x in labels) and len(set(next(iter(x)) for x in labels)) == 1:
+                return self._one_hot(next(iter(labels[0]))), 'md5'
+        return None, None
+
+    def _one_hot(self, cate_id):
+        class_id = int(self._cates.to_class(cate_id, self._args.cate_level))
+        probs = np.zeros(len(self._cates.cate_ids) if self._args.cate_level == 3 else self._cates.cate1_sub.max() + 1)
+        probs[class_id] = 1.0
+        return probs
+
+    def _receive(self):
+        identity, _, payload = self._socket.recv_multipart()
+        arrival = time.time()
+        request = pickle.loads(payload)
+        if not request['images']:
+            self._error(identity, 'no images')
+            return
+        probs, source = self._known_probs(request['images'])
+        if probs is not None:
+            self._reply(identity, request, arrival, probs, source)
+            return
+
+        key = self._next_key
+        self._next_key += 1
+        items = [(key, i, x) for i, x in enumerate(request['images'])]
+        try:
+            images = decode_images(items, self._data_shape, self._args.resize, self._args.multi_view)
+        except (cv2.error, TypeError, ValueError) as e:  # undecodable bytes, answered without stopping the batches
+            logging.warning('cannot decode a request: {}'.format(str(e).strip()))
+            self._error(identity, 'cannot decode the images: {}'.format(str(e).strip()))
+            return
+        shapes = set(x[0].shape for x in images) - {tuple(self._data_shape)}
+        if shapes:
+            self._error(identity, 'image shapes {} != {}, see --resize'.format(sorted(shapes), self._data_shape))
+            return
+        if len(images) > self._max_batch_size:
+            self._error(identity, '{} views > the largest batch size {}'.format(len(images), self._max_batch_size))
+            return
+        self._pending.append((identity, key, request, arrival, images))
+        self._pending_rows += len(images)
+
+    def _forward(self):
+        """forward the pending products that fit in the largest batch"""
+        batch, rows = [], 0
+        while self._pending and rows + len(self._pending[0][4]) <= self._max_batch_size:
+            batch.append(self._pending.pop(0))
+            rows += len(batch[-1][4])
+        self._pending_rows -= rows
+
+        batch_size = next(x for x in self._batch_sizes if x >= rows)
+        batch_data = np.zeros([batch_size] + self._data_shape, dtype=np.float32)
+        batch_ids, batch_raw = [], []
+        for _, _, _, _, images in batch:
+            for img, key, image_id, img_bytes in images:
+                batch_data[len(batch_ids)] = img
+                batch_ids.append((key, image_id))
+                batch_raw.append(img_bytes)
+        probs_dict = _do_forward(self._testers[batch_size], batch_data, batch_ids, batch_raw, self._cates,
+                                 self._md5_dict, 'unique', self._args.cate_level)
+        for identity, key, request, arrival, _ in batch:
+            probs = _product_prob(probs_dict[key], len(self._args.symbol))
+            self._reply(identity, request, arrival, probs / probs.sum() if probs.sum() > 0 else probs, 'model')
+        self._batch_rows.append(rows)
+
+    def _report(self):
+        if self._latencies:
+            latencies = np.array(self._latencies) * 1000
+            logging.info('{} requests ({}), latency p50:{:.1f}ms p99:{:.1f}ms, {:.1f} rows/batch'.format(
+                len(latencies), ', '.join('{}:{}'.format(k, v) for k, v in sorted(self._sources.items())),
+                np.percentile(latencies, 50), np.percentile(latencies, 99),
+                np.mean(self._batch_rows) if self._batch_rows else 0.0))
+        self._latencies, self._batch_rows = [], []
+        self._sources.clear()
+
+    def run(self):
+        max_delay = self._args.max_delay_ms / 1000
+        last_report = time.time()
+        while True:
+            if self._pending:
+                timeout = max(0, self._pending[0][3] + max_delay - time.time()) * 1000
+            else:
+                timeout = max(0, last_report + self._args.report_interval - time.time()) * 1000
+            if self._socket.poll(timeout):
+                self._receive()
+                while self._pending_rows < self._max_batch_size and self._socket.poll(0):
+                    self._receive()
+            if self._pending and (self._pending_rows >= self._max_batch_size or
+                                  time.time() - self._pending[0][3] >= max_delay):
+                self._forward()
+            if time.time() - last_report >= self._args.report_interval:
+                self._report()
+                last_report = time.time()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--params', type=str, nargs='+', required=True)
+    parser.add_argument('--symbol', type=str, nargs='+', required=True)
+    parser.add_argument('--data-shape', type=str, default='3,180,180')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 128],
+                        help='batch sizes bound in advance, the largest one bounds a batch')
+    parser.add_argument('--max-delay-ms', type=float, default=5.0,
+                        help='the longest time a product waits for others to fill a batch')
+    parser.add_argument('--port', type=int, default=18500)
+    parser.add_argument('--device-type', type=str, default='gpu', choices=['gpu', 'cpu'])
+    parser.add_argument('--gpus', type=str, default='0')
+    parser.add_argument('--symbol-cache-dir', type=str, default=os.path.expanduser('~/.cache/kaggle-cdiscount/symbols'))
+    parser.add_argument('--cate-level', type=int, default=3)
+    parser.add_argument('--md5-dict-pkl', type=str, default='')
+    parser.add_argument('--product-index', type=str, default='')
+    parser.add_argument('--resize', type=int, default=0)
+    parser.add_argument('--multi-view', type=int, default=0)
+    parser.add_argument('--report-interval', type=float, default=10.0, help='seconds')
+    args = parser.parse_args()
+
+    assert len(args.params) == len(args.symbol)
+    Server(args).run()
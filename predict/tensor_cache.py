@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Decoded images of a bson, cached for repeated evaluations (predict.py --tensor-cache).
+
+The views of decode_images (resize and multi-view applied) are stored once as raw uint8:
+
+    <cache>            uint8  (rows, C, H, W), memory-mapped by load_cache
+    <cache>.index.npz  product_ids  int64  (P,)       in bson order, the first P products of the bson
+                       starts       int64  (P + 1,)   rows of the i-th product: [starts[i], starts[i + 1])
+                       image_ids    int32  (rows,)
+                       md5          uint8  (rows, 16) md5 digest of the jpeg of each row
+                       meta         json   data_shape, resize, multi_view, product_unique_md5 and bson
+"""
+
+import sys
+import os
+import json
+import hashlib
+import logging
+from multiprocessing import Pool
+import coloredlogs
+coloredlogs.install(level=logging.INFO)
+
+import numpy as np
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data import utils
+
+
+def _decode_range(job):
+    from predict import read_images, decode_images  # not at the top, predict.py imports this module
+    bson_path, offset, start, count, meta = job
+    product_ids, num_rows, image_ids, digests, data = [], [], [], [], []
+    for items, _ in read_images(bson_path, start + count, meta['product_unique_md5'], offset, start):
+        images = decode_images(items, meta['data_shape'], meta['resize'], meta['multi_view'])
+        product_ids.append(items[0][0])
+        num_rows.append(len(images))
+        for img, _, image_id, img_bytes in images:
+            if list(img.shape) != meta['data_shape']:
+                raise ValueError('image {} of product {} is {}, not --data-shape {} (use --resize)'.format(
+                    image_id, items[0][0], img.shape, meta['data_shape']))
+            image_ids.append(image_id)
+            digests.append(np.frombuffer(hashlib.md5(img_bytes).digest(), dtype=np.uint8))
+            data.append(img)
+    shape = [0] + meta['data_shape']
+    return (np.array(product_ids, dtype=np.int64), np.array(num_rows, dtype=np.int64),
+            np.array(image_ids, dtype=np.int32), np.array(digests, dtype=np.uint8).reshape(-1, 16),
+            np.stack(data) if data else np.zeros(shape, dtype=np.uint8))
+
+
+def build_cache(bson_path, cache_path, data_shape, resize=0, multi_view=0, product_unique_md5=False, cut=0,
+                num_procs=1, chunk_size=1000):
+    offsets = utils.get_bson_offsets(bson_path)
+    if cut:
+        offsets = offsets[:cut]
+    meta = {'data_shape': data_shape, 'resize': resize, 'multi_view': multi_view,
+            'product_unique_md5': product_unique_md5, 'bson': os.path.abspath(bson_path)}
+    jobs = [(bson_path, offsets[i], i, min(chunk_size, len(offsets) - i), meta) for i in range(0, len(offsets), chunk_size)]
+    logging.info('decode {} products of {} with {} processes'.format(len(offsets), bson_path, num_procs))
+
+    product_ids, num_rows, image_ids, digests = [], [], [], []
+    with Pool(num_procs) as pool, open(cache_path, 'wb') as writer:
+        for result in tqdm(pool.imap(_decode_range, jobs), total=len(jobs), unit='chunks'):
+            for x, y in zip((product_ids, num_rows, image_ids, digests), result[:4]):
+                x.append(y)
+            writer.write(np.ascontiguousarray(result[4]).tobytes())
+
+    num_rows = np.concatenate(num_rows) if num_rows else np.zeros(0, dtype=np.int64)
+    index = {
+        'product_ids': np.concatenate(product_ids) if product_ids else np.zeros(0, dtype=np.int64),
+        'starts': np.concatenate([[0], np.cumsum(num_rows)]).astype(np.int64),
+        'image_ids': np.concatenate(image_ids) if image_ids else np.zeros(0, dtype=np.int32),
+        'md5': np.concatenate(digests) if digests else np.zeros((0, 16), dtype=np.uint8),
+        'meta': np.array(json.dumps(meta)),
+    }
+    with open(cache_path + '.index.npz', 'wb') as writer:
+        np.savez(writer, **index)
+    logging.info('saved {} products ({} rows, {:.1f}GB) to {}'.format(
+        len(index['product_ids']), index['starts'][-1], os.path.getsize(cache_path) / 2**30, cache_path))
+
+
+def load_cache(cache_path):
+    """(memmap of the rows, index), see the module docstring"""
+    with np.load(cache_path + '.index.npz') as data:
+        index = {k: data[k] for k in ('product_ids', 'starts', 'image_ids', 'md5')}
+        index['meta'] = json.loads(str(data['meta']))
+    shape = (int(index['starts'][-1]),) + tuple(index['meta']['data_shape'])
+    rows = np.memmap(cache_path, dtype=np.uint8, mode='r', shape=shape) if shape[0] else np.zeros(shape, np.uint8)
+    logging.info('loaded {} products ({} rows) from {}'.format(len(index['product_ids']), shape[0], cache_path))
+    return rows, index
+
+
+def check_cache(index, data_shape, resize, multi_view, product_unique_md5):
+    """raise ValueError if the cache was built with other decoding arguments"""
+    expected = {'data_shape': data_shape, 'resize': resize, 'multi_view': multi_view,
+                'product_unique_md5': product_unique_md5}
+    actual = {k: index['meta'][k] for k in expected}
+    if actual != expected:
+        raise ValueError('the tensor cache was built with {}, not {}'.format(actual, expected))
+
+
+def main(args):
+    build_cache(args.bson, args.cache, [int(x) for x in args.data_shape.split(',')], args.resize, args.multi_view,
+                args.product_unique_md5, args.cut, args.num_procs, args.chunk_size)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bson', type=str, required=True)
+    parser.add_argument('--cache', type=str, required=True, help='path to save, with <cache>.index.npz')
+    parser.add_argument('--data-shape', type=str, default='3,180,180')
+    parser.add_argument('--resize', type=int, default=0)
+    parser.add_argument('--multi-view', type=int, default=0)
+    parser.add_argument('--product-unique-md5', action='store_true')
+    parser.add_argument('--cut', type=int, default=0)
+    parser.add_argument('--num-procs', type=int, default=8)
+    parser.add_argument('--chunk-size', type=int, default=1000, help='products decoded by a process at once')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Training throughput by kvstore on CPU processes: local and device in a single process, against
+dist_sync and dist_async with 1..N workers started by launch.py, all on the synthetic data of --benchmark 1.
+
+A process's throughput is the mean of the 'Speed: x samples/sec' lines of its log, after the first
+--skip-batches lines (warm-up). The total throughput is the sum over the workers.
+"""
+
+import sys
+import os
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+import re
+import subprocess
+import logging
+import coloredlogs
+coloredlogs.install(level=logging.INFO, milliseconds=True)
+
+from train.launch import launch
+
+SPEED = re.compile(r'Speed: ([0-9.]+) samples/sec')
+
+
+def train_command(args, kv_store):
+    return [sys.executable, os.path.join(BASE_DIR, 'train', 'train_model.py'),
+            '--benchmark', '1', '--kv-store', kv_store, '--gpus', '',
+            '--symbol', 'resnext', '--num-layers', str(args.num_layers), '--num-conv-groups', str(args.num_conv_groups),
+            '--image-shape', args.image_shape, '--num-classes', str(args.num_classes),
+            '--batch-size', str(args.batch_size), '--num-examples', str(args.num_examples),
+            '--num-epochs', '1', '--lr-step-epochs', '10', '--disp-batches', '1']
+
+
+def log_speed(log_path, skip_batches):
+    """mean samples/s of a training log, 0 if it has no speed after the warm-up"""
+    with open(log_path, 'r', errors='replace') as reader:
+        speeds = [float(x) for x in SPEED.findall(reader.read())][skip_batches:]
+    return sum(speeds) / len(speeds) if speeds else 0.0
+
+
+def run_single(args, kv_store):
+    log_path = os.path.join(args.log_dir, kv_store, 'worker-0.log')
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    env = dict(os.environ, OMP_NUM_THREADS=str(args.omp_threads)) if args.omp_threads > 0 else None
+    with open(log_path, 'w') as log:
+        returncode = subprocess.call(train_command(args, kv_store), stdout=log, stderr=subprocess.STDOUT, env=env)
+    if returncode != 0:
+        logging.error('{} exited with {}, see {}'.format(kv_store, returncode, log_path))
+    return [log_speed(log_path, args.skip_batches)]
+
+
+def run_dist(args, kv_store, num_workers):
+    log_dir = os.path.join(args.log_dir, '{}-{}'.format(kv_store, num_workers))
+    exit_codes = launch(train_command(args, kv_store), num_workers, args.num_servers, log_dir=log_dir,
+                        port=args.port, omp_threads=args.omp_threads)
+    if any(exit_codes.values()):
+        logging.error('{} with {} workers failed, see {}'.format(kv_store, num_workers, log_dir))
+    return [log_speed(os.path.join(log_dir, 'worker-{}.log'.format(i)), args.skip_batches) for i in range(num_workers)]
+
+
+def main(args):
+    rows = []
+    for kv_store in args.kv_stores:
+        for num_workers in ([1] if 'dist' not in kv_store else args.num_workers):
+            speeds = run_single(args, kv_store) if 'dist' not in kv_store else run_dist(args, kv_store, num_workers)
+            rows.append((kv_store, num_workers, sum(speeds), sum(speeds) / len(speeds)))
+            logging.info('{} x {}: {:.2f} samples/s'.format(kv_store, num_workers, sum(speeds)))
+
+    base = rows[0][2]
+    print('kv-store\tworkers\tsamples/s\tsamples/s per worker\tx {}'.format(rows[0][0]))
+    for kv_store, num_workers, total, per_worker in rows:
+        print('{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}'.format(kv_store, num_workers, total, per_worker, total / max(base, 1e-9)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kv-stores', type=str, nargs='+', default=['local', 'device', 'dist_sync', 'dist_async'])
+    parser.add_argument('--num-workers', type=int, nargs='+', default=[1, 2, 4], help='of the dist kvstores')
+    parser.add_argument('--num-servers', type=int, default=1)
+    parser.add_argument('--omp-threads', type=int, default=1, help='OMP_NUM_THREADS of each process, 0 to inherit')
+    parser.add_argument('--num-layers', type=int, default=50)
+    parser.add_argument('--num-conv-groups', type=int, default=32)
+    parser.add_argument('--image-shape', type=str, default='3,64,64')
+    parser.add_argument('--num-classes', type=int, default=5270)
+    parser.add_argument('--batch-size', type=int, default=16, help='of each worker')
+    parser.add_argument('--num-examples', type=int, default=1024, help='of an epoch, shared by the workers')
+    parser.add_argument('--skip-batches', type=int, default=2, help='speed lines of each log not measured')
+    parser.add_argument('--port', type=int, default=9091, help='of the scheduler')
+    parser.add_argument('--log-dir', type=str, default='benchmark_kvstore_logs')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Throughput and memory of resnext variants on synthetic data.
+
+Every configuration of the grid (depth, conv groups, squeeze-excitation, image shape) is bound
+in its own process, so the peak resident memory (ru_maxrss) is its own, and it is timed for
+forward only (inference) and forward + backward (training, without the optimizer update).
+The rows are appended to a tsv with the date, the host and the mxnet version to follow them over time.
+"""
+
+import sys
+import os
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+import time
+import socket
+import resource
+import itertools
+import multiprocessing
+import logging
+import coloredlogs
+coloredlogs.install(level=logging.INFO, milliseconds=True)
+
+import numpy as np
+import mxnet as mx
+
+from train.common.data import SyntheticDataIter
+from train.symbols import resnext
+
+COLUMNS = ['date', 'host', 'mxnet', 'device', 'num_layers', 'num_conv_groups', 'squeeze_excitation', 'image_shape',
+           'batch_size', 'params (M)', 'forward (img/s)', 'forward+backward (img/s)', 'peak rss (MB)']
+
+
+def _time(func, num_batches, num_warmup):
+    for _ in range(num_warmup):
+        func()
+    mx.nd.waitall()
+    t0 = time.time()
+    for _ in range(num_batches):
+        func()
+    mx.nd.waitall()
+    return time.time() - t0
+
+
+def measure(config):
+    """(params, forward img/s, forward+backward img/s, peak rss MB) of a configuration, run in a child process"""
+    args, num_layers, num_conv_groups, squeeze_excitation, image_shape = config
+    symbol = resnext.get_symbol(args.num_classes, num_layers, image_shape, num_conv_groups=num_conv_groups,
+                                use_squeeze_excitation=squeeze_excitation, excitation_ratio=args.excitation_ratio)
+    data_shape = tuple(int(x) for x in image_shape.split(','))
+    batch = SyntheticDataIter(args.num_classes, args.batch_size, data_shape, 1).next()
+    ctx = mx.cpu() if args.device_type == 'cpu' else [mx.gpu(int(x)) for x in args.gpus.split(',')]
+
+    arg_shapes, _, _ = symbol.infer_shape(data=(args.batch_size,) + data_shape)
+    num_params = sum(int(np.prod(shape)) for name, shape in zip(symbol.list_arguments(), arg_shapes)
+                     if name not in ('data', 'softmax_label'))
+
+    model = mx.mod.Module(symbol=symbol, context=ctx)
+    model.bind(data_shapes=batch.provide_data, label_shapes=batch.provide_label, for_training=True)
+    model.init_params(initializer=mx.init.Xavier(rnd_type='gaussian', factor_type='in', magnitude=2))
+
+    def _forward():
+        model.forward(batch, is_train=False)
+        for x in model.get_outputs():
+            x.wait_to_read()
+
+    def _forward_backward():
+        model.forward(batch, is_train=True)
+        model.backward()
+        for x in model._exec_group.grad_arrays[0]:
+            x.wait_to_read()
+
+    images = args.batch_size * args.num_batches
+    forward = images / _time(_forward, args.num_batches, args.num_warmup)
+    forward_backward = images / _time(_forward_backward, args.num_batches, args.num_warmup)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on linux
+    return num_params / 1e6, forward, forward_backward, peak
+
+
+def main(args):
+    grid = list(itertools.product(args.num_layers, args.num_conv_groups, args.squeeze_excitation, args.image_shape))
+    common = [time.strftime('%Y-%m-%d %H:%M:%S'), socket.gethostname(), mx.__version__,
+              args.device_type if args.device_type == 'cpu' else 'gpu:' + args.gpus]
+
+    new_file = not os.path.exists(args.output)
+    with open(args.output, 'a') as writer:
+        if new_file:
+            writer.write('\t'.join(COLUMNS) + '\n')
+        print('\t'.join(COLUMNS[4:]))
+        context = multiprocessing.get_context('spawn')  # a fresh process, for its own peak memory
+        for num_layers, num_conv_groups, squeeze_excitation, image_shape in grid:
+            with context.Pool(1) as pool:
+                result = pool.apply(measure, ((args, num_layers, num_conv_groups, bool(squeeze_excitation), image_shape),))
+            row = [num_layers, num_conv_groups, squeeze_excitation, image_shape, args.batch_size,
+                   '{:.2f}'.format(result[0]), '{:.2f}'.format(result[1]), '{:.2f}'.format(result[2]),
+                   '{:.0f}'.format(result[3])]
+            print('\t'.join(str(x) for x in row))
+            writer.write('\t'.join(str(x) for x in common + row) + '\n')
+            writer.flush()
+    logging.info('appended {} rows to {}'.format(len(grid), args.output))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-layers', type=int, nargs='+', default=[50, 101])
+    parser.add_argument('--num-conv-groups', type=int, nargs='+', default=[32, 64])
+    parser.add_argument('--squeeze-excitation', type=int, nargs='+', default=[0, 1], choices=[0, 1])
+    parser.add_argument('--excitation-ratio', type=float, default=1/16)
+    parser.add_argument('--image-shape', type=str, nargs='+', default=['3,160,160', '3,180,180', '3,224,224'])
+    parser.add_argument('--num-classes', type=int, default=5270)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--num-batches', type=int, default=5, help='timed batches of each configuration')
+    parser.add_argument('--num-warmup', type=int, default=1, help='batches before timing')
+    parser.add_argument('--device-type', type=str, default='cpu', choices=['gpu', 'cpu'])
+    parser.add_argument('--gpus', type=str, default='0')
+    parser.add_argument('--output', type=str, default=os.path.join(BASE_DIR, 'train', 'benchmark_symbols.tsv'),
+                        help='tsv to append the results to')
+    args = parser.parse_args()
+
+    main(args)
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import os
+import json
 
+import numpy as np
 import mxnet as mx
 
 
@@ -31,6 +34,15 @@ def add_data_args(parser):
     return data
 
 
+def add_feature_args(parser):
+    feature = parser.add_argument_group('Feature', 'cached embeddings created by extract_features.py')
+    feature.add_argument('--feature-train', type=str, help='the prefix of cached training features')
+    feature.add_argument('--feature-val', type=str, help='the prefix of cached validation features')
+    feature.add_argument('--feature-block-size', type=int, default=65536,
+                         help='number of rows shuffled together, larger is more random but reads less sequentially')
+    return feature
+
+
 def add_data_aug_args(parser):
     aug = parser.add_argument_group(
         'Image augmentations', 'implemented in src/io/image_aug_default.cc')
@@ -66,6 +78,31 @@ def set_data_aug_level(aug, level):
         aug.set_defaults(max_random_rotate_angle=10, max_random_shear_ratio=0.1, max_random_aspect_ratio=0.25)
 
 
+class SyntheticDataIter(mx.io.DataIter):
+    """The same random batch `num_batches` times, to measure the network without the cost of reading and decoding"""
+    def __init__(self, num_classes, batch_size, data_shape, num_batches, dtype='float32',
+                 data_name='data', label_name='softmax_label', seed=0):
+        super(SyntheticDataIter, self).__init__(batch_size)
+        rng = np.random.RandomState(seed)
+        self._data = mx.nd.array(rng.uniform(-1, 1, (batch_size,) + tuple(data_shape)), dtype=dtype)
+        # float32 as the labels of ImageRecordIter, float16 cannot hold every class id above 2048
+        self._label = mx.nd.array(rng.randint(0, num_classes, (batch_size,)), dtype='float32')
+        self._num_batches = num_batches
+        self._cursor = 0
+        self.provide_data = [mx.io.DataDesc(data_name, self._data.shape, dtype)]
+        self.provide_label = [mx.io.DataDesc(label_name, self._label.shape, 'float32')]
+
+    def reset(self):
+        self._cursor = 0
+
+    def next(self):
+        if self._cursor >= self._num_batches:
+            raise StopIteration
+        self._cursor += 1
+        return mx.io.DataBatch(data=[self._data], label=[self._label], pad=0,
+                               provide_data=self.provide_data, provide_label=self.provide_label)
+
+
 def get_rec_iter(args, kv=None):
     image_shape = tuple([int(l) for l in args.image_shape.split(',')])
 
@@ -73,6 +110,13 @@ def get_rec_iter(args, kv=None):
         rank, nworker = (kv.rank, kv.num_workers)
     else:
         rank, nworker = (0, 1)
+    if 'benchmark' in args and args.benchmark:  # as many batches as a shard of the rec
+        num_batches = max(1, args.num_examples // (args.batch_size * nworker))
+        train = SyntheticDataIter(args.num_classes, args.batch_size, image_shape, num_batches,
+                                  dtype=args.dtype if 'dtype' in args else 'float32',
+                                  data_name=args.data_name, label_name=args.label_name)
+        return train, None
+
     rgb_mean = [float(i) for i in args.rgb_mean.split(',')]
     train = mx.io.ImageRecordIter(
         path_imgrec=args.data_train,
@@ -125,3 +169,83 @@ def get_rec_iter(args, kv=None):
         num_parts=nworker,
         part_index=rank)
     return train, val
+
+
+def load_feature_meta(prefix):
+    with open(prefix + '.json', 'r') as reader:
+        return json.load(reader)
+
+
+class FeatureIter(mx.io.DataIter):
+    """Iterate over float16 embeddings cached in `<prefix>.feat` with labels in `<prefix>.label`.
+
+    Rows are read from a memory-mapped file, so the cache does not need to fit in memory.
+    With `shuffle`, blocks of `block_size` rows are visited in random order and shuffled inside the block.
+    """
+    def __init__(self, prefix, batch_size, shuffle=False, block_size=65536,
+                 data_name='data', label_name='softmax_label', num_parts=1, part_index=0):
+        super(FeatureIter, self).__init__(batch_size)
+        meta = load_feature_meta(prefix)
+        num_examples, feature_dim = meta['num_examples'], meta['feature_dim']
+        features = np.memmap(prefix + '.feat', dtype=np.float16, mode='r', shape=(num_examples, feature_dim))
+        labels = np.fromfile(prefix + '.label', dtype=np.float32)
+        assert len(labels) == num_examples, 'broken feature cache: {}'.format(prefix)
+
+        part_size = num_examples // num_parts
+        begin = part_size * part_index
+        end = num_examples if part_index == num_parts - 1 else begin + part_size
+        self._features = features[begin:end]
+        self._labels = labels[begin:end]
+        self._shuffle = shuffle
+        self._block_size = block_size
+        self._order = None
+        self._cursor = 0
+
+        self.num_examples = end - begin
+        self.feature_dim = feature_dim
+        self.provide_data = [mx.io.DataDesc(data_name, (batch_size, feature_dim))]
+        self.provide_label = [mx.io.DataDesc(label_name, (batch_size,))]
+        self.reset()
+
+    def reset(self):
+        if self._shuffle:
+            blocks = [np.arange(x, min(x + self._block_size, self.num_examples))
+                      for x in range(0, self.num_examples, self._block_size)]
+            np.random.shuffle(blocks)
+            for block in blocks:
+                np.random.shuffle(block)
+            self._order = np.concatenate(blocks)
+        else:
+            self._order = np.arange(self.num_examples)
+        self._cursor = 0
+
+    def next(self):
+        if self._cursor >= self.num_examples:
+            raise StopIteration
+        index = self._order[self._cursor:self._cursor + self.batch_size]
+        pad = self.batch_size - len(index)
+        if pad > 0:  # wrap around like ImageRecordIter(round_batch=True)
+            index = np.concatenate([index, self._order[:pad]])
+        self._cursor += self.batch_size
+
+        data = mx.nd.array(self._features[index].astype(np.float32))
+        label = mx.nd.array(self._labels[index])
+        return mx.io.DataBatch(data=[data], label=[label], pad=pad,
+                               provide_data=self.provide_data, provide_label=self.provide_label)
+
+
+def get_feature_iter(args, kv=None):
+    if kv:
+        rank, nworker = (kv.rank, kv.num_workers)
+    else:
+        rank, nworker = (0, 1)
+    train = FeatureIter(args.feature_train, args.batch_size, shuffle=True, block_size=args.feature_block_size,
+                        data_name=args.data_name, label_name=args.label_name,
+                        num_parts=nworker, part_index=rank)
+    if args.feature_val is None:
+        return train, None
+
+    val = FeatureIter(args.feature_val, args.batch_size, shuffle=False,
+                      data_name=args.data_name, label_name=args.label_name,
+                      num_parts=nworker, part_index=rank)
+    return train, val
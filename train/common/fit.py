@@ -24,6 +24,33 @@ def _get_lr_scheduler(args, kv):
     return lr, mx.lr_scheduler.MultiFactorScheduler(step=steps, factor=args.lr_factor)
 
 
+def _get_image_shape_stages(args, begin_epoch):
+    """
+    [(begin_epoch, end_epoch, image_shape, resize), ...] of --image-shape-schedule from begin_epoch,
+    e.g. '0:160,8:180,14:224' with --image-shape 3,224,224, --resize 224 and 20 epochs:
+    [(0, 8, '3,160,160', 160), (8, 14, '3,180,180', 180), (14, 20, '3,224,224', 224)]
+    --resize is scaled with the image size
+    """
+    if 'image_shape_schedule' not in args or not args.image_shape_schedule:
+        return [(begin_epoch, args.num_epochs, args.image_shape, args.resize)]
+    channels, base_size = args.image_shape.split(',')[:2]
+    schedule = []
+    for x in args.image_shape_schedule.split(','):
+        epoch, size = (int(y) for y in x.split(':'))
+        resize = int(round(args.resize * size / int(base_size))) if args.resize > 0 else args.resize
+        schedule.append((epoch, '{0},{1},{1}'.format(channels, size), resize))
+    schedule.sort()
+    assert schedule[0][0] == 0, 'the schedule must start at epoch 0: {}'.format(args.image_shape_schedule)
+
+    stages = []
+    for i, (epoch, image_shape, resize) in enumerate(schedule):
+        end = schedule[i + 1][0] if i + 1 < len(schedule) else args.num_epochs
+        begin, end = max(epoch, begin_epoch), min(end, args.num_epochs)
+        if begin < end:
+            stages.append((begin, end, image_shape, resize))
+    return stages
+
+
 def _load_model(args, rank=0):
     if 'load_epoch' not in args or args.load_epoch is None:
         return None, None, None
@@ -92,6 +119,10 @@ def add_fit_args(parser):
     train.add_argument('--dtype', type=str, default='float32',
                        help='precision: float32 or float16')
     train.add_argument('--eval-metrics', type=str, nargs='+', default=['accuracy'])
+    train.add_argument('--image-shape-schedule', type=str, default='',
+                       help='image size by epoch, e.g. 0:160,8:180,14:224, relative to --image-shape (and --resize). the data '
+                            'iterators are rebuilt and the module is reshaped at each boundary, keeping the '
+                            'parameters and the optimizer states')
     return train
 
 
@@ -112,7 +143,10 @@ def fit(args, network, data_loader, **kwargs):
     for k, v in vars(args).items():
         logging.info('  {}: {}'.format(k, v))
 
-    # data iterators
+    # data iterators, of the first image shape of the schedule
+    stages = _get_image_shape_stages(args, args.load_epoch if args.load_epoch else 0)
+    if stages:
+        args.image_shape, args.resize = stages[0][2:]
     (train, val) = data_loader(args, kv)
     if args.test_io:
         tic = time.time()
@@ -194,18 +228,28 @@ def fit(args, network, data_loader, **kwargs):
         batch_end_callbacks += cbs if isinstance(cbs, list) else [cbs]
 
     # run
-    model.fit(train,
-              begin_epoch=args.load_epoch if args.load_epoch else 0,
-              num_epoch=args.num_epochs,
-              eval_data=val,
-              eval_metric=eval_metrics,
-              kvstore=kv,
-              optimizer=args.optimizer,
-              optimizer_params=optimizer_params,
-              initializer=initializer,
-              arg_params=arg_params,
-              aux_params=aux_params,
-              batch_end_callback=batch_end_callbacks,
-              epoch_end_callback=checkpoint,
-              allow_missing=True,
-              monitor=monitor)
+    for i, (begin_epoch, end_epoch, image_shape, resize) in enumerate(stages):
+        if i > 0:  # parameters and optimizer states are kept, fit does not initialize them again
+            args.image_shape, args.resize = image_shape, resize
+            (train, val) = data_loader(args, kv)
+            model.reshape(data_shapes=train.provide_data, label_shapes=train.provide_label)
+        if len(stages) > 1:
+            logging.info('epoch {} to {}: image shape {}'.format(begin_epoch, end_epoch - 1, image_shape))
+        model.fit(train,
+                  begin_epoch=begin_epoch,
+                  num_epoch=end_epoch,
+                  eval_data=val,
+                  eval_metric=eval_metrics,
+                  kvstore=kv,
+                  optimizer=args.optimizer,
+                  optimizer_params=optimizer_params,
+                  initializer=initializer,
+                  arg_params=arg_params,
+                  aux_params=aux_params,
+                  batch_end_callback=batch_end_callbacks,
+                  epoch_end_callback=checkpoint,
+                  allow_missing=True,
+                  monitor=monitor)
+
+    if 'dist' in args.kv_store:  # no worker leaves before the others are done with the servers
+        kv._barrier()
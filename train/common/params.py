@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compressed parameter files (.cparams), loaded lazily from a memory map.
+
+    8 bytes   magic b'CPARAMS1'
+    8 bytes   uint64 little-endian size of the header
+    header    utf-8 json: {'format': 'float16' | 'int8',
+                           'tensors': {'arg:<name>' | 'aux:<name>': {'dtype', 'shape', 'offset', 'scale_offset'}}}
+    data      the tensors, each aligned to 64 bytes, offsets are from the start of the file
+
+float16: every float32 tensor is stored as float16.
+int8: tensors of 2 or more dimensions (weights) are quantized symmetrically per output channel (axis 0),
+      with a float32 scale per channel at scale_offset; the others (biases, BatchNorm) stay float32.
+
+A tensor is read and dequantized to float32 only when it is looked up, e.g. by Module.set_params.
+"""
+
+import os
+import json
+import struct
+from collections.abc import Mapping
+
+import numpy as np
+import mxnet as mx
+
+MAGIC = b'CPARAMS1'
+ALIGN = 64
+FORMATS = ('float16', 'int8')
+
+
+def is_compressed(path):
+    with open(path, 'rb') as reader:
+        return reader.read(len(MAGIC)) == MAGIC
+
+
+def _quantize(x, fmt):
+    """(stored array, per-channel scales or None)"""
+    if x.dtype != np.float32:
+        return x, None
+    if fmt == 'float16':
+        return x.astype(np.float16), None
+    if x.ndim < 2:
+        return x, None
+    scales = np.abs(x.reshape(len(x), -1)).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    q = np.round(x / scales.reshape((-1,) + (1,) * (x.ndim - 1)))
+    return np.clip(q, -127, 127).astype(np.int8), scales.astype(np.float32)
+
+
+def save_compressed(path, save_dict, fmt='float16'):
+    """save_dict: {'arg:<name>' | 'aux:<name>': NDArray}, as given to mx.nd.save"""
+    assert fmt in FORMATS, fmt
+    tensors, chunks = dict(), []
+    offset = 0
+
+    def _append(array):
+        nonlocal offset
+        offset = -(-offset // ALIGN) * ALIGN
+        chunks.append((offset, array))
+        position = offset
+        offset += array.nbytes
+        return position
+
+    for key in sorted(save_dict):
+        value = save_dict[key]
+        stored, scales = _quantize(value.asnumpy() if isinstance(value, mx.nd.NDArray) else np.asarray(value), fmt)
+        tensors[key] = {'dtype': stored.dtype.name, 'shape': list(stored.shape), 'offset': _append(stored)}
+        if scales is not None:
+            tensors[key]['scale_offset'] = _append(scales)
+
+    header = json.dumps({'format': fmt, 'tensors': tensors}).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+    with open(path + '.tmp', 'wb') as writer:
+        writer.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for position, array in chunks:
+            writer.seek(data_start + position)
+            writer.write(np.ascontiguousarray(array).tobytes())
+    os.replace(path + '.tmp', path)
+
+
+class LazyParams(Mapping):
+    """name -> NDArray (float32) of one kind ('arg' or 'aux'), dequantized from the memory map on lookup"""
+    def __init__(self, buffer, data_start, tensors, kind, ignore_names=()):
+        self._buffer = buffer
+        self._data_start = data_start
+        self._tensors = {k.split(':', 1)[1]: v for k, v in tensors.items()
+                         if k.split(':', 1)[0] == kind and k.split(':', 1)[1] not in ignore_names}
+
+    def _read(self, dtype, shape, offset):
+        count = int(np.prod(shape))
+        start = self._data_start + offset
+        return np.frombuffer(self._buffer, dtype=dtype, count=count, offset=start).reshape(shape)
+
+    def __getitem__(self, name):
+        info = self._tensors[name]
+        x = self._read(info['dtype'], info['shape'], info['offset'])
+        if 'scale_offset' in info:
+            scales = self._read(np.float32, [info['shape'][0]], info['scale_offset'])
+            x = x.astype(np.float32) * scales.reshape((-1,) + (1,) * (x.ndim - 1))
+        return mx.nd.array(x, dtype=np.float32 if x.dtype == np.float16 else x.dtype)
+
+    def __contains__(self, name):  # without reading the tensor, as Mapping would
+        return name in self._tensors
+
+    def __iter__(self):
+        return iter(self._tensors)
+
+    def __len__(self):
+        return len(self._tensors)
+
+
+def load_compressed(path, ignore_names=()):
+    """(arg_params, aux_params) as LazyParams"""
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    header_size = struct.unpack('<Q', buffer[len(MAGIC):len(MAGIC) + 8].tobytes())[0]
+    header = json.loads(buffer[len(MAGIC) + 8:len(MAGIC) + 8 + header_size].tobytes().decode('utf-8'))
+    data_start = -(-(len(MAGIC) + 8 + header_size) // ALIGN) * ALIGN
+    return (LazyParams(buffer, data_start, header['tensors'], 'arg', ignore_names),
+            LazyParams(buffer, data_start, header['tensors'], 'aux', ignore_names))
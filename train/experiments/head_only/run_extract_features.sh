@@ -0,0 +1,17 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+MXNET_CUDNN_AUTOTUNE_DEFAULT=0 python3 -u ${ROOT}/train/extract_features.py \
+    --gpus              0,1,2,3,4,5,6,7 \
+    --symbol            ${ROOT}/train/checkpoints/resnext-101/resnext-101-symbol.json \
+    --params            ${ROOT}/train/checkpoints/resnext-101/resnext-101-0019.params \
+    --feature-layer     flatten0 \
+    --save-prefix       ${ROOT}/data/features/resnext-101-flatten0 \
+    --data-train        ${ROOT}/data/train_split_A_train.rec \
+    --data-val          ${ROOT}/data/train_split_A_val.rec \
+    --image-shape       3,180,180 \
+    --data-nthread      6 \
+    --batch-size        1024 \
+    --rgb-mean          0,0,0 \
+    --rgb-scale         1.0
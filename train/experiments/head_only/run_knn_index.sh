@@ -0,0 +1,21 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+# memory, queries/s, recall@10 and vote accuracy of 8 to 64 bytes/code on the validation embeddings
+python3 -u ${ROOT}/train/knn_index.py \
+    --feature-train     ${ROOT}/data/features/resnext-101-flatten0-train \
+    --feature-val       ${ROOT}/data/features/resnext-101-flatten0-val \
+    --nlist             4096 \
+    --nprobe            16 \
+    --m                 8 16 32 64 \
+    --num-queries       10000 \
+    --benchmark
+
+python3 -u ${ROOT}/train/knn_index.py \
+    --feature-train     ${ROOT}/data/features/resnext-101-flatten0-train \
+    --feature-val       ${ROOT}/data/features/resnext-101-flatten0-val \
+    --index             ${ROOT}/data/features/resnext-101-flatten0-ivfpq32.npz \
+    --nlist             4096 \
+    --nprobe            16 \
+    --m                 32
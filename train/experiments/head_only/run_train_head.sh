@@ -0,0 +1,21 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+python3 -u ${ROOT}/train/train_head.py \
+    --gpus              0 \
+    --kv-store          device \
+    --feature-train     ${ROOT}/data/features/resnext-101-flatten0-train \
+    --feature-val       ${ROOT}/data/features/resnext-101-flatten0-val \
+    --model-prefix      ${ROOT}/train/experiments/head_only/checkpoints/resnext-101-head-smooth0.1 \
+    --export-prefix     ${ROOT}/train/experiments/head_only/checkpoints/resnext-101-smooth0.1 \
+    --optimizer         nadam \
+    --lr                0.0001 \
+    --lr-factor         0.2 \
+    --lr-step-epochs    6,10 \
+    --disp-batches      1000 \
+    --num-epoch         12 \
+    --top-k             5 \
+    --batch-size        1024 \
+    --num-classes       5270 \
+    --smooth-alpha      0.1
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+import time
+import json
+import logging
+import coloredlogs
+coloredlogs.install(level=logging.INFO, milliseconds=True)
+
+import numpy as np
+import mxnet as mx
+
+from train.common import data
+from train.train_model import load_symbol, load_params, get_feature_symbol
+
+
+def get_extract_iter(args, path_imgrec):
+    image_shape = tuple([int(l) for l in args.image_shape.split(',')])
+    rgb_mean = [float(i) for i in args.rgb_mean.split(',')]
+    return mx.io.ImageRecordIter(
+        path_imgrec=path_imgrec,
+        label_width=args.label_width,
+        mean_r=rgb_mean[0],
+        mean_g=rgb_mean[1],
+        mean_b=rgb_mean[2],
+        scale=args.rgb_scale,
+        data_name=args.data_name,
+        label_name=args.label_name,
+        batch_size=args.batch_size,
+        resize=args.resize,
+        inter_method=args.inter_method,
+        data_shape=image_shape,
+        preprocess_threads=args.data_nthreads,
+        rand_crop=False,
+        rand_mirror=False,
+        shuffle=False)
+
+
+def extract(args, module, path_imgrec, save_prefix):
+    if os.path.exists(save_prefix + '.json'):
+        raise FileExistsError(save_prefix + '.json')
+
+    logging.info('extract features: {} -> {}'.format(path_imgrec, save_prefix))
+    data_iter = get_extract_iter(args, path_imgrec)
+    feature_dim = module.output_shapes[0][1][1]
+
+    count = 0
+    tic = time.time()
+    with open(save_prefix + '.feat', 'wb') as feat_writer, open(save_prefix + '.label', 'wb') as label_writer:
+        for i, batch in enumerate(data_iter):
+            module.forward(batch, is_train=False)
+            n = args.batch_size - batch.pad
+            features = module.get_outputs()[0].asnumpy()[:n]
+            features.astype(np.float16).tofile(feat_writer)
+            batch.label[0].asnumpy()[:n].astype(np.float32).tofile(label_writer)
+            count += n
+            if (i + 1) % args.disp_batches == 0:
+                logging.info('Batch [%d]\tSpeed: %.2f samples/sec' % (
+                    i, args.disp_batches * args.batch_size / (time.time() - tic)))
+                tic = time.time()
+
+    meta = {
+        'num_examples': count,
+        'feature_dim': feature_dim,
+        'feature_layer': args.feature_layer,
+        'symbol': os.path.abspath(args.symbol),
+        'params': os.path.abspath(args.params),
+        'image_shape': args.image_shape,
+        'data': os.path.abspath(path_imgrec),
+    }
+    with open(save_prefix + '.json', 'w') as writer:
+        json.dump(meta, writer, indent=2)
+    logging.info('saved {} features ({} dims, {:.1f} MB)'.format(
+        count, feature_dim, count * feature_dim * 2 / 1024 / 1024))
+
+
+def main(args):
+    symbol = get_feature_symbol(load_symbol(args.symbol), args.feature_layer)
+    arg_params, aux_params = load_params(args.params)
+    arg_names, aux_names = set(symbol.list_arguments()), set(symbol.list_auxiliary_states())
+    arg_params = {k: v for k, v in arg_params.items() if k in arg_names}
+    aux_params = {k: v for k, v in aux_params.items() if k in aux_names}
+
+    image_shape = tuple([int(l) for l in args.image_shape.split(',')])
+    devs = mx.cpu() if args.gpus is None or args.gpus == '' else [mx.gpu(int(i)) for i in args.gpus.split(',')]
+    module = mx.mod.Module(symbol=symbol, data_names=[args.data_name], label_names=None, context=devs)
+    module.bind(data_shapes=[(args.data_name, (args.batch_size,) + image_shape)], for_training=False)
+    module.set_params(arg_params, aux_params)
+
+    if args.data_train:
+        extract(args, module, args.data_train, args.save_prefix + '-train')
+    if args.data_val:
+        extract(args, module, args.data_val, args.save_prefix + '-val')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    data.add_data_args(parser)
+
+    parser.add_argument('--symbol', type=str, required=True, help='.json path of the backbone')
+    parser.add_argument('--params', type=str, required=True, help='.params path of the backbone')
+    parser.add_argument('--feature-layer', type=str, required=True, help='e.g. flatten0')
+    parser.add_argument('--save-prefix', type=str, required=True,
+                        help='features are saved to <prefix>-train.feat and <prefix>-val.feat')
+    parser.add_argument('--gpus', type=str, default='0')
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--disp-batches', type=int, default=100)
+    args = parser.parse_args()
+
+    main(args)
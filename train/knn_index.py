@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+"""
+k-NN label transfer over the embeddings cached by extract_features.py.
+
+The training embeddings are compressed into an IVF-PQ index: a coarse k-means quantizer
+assigns every embedding to one of `nlist` inverted lists, and the residual to its list centroid
+is product-quantized into `m` bytes (one of 256 centroids for each of m sub-vectors).
+A query visits its `nprobe` nearest lists and ranks their codes with per-list lookup tables
+of the distances to the sub-centroids (asymmetric distance), then the labels of the k nearest vote.
+"""
+
+import sys
+import os
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+import time
+import logging
+from collections import Counter
+import coloredlogs
+coloredlogs.install(level=logging.INFO, milliseconds=True)
+
+import numpy as np
+
+from train.common import data
+
+NUM_CENTROIDS = 256  # of each sub-quantizer, codes are uint8
+
+
+def load_features(prefix):
+    """(memmap of the float16 embeddings, labels) of extract_features.py"""
+    meta = data.load_feature_meta(prefix)
+    features = np.memmap(prefix + '.feat', dtype=np.float16, mode='r', shape=(meta['num_examples'], meta['feature_dim']))
+    labels = np.fromfile(prefix + '.label', dtype=np.float32).astype(np.int32)
+    return features, labels
+
+
+def _sq_distances(x, centroids):
+    """squared euclidean distances (len(x), len(centroids))"""
+    return ((x ** 2).sum(axis=1)[:, None] - 2 * x.dot(centroids.T) + (centroids ** 2).sum(axis=1)[None, :])
+
+
+def _assign(x, centroids, chunk_size=65536):
+    return np.concatenate([np.argmin(_sq_distances(x[i:i + chunk_size], centroids), axis=1)
+                           for i in range(0, len(x), chunk_size)]) if len(x) else np.zeros(0, np.int64)
+
+
+def kmeans(x, k, num_iters=20, seed=0):
+    """Lloyd's k-means, empty clusters are restarted from random points"""
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), k, replace=len(x) < k)].copy()
+    for _ in range(num_iters):
+        assign = _assign(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.choice(len(x), empty.sum())]
+    return centroids
+
+
+def _pad(x, dim):
+    x = np.asarray(x, dtype=np.float32)
+    return x if x.shape[1] == dim else np.hstack([x, np.zeros((len(x), dim - x.shape[1]), np.float32)])
+
+
+def _encode(index, x):
+    """(list ids, PQ codes) of the rows of x"""
+    lists = _assign(x, index['coarse'])
+    residuals = (x - index['coarse'][lists]).reshape(len(x), index['m'], -1)
+    codes = np.stack([_assign(residuals[:, j], index['codebooks'][j]) for j in range(index['m'])], axis=1)
+    return lists, codes.astype(np.uint8)
+
+
+def build_index(features, labels, nlist=1024, m=16, train_size=200000, num_iters=20, chunk_size=65536, seed=0):
+    dim = -(-features.shape[1] // m) * m  # padded to a multiple of m
+    rng = np.random.RandomState(seed)
+    sample = _pad(features[np.sort(rng.choice(len(features), min(train_size, len(features)), replace=False))], dim)
+
+    t0 = time.time()
+    index = {'m': m, 'feature_dim': features.shape[1]}
+    index['coarse'] = kmeans(sample, nlist, num_iters, seed).astype(np.float32)
+    residuals = (sample - index['coarse'][_assign(sample, index['coarse'])]).reshape(len(sample), m, -1)
+    index['codebooks'] = np.stack([kmeans(residuals[:, j], NUM_CENTROIDS, num_iters, seed + j)
+                                   for j in range(m)]).astype(np.float32)
+    logging.info('trained {} lists and {} x {} sub-centroids on {} rows in {:.1f}s'.format(
+        nlist, m, NUM_CENTROIDS, len(sample), time.time() - t0))
+
+    lists, codes = [], []
+    for i in range(0, len(features), chunk_size):
+        chunk_lists, chunk_codes = _encode(index, _pad(features[i:i + chunk_size], dim))
+        lists.append(chunk_lists)
+        codes.append(chunk_codes)
+    lists = np.concatenate(lists)
+    order = np.argsort(lists, kind='mergesort')
+    index['codes'] = np.concatenate(codes)[order]
+    index['labels'] = np.asarray(labels, dtype=np.int32)[order]
+    index['ids'] = order.astype(np.int64)  # rows in the feature cache
+    index['list_starts'] = np.searchsorted(lists[order], np.arange(nlist + 1))
+    logging.info('encoded {} rows in {:.1f}s'.format(len(features), time.time() - t0))
+    return index
+
+
+def save_index(index, path):
+    with open(path, 'wb') as writer:
+        np.savez(writer, **index)
+    logging.info('saved {} rows ({:.1f} MB of codes) to {}'.format(
+        len(index['codes']), index['codes'].nbytes / 1024 / 1024, path))
+
+
+def load_index(path):
+    with np.load(path) as data:
+        index = {k: data[k] for k in data.files}
+    index['m'] = int(index['m'])
+    logging.info('loaded {} rows, {} lists, {} bytes/code from {}'.format(
+        len(index['codes']), len(index['coarse']), index['m'], path))
+    return index
+
+
+def _merge_top_k(best_distances, best_rows, distances, rows, k):
+    """the k smallest of best (n, k) and of distances (n, c) whose columns are rows (c,), unsorted"""
+    if distances.shape[1] > k:
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        distances, rows = np.take_along_axis(distances, top, axis=1), rows[top]
+    else:
+        rows = np.broadcast_to(rows, distances.shape)
+    distances, rows = np.hstack([best_distances, distances]), np.hstack([best_rows, rows])
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(distances, top, axis=1), np.take_along_axis(rows, top, axis=1)
+
+
+def _group_bounds(sorted_values):
+    """(values, begins, ends) of the runs of a sorted array"""
+    values, begins = np.unique(sorted_values, return_index=True)
+    return values, begins, np.append(begins[1:], len(sorted_values))
+
+
+def _sort_top_k(distances, rows):
+    order = np.argsort(distances, axis=1, kind='mergesort')
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+
+def search(index, queries, k=10, nprobe=8):
+    """
+    (rows in the feature cache, approximate squared distances) of the k nearest neighbors, (len(queries), k).
+    the queries are grouped by probed list, and the lookup tables of all the queries of a list are computed at once.
+    """
+    m, coarse, codebooks = index['m'], index['coarse'], index['codebooks']
+    queries = _pad(queries, coarse.shape[1])
+    nprobe = min(nprobe, len(coarse))
+    coarse_distances = _sq_distances(queries, coarse)
+    probes = np.argpartition(coarse_distances, nprobe - 1, axis=1)[:, :nprobe] if nprobe < len(coarse) else \
+        np.arange(len(coarse))[None, :].repeat(len(queries), axis=0)
+    rows = np.full((len(queries), k), -1, dtype=np.int64)
+    distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+
+    probed_lists, query_ids = probes.ravel(), np.arange(len(queries)).repeat(nprobe)
+    order = np.argsort(probed_lists, kind='mergesort')
+    probed_lists, query_ids = probed_lists[order], query_ids[order]
+    codebook_norms = (codebooks ** 2).sum(axis=2)  # (m, 256)
+    for l, begin_query, end_query in zip(*_group_bounds(probed_lists)):
+        begin, end = index['list_starts'][l], index['list_starts'][l + 1]
+        if begin == end:
+            continue
+        qs = query_ids[begin_query:end_query]
+        residuals = (queries[qs] - coarse[l]).reshape(len(qs), m, -1)
+        tables = ((residuals ** 2).sum(axis=2)[:, :, None] - 2 * np.einsum('qjd,jcd->qjc', residuals, codebooks) +
+                  codebook_norms[None])  # (queries, m, 256)
+        codes = index['codes'][begin:end]
+        list_distances = np.zeros((len(qs), end - begin), dtype=np.float32)
+        for j in range(m):
+            list_distances += tables[:, j, codes[:, j]]
+        distances[qs], rows[qs] = _merge_top_k(distances[qs], rows[qs], list_distances, np.arange(begin, end), k)
+    distances, rows = _sort_top_k(distances, rows)
+    rows[~np.isfinite(distances)] = -1
+    return rows, distances
+
+
+def vote(index, queries, k=10, nprobe=8, weighted=True, rows=None, distances=None):
+    """labels voted by the k nearest neighbors of each query, weighted by 1 / distance if weighted.
+    rows and distances of a previous search of the queries are reused if given"""
+    if rows is None:
+        rows, distances = search(index, queries, k, nprobe)
+    preds = np.full(len(rows), -1, dtype=np.int32)
+    for q in range(len(rows)):
+        votes = Counter()
+        for row, distance in zip(rows[q], distances[q]):
+            if row >= 0:
+                votes[int(index['labels'][row])] += 1.0 / (1e-6 + distance) if weighted else 1.0
+        if votes:
+            preds[q] = votes.most_common(1)[0][0]
+    return preds
+
+
+def _exact_neighbors(features, queries, k, chunk_size=16384):
+    """rows of the k nearest neighbors by a brute-force scan, keeping a running top-k"""
+    best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+    best_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+    for i in range(0, len(features), chunk_size):
+        d = _sq_distances(queries, np.asarray(features[i:i + chunk_size], dtype=np.float32))
+        best_distances, best_rows = _merge_top_k(best_distances, best_rows, d, np.arange(i, i + d.shape[1]), k)
+    return _sort_top_k(best_distances, best_rows)[1]
+
+
+def benchmark(args):
+    """memory, query throughput, recall@k against the exact neighbors and vote accuracy for each code size"""
+    features, labels = load_features(args.feature_train)
+    queries, query_labels = load_features(args.feature_val)
+    queries = np.asarray(queries[:args.num_queries], dtype=np.float32)
+    query_labels = query_labels[:args.num_queries]
+    exact = _exact_neighbors(features, queries, args.k)
+    logging.info('{} x {} training rows, {} queries'.format(len(features), features.shape[1], len(queries)))
+
+    print('m\tMB (codes)\tbytes/row\tqueries/s\trecall@{0}\tacc (knn)\tacc (exact knn)'.format(args.k))
+    exact_acc = np.mean([Counter(labels[x].tolist()).most_common(1)[0][0] == y for x, y in zip(exact, query_labels)])
+    for m in args.m:
+        index = build_index(features, labels, args.nlist, m, args.train_size, args.num_iters)
+        t0 = time.time()
+        rows, distances = search(index, queries, args.k, args.nprobe)
+        elapsed = time.time() - t0
+        found = index['ids'][np.maximum(rows, 0)]
+        recall = np.mean([len(set(a[r >= 0].tolist()) & set(b.tolist())) / args.k
+                          for a, r, b in zip(found, rows, exact)])
+        preds = vote(index, queries, args.k, args.nprobe, weighted=False, rows=rows, distances=distances)
+        row_bytes = m + index['labels'].itemsize + index['ids'].itemsize
+        print('{}\t{:.1f}\t{}\t{:.1f}\t{:.4f}\t{:.4f}\t{:.4f}'.format(
+            m, index['codes'].nbytes / 1024 / 1024, row_bytes, len(queries) / elapsed, recall,
+            np.mean(preds == query_labels), exact_acc))
+    print('float16 embeddings: {:.1f} MB, {} bytes/row'.format(features.nbytes / 1024 / 1024, features.shape[1] * 2))
+
+
+def main(args):
+    if args.benchmark:
+        benchmark(args)
+        return
+    features, labels = load_features(args.feature_train)
+    index = build_index(features, labels, args.nlist, args.m[0], args.train_size, args.num_iters)
+    save_index(index, args.index)
+    if args.feature_val:
+        queries, query_labels = load_features(args.feature_val)
+        queries, query_labels = queries[:args.num_queries], query_labels[:args.num_queries]
+        preds = np.concatenate([vote(index, queries[i:i + args.batch_size], args.k, args.nprobe)
+                                for i in range(0, len(queries), args.batch_size)])
+        logging.info('knn accuracy on {} rows of {}: {:.6f}'.format(
+            len(queries), args.feature_val, np.mean(preds == query_labels)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feature-train', type=str, required=True,
+                        help='prefix of the training embeddings of extract_features.py, e.g. <prefix>-train')
+    parser.add_argument('--feature-val', type=str, default='', help='prefix of labelled embeddings to evaluate')
+    parser.add_argument('--index', type=str, default='', help='.npz path to save')
+    parser.add_argument('--nlist', type=int, default=1024, help='inverted lists of the coarse quantizer')
+    parser.add_argument('--m', type=int, nargs='+', default=[16],
+                        help='bytes of a code (sub-quantizers), several values with --benchmark')
+    parser.add_argument('--nprobe', type=int, default=8, help='lists visited by a query')
+    parser.add_argument('--k', type=int, default=10, help='neighbors voting')
+    parser.add_argument('--train-size', type=int, default=200000, help='rows to train the quantizers on')
+    parser.add_argument('--num-iters', type=int, default=20, help='k-means iterations')
+    parser.add_argument('--num-queries', type=int, default=1000,
+                        help='validation rows queried, also scanned exactly with --benchmark')
+    parser.add_argument('--batch-size', type=int, default=1024, help='queries voted at once')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare memory, queries/s, recall and accuracy of the --m code sizes on --feature-val')
+    args = parser.parse_args()
+
+    if not args.benchmark and not args.index:
+        parser.error('--index is required unless --benchmark')
+    if args.benchmark and not args.feature_val:
+        parser.error('--benchmark requires --feature-val')
+    main(args)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+Start a distributed training job (--kv-store dist_sync or dist_async) on this machine or over ssh.
+
+The scheduler, the servers and the workers all run the same command, and DMLC_ROLE tells each
+process its role. The scheduler runs here. The servers and the workers are spread over the hosts of
+--hostfile, or all run here without one. fit.py shards the rec between the workers by
+kv.rank / kv.num_workers. The output of each process goes to <log-dir>/<role>-<i>.log.
+
+    python train/launch.py -n 4 -s 2 --log-dir logs -- python3 train/train_model.py --kv-store dist_sync ...
+"""
+
+import sys
+import os
+import time
+import shlex
+import signal
+import socket
+import subprocess
+import logging
+import coloredlogs
+coloredlogs.install(level=logging.INFO, milliseconds=True)
+
+LOCAL_HOSTS = ('localhost', '127.0.0.1')
+
+
+def read_hostfile(path):
+    """hosts, one per line, # for comments"""
+    with open(path, 'r') as reader:
+        return [x.split('#')[0].strip() for x in reader if x.split('#')[0].strip()]
+
+
+def get_env(role, num_workers, num_servers, root_uri, root_port, omp_threads=0):
+    env = {'DMLC_ROLE': role, 'DMLC_PS_ROOT_URI': root_uri, 'DMLC_PS_ROOT_PORT': str(root_port),
+           'DMLC_NUM_WORKER': str(num_workers), 'DMLC_NUM_SERVER': str(num_servers)}
+    if omp_threads > 0:
+        env['OMP_NUM_THREADS'] = str(omp_threads)
+    return env
+
+
+def remote_command(command, env, cwd):
+    """shell command of a process on a host, exec'ed so that it is the process the hangup of its tty reaches"""
+    return 'cd {} && exec env {} {}'.format(shlex.quote(cwd),
+                                           ' '.join('{}={}'.format(k, shlex.quote(v)) for k, v in sorted(env.items())),
+                                           ' '.join(shlex.quote(x) for x in command))
+
+
+def start(command, env, log_path, host=None):
+    """
+    a process of the job, on host over ssh (in the same directory) or here.
+    ssh -tt gives the remote process a tty, so it gets SIGHUP when the local ssh is terminated.
+    """
+    log = open(log_path, 'w')
+    if host is None or host in LOCAL_HOSTS:
+        process = subprocess.Popen(command, env=dict(os.environ, **env), stdout=log, stderr=subprocess.STDOUT)
+    else:
+        process = subprocess.Popen(['ssh', '-tt', '-o', 'StrictHostKeyChecking=no', host,
+                                    remote_command(command, env, os.getcwd())],
+                                   stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+    log.close()  # the child has its own descriptor
+    return process
+
+
+def _tail(path, num_lines=20):
+    with open(path, 'r', errors='replace') as reader:
+        return ''.join(reader.readlines()[-num_lines:])
+
+
+def launch(command, num_workers, num_servers=1, hosts=None, log_dir='.', port=9091, scheduler_host='',
+           omp_threads=0, shutdown_timeout=60.0):
+    """run the job until the workers exit, returns {log name: exit code}"""
+    os.makedirs(log_dir, exist_ok=True)
+    remote = hosts and any(x not in LOCAL_HOSTS for x in hosts)
+    root_uri = scheduler_host or (socket.gethostbyname(socket.gethostname()) if remote else '127.0.0.1')
+    hosts = hosts or [None]
+
+    processes = dict()  # log name -> (process, log path)
+    roles = [('scheduler', 0, None)]
+    roles += [('server', i, hosts[i % len(hosts)]) for i in range(num_servers)]
+    roles += [('worker', i, hosts[i % len(hosts)]) for i in range(num_workers)]
+    for role, i, host in roles:
+        name = '{}-{}'.format(role, i)
+        log_path = os.path.join(log_dir, name + '.log')
+        env = get_env(role, num_workers, num_servers, root_uri, port, omp_threads)
+        processes[name] = (start(command, env, log_path, host), log_path)
+        logging.info('started {} on {} (log: {})'.format(name, host or 'localhost', log_path))
+
+    t0 = time.time()
+    try:
+        for name, (process, _) in processes.items():
+            if name.startswith('worker'):
+                process.wait()
+        deadline = time.time() + shutdown_timeout  # the servers and the scheduler exit after the workers
+        for name, (process, _) in processes.items():
+            try:
+                process.wait(max(0.0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                logging.warning('{} did not exit, terminate it'.format(name))
+                process.terminate()
+                process.wait()
+    except (KeyboardInterrupt, SystemExit):
+        logging.warning('Interrupted. Terminate all processes.')
+        for process, _ in processes.values():
+            process.terminate()
+        raise
+
+    exit_codes = {name: process.returncode for name, (process, _) in processes.items()}
+    logging.info('job finished in {:.1f}s'.format(time.time() - t0))
+    for name, (_, log_path) in processes.items():
+        if exit_codes[name] != 0:
+            logging.error('{} exited with {}, the end of {}:\n{}'.format(name, exit_codes[name], log_path, _tail(log_path)))
+    return exit_codes
+
+
+def main(args):
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))  # terminate the job with the launcher
+    hosts = read_hostfile(args.hostfile) if args.hostfile else None
+    exit_codes = launch(args.command, args.num_workers, args.num_servers, hosts, args.log_dir, args.port,
+                        args.scheduler_host, args.omp_threads, args.shutdown_timeout)
+    if any(exit_codes.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num-workers', type=int, required=True)
+    parser.add_argument('-s', '--num-servers', type=int, default=1)
+    parser.add_argument('-H', '--hostfile', type=str, default='',
+                        help='hosts of the servers and the workers (round-robin), with the repository at the same path. '
+                             'without it, all processes run on this machine')
+    parser.add_argument('--scheduler-host', type=str, default='', help='address of this machine seen by the hosts')
+    parser.add_argument('--port', type=int, default=9091, help='of the scheduler')
+    parser.add_argument('--log-dir', type=str, default='launch_logs')
+    parser.add_argument('--omp-threads', type=int, default=0, help='OMP_NUM_THREADS of each process, 0 to inherit')
+    parser.add_argument('--shutdown-timeout', type=float, default=60.0,
+                        help='seconds the servers and the scheduler may take to exit after the workers')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='the training command, after --')
+    args = parser.parse_args()
+
+    if args.command and args.command[0] == '--':
+        args.command = args.command[1:]
+    if not args.command:
+        parser.error('the training command is required after --')
+    main(args)
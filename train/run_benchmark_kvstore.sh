@@ -0,0 +1,15 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+# samples/s of local and device against dist_sync and dist_async with 1, 2, 4 and 8 worker processes on CPU
+python3 -u ${ROOT}/train/benchmark_kvstore.py \
+    --kv-stores         local device dist_sync dist_async \
+    --num-workers       1 2 4 8 \
+    --num-servers       1 \
+    --omp-threads       1 \
+    --num-layers        50 \
+    --image-shape       3,64,64 \
+    --batch-size        16 \
+    --num-examples      1024 \
+    --log-dir           ${ROOT}/train/benchmark_kvstore_logs
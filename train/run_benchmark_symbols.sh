@@ -0,0 +1,13 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+python3 -u ${ROOT}/train/benchmark_symbols.py \
+    --num-layers            50 101 \
+    --num-conv-groups       32 64 \
+    --squeeze-excitation    0 1 \
+    --image-shape           3,160,160 3,180,180 3,224,224 \
+    --batch-size            8 \
+    --num-batches           5 \
+    --device-type           cpu \
+    --output                ${ROOT}/train/benchmark_symbols.tsv
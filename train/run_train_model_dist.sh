@@ -0,0 +1,36 @@
+#!/usr/bin/env bash
+
+ROOT=/home/deploy/dylan/projects/kaggle-cdiscount
+
+# 4 workers and 2 servers on the hosts of hosts.txt, each worker reads a quarter of the rec
+python3 -u ${ROOT}/train/launch.py \
+    --num-workers       4 \
+    --num-servers       2 \
+    --hostfile          ${ROOT}/train/hosts.txt \
+    --log-dir           ${ROOT}/train/checkpoints/se-resnext-101-64x4d-dist/logs \
+    -- \
+    python3 -u ${ROOT}/train/train_model.py \
+    --gpus              0,1,2,3,4,5,6,7 \
+    --kv-store          dist_sync \
+    --symbol            resnext \
+    --num-layers        101 \
+    --use-squeeze-excitation \
+    --num-conv-groups   64 \
+    --model-prefix      ${ROOT}/train/checkpoints/se-resnext-101-64x4d-dist/se-resnext-101-64x4d \
+    --data-train        ${ROOT}/data/train_split_train.rec \
+    --data-val          ${ROOT}/data/train_split_val.rec \
+    --image-shape       3,180,180 \
+    --data-nthread      6 \
+    --optimizer         nadam \
+    --lr                0.0001 \
+    --lr-factor         0.2 \
+    --lr-step-epochs    10,13,15 \
+    --disp-batches      100 \
+    --num-epoch         15 \
+    --wd                0.00004 \
+    --top-k             5 \
+    --batch-size        512 \
+    --num-classes       5270 \
+    --num-examples      11754490 \
+    --rgb-mean          0,0,0 \
+    --rgb-scale         1.0
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+import logging
+import coloredlogs
+coloredlogs.install(level=logging.INFO, milliseconds=True)
+
+import mxnet as mx
+
+from train.common import data, fit
+from train.train_model import load_symbol, load_params, get_head_symbol, get_finetune_model
+
+
+def export(args, meta):
+    """merge the trained head into the backbone, so the result can be used by predict.py or train_model.py"""
+    _, head_arg_params, _ = mx.model.load_checkpoint(args.model_prefix, args.num_epochs)
+    base_symbol = load_symbol(meta['symbol'])
+    arg_params, aux_params = load_params(meta['params'])
+    symbol, arg_params, aux_params = get_finetune_model(base_symbol, arg_params, aux_params,
+                                                        num_classes=args.num_classes,
+                                                        feature_layer=meta['feature_layer'],
+                                                        dropout_ratio=args.dropout_ratio,
+                                                        smooth_alpha=args.smooth_alpha)
+    arg_params.update({k: v for k, v in head_arg_params.items() if k.startswith('fc_')})
+    mx.model.save_checkpoint(args.export_prefix, 0, symbol, arg_params, aux_params)
+    logging.info('exported to {}-symbol.json, {}-0000.params'.format(args.export_prefix, args.export_prefix))
+
+
+def train(args):
+    meta = data.load_feature_meta(args.feature_train)
+    logging.info('features: {} x {} from {} layer'.format(meta['num_examples'], meta['feature_dim'], meta['feature_layer']))
+    if args.num_examples is None:
+        args.num_examples = meta['num_examples']
+
+    symbol = get_head_symbol(args.num_classes, args.dropout_ratio, args.smooth_alpha)
+    arg_params, aux_params = {}, {}
+    if args.params:
+        arg_params, aux_params = load_params(args.params)
+
+    fit.fit(args=args,
+            network=symbol,
+            data_loader=data.get_feature_iter,
+            arg_params=arg_params,
+            aux_params=aux_params)
+
+    if args.export_prefix:
+        export(args, meta)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    # add args
+    fit.add_fit_args(parser)
+    data.add_data_args(parser)
+    data.add_feature_args(parser)
+
+    parser.add_argument('--params', type=str, default='', help='.params path of a head to continue training')
+    parser.add_argument('--smooth-alpha', type=float, default=0.0, help='label smoothing')
+    parser.add_argument('--dropout-ratio', type=float, default=None, help='use dropout')
+    parser.add_argument('--export-prefix', type=str, default='',
+                        help='save the backbone with the trained head (requires --model-prefix)')
+    args = parser.parse_args()
+
+    if args.export_prefix and not args.model_prefix:
+        parser.error('--export-prefix requires --model-prefix')
+
+    train(args)
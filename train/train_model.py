@@ -11,7 +11,7 @@ coloredlogs.install(level=logging.INFO, milliseconds=True)
 
 import mxnet as mx
 
-from train.common import data, fit
+from train.common import data, fit, params
 
 
 def load_symbol(symbol_path):
@@ -24,6 +24,8 @@ def load_symbol(symbol_path):
 def load_params(params_path, ignore_arg_names=list()):
     if not os.path.exists(params_path):
         raise FileNotFoundError('not exists: {}'.format(params_path))
+    if params.is_compressed(params_path):
+        return params.load_compressed(params_path, ignore_arg_names)
 
     arg_params, aux_params = {}, {}
     save_dict = mx.nd.load(params_path)
@@ -40,16 +42,26 @@ def load_symbol_params(symbol_path, params_path):
     return load_symbol(symbol_path) + load_params(params_path)
 
 
-def get_finetune_model(base_symbol, arg_params, aux_params, num_classes, feature_layer, dropout_ratio, smooth_alpha, **kwargs):
-    logging.info('fine-tune to {} classes from {} layer'.format(num_classes, feature_layer))
+def get_feature_symbol(base_symbol, feature_layer):
     all_layers = base_symbol.get_internals()
+    return mx.sym.Flatten(data=all_layers[feature_layer + '_output'])  # embedding
+
+
+def get_head_symbol(num_classes, dropout_ratio, smooth_alpha, net=None):
+    net = net if net is not None else mx.sym.Variable('data')
     label = mx.sym.Variable('softmax_label')
-    net = all_layers[feature_layer + '_output']  # embedding
     if dropout_ratio is not None and dropout_ratio > 0.0:
         net = mx.sym.Dropout(net, p=dropout_ratio)
 
     net = mx.sym.FullyConnected(data=net, num_hidden=num_classes, name='fc')
-    new_symbol = mx.sym.SoftmaxOutput(data=net, label=label, name='softmax', smooth_alpha=smooth_alpha)
+    return mx.sym.SoftmaxOutput(data=net, label=label, name='softmax', smooth_alpha=smooth_alpha)
+
+
+def get_finetune_model(base_symbol, arg_params, aux_params, num_classes, feature_layer, dropout_ratio, smooth_alpha, **kwargs):
+    logging.info('fine-tune to {} classes from {} layer'.format(num_classes, feature_layer))
+    all_layers = base_symbol.get_internals()
+    net = all_layers[feature_layer + '_output']  # embedding
+    new_symbol = get_head_symbol(num_classes, dropout_ratio, smooth_alpha, net=net)
 
     new_arg_params = dict({k: arg_params[k] for k in arg_params if 'fc' not in k})
     return new_symbol, new_arg_params, aux_params